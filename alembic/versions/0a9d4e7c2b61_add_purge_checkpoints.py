@@ -0,0 +1,45 @@
+"""Add purge_checkpoints table and indexes for the retention purge
+
+Revision ID: 0a9d4e7c2b61
+Revises: f1c6a3d8b542
+Create Date: 2026-10-18 20:03:51.118406
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0a9d4e7c2b61"
+down_revision: Union[str, None] = "f1c6a3d8b542"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "purge_checkpoints",
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("after_created_at", sa.DateTime(), nullable=True),
+        sa.Column("after_id", sa.Integer(), nullable=True),
+        sa.Column("receipts_deleted", sa.BigInteger(), nullable=False),
+        sa.Column("products_deleted", sa.BigInteger(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("name"),
+    )
+    op.create_index("ix_receipts_created_at", "receipts", ["created_at"], unique=False)
+    op.create_index(
+        "ix_receipt_product_product_id",
+        "receipt_product",
+        ["product_id"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_receipt_product_product_id", table_name="receipt_product")
+    op.drop_index("ix_receipts_created_at", table_name="receipts")
+    op.drop_table("purge_checkpoints")
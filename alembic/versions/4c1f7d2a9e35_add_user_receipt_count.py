@@ -0,0 +1,37 @@
+"""Add users.receipt_count counter
+
+Revision ID: 4c1f7d2a9e35
+Revises: eb8b1375c8bb
+Create Date: 2026-10-18 10:02:11.418203
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "4c1f7d2a9e35"
+down_revision: Union[str, None] = "eb8b1375c8bb"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "users",
+        sa.Column("receipt_count", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.execute(
+        """
+        UPDATE users SET receipt_count = (
+            SELECT COUNT(*) FROM receipts WHERE receipts.user_id = users.id
+        )
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("users", "receipt_count")
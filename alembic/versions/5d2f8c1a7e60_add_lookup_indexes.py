@@ -0,0 +1,36 @@
+"""Add receipts(user_id, created_at) and products(name, price) indexes
+
+Revision ID: 5d2f8c1a7e60
+Revises: 9b3e6a0c5d14
+Create Date: 2026-10-18 15:02:11.418530
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "5d2f8c1a7e60"
+down_revision: Union[str, None] = "9b3e6a0c5d14"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_receipts_user_id_created_at",
+        "receipts",
+        ["user_id", "created_at"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_products_name_price", "products", ["name", "price"], unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_products_name_price", table_name="products")
+    op.drop_index("ix_receipts_user_id_created_at", table_name="receipts")
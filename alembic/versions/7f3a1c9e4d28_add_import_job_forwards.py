@@ -0,0 +1,41 @@
+"""Add import_job_forwards table
+
+Revision ID: 7f3a1c9e4d28
+Revises: 5e2b9c7a1d43
+Create Date: 2026-10-19 10:12:44.618305
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "7f3a1c9e4d28"
+down_revision: Union[str, None] = "5e2b9c7a1d43"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "import_job_forwards",
+        sa.Column("old_id", sa.BigInteger(), nullable=False),
+        sa.Column("new_id", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("old_id"),
+    )
+    op.create_index(
+        op.f("ix_import_job_forwards_new_id"),
+        "import_job_forwards",
+        ["new_id"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        op.f("ix_import_job_forwards_new_id"), table_name="import_job_forwards"
+    )
+    op.drop_table("import_job_forwards")
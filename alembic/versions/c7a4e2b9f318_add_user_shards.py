@@ -0,0 +1,44 @@
+"""Add users.shard and receipt_forwards table
+
+Revision ID: c7a4e2b9f318
+Revises: 5d2f8c1a7e60
+Create Date: 2026-10-18 16:40:52.230117
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c7a4e2b9f318"
+down_revision: Union[str, None] = "5d2f8c1a7e60"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "users",
+        sa.Column("shard", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.create_table(
+        "receipt_forwards",
+        sa.Column("old_id", sa.BigInteger(), nullable=False),
+        sa.Column("new_id", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("old_id"),
+    )
+    op.create_index(
+        op.f("ix_receipt_forwards_new_id"),
+        "receipt_forwards",
+        ["new_id"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_receipt_forwards_new_id"), table_name="receipt_forwards")
+    op.drop_table("receipt_forwards")
+    op.drop_column("users", "shard")
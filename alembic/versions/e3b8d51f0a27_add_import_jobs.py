@@ -0,0 +1,60 @@
+"""Add import_jobs and import_job_errors tables
+
+Revision ID: e3b8d51f0a27
+Revises: c7a4e2b9f318
+Create Date: 2026-10-18 18:05:37.516094
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e3b8d51f0a27"
+down_revision: Union[str, None] = "c7a4e2b9f318"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "import_jobs",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("lines_committed", sa.Integer(), nullable=False),
+        sa.Column("receipts_imported", sa.Integer(), nullable=False),
+        sa.Column("error_count", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["user_id"],
+            ["users.id"],
+        ),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(op.f("ix_import_jobs_id"), "import_jobs", ["id"], unique=False)
+    op.create_index(
+        op.f("ix_import_jobs_user_id"), "import_jobs", ["user_id"], unique=False
+    )
+    op.create_table(
+        "import_job_errors",
+        sa.Column("job_id", sa.Integer(), nullable=False),
+        sa.Column("line", sa.Integer(), nullable=False),
+        sa.Column("detail", sa.String(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["job_id"],
+            ["import_jobs.id"],
+        ),
+        sa.PrimaryKeyConstraint("job_id", "line"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("import_job_errors")
+    op.drop_index(op.f("ix_import_jobs_user_id"), table_name="import_jobs")
+    op.drop_index(op.f("ix_import_jobs_id"), table_name="import_jobs")
+    op.drop_table("import_jobs")
@@ -0,0 +1,43 @@
+"""Add product_sales table for the best sellers leaderboard
+
+Revision ID: f1c6a3d8b542
+Revises: e3b8d51f0a27
+Create Date: 2026-10-18 19:12:08.241730
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "f1c6a3d8b542"
+down_revision: Union[str, None] = "e3b8d51f0a27"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "product_sales",
+        sa.Column("period", sa.String(), nullable=False),
+        sa.Column("started_at", sa.DateTime(), nullable=False),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("price", sa.Float(), nullable=False),
+        sa.Column("quantity", sa.BigInteger(), nullable=False),
+        sa.Column("revenue", sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint("period", "started_at", "name", "price"),
+    )
+    op.create_index(
+        "ix_product_sales_ranking",
+        "product_sales",
+        ["period", "started_at", "quantity"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_product_sales_ranking", table_name="product_sales")
+    op.drop_table("product_sales")
@@ -0,0 +1,457 @@
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import List, Optional
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from app.cache import TTLCache
+from app.config import settings
+from app.models import Receipt, receipt_product
+from app.sharding import global_receipt_id, split_receipt_id
+
+# segment-NNNNNN.dat   zlib-compressed blocks, each a JSON array of receipts
+# segment-NNNNNN.idx   (receipt_id, block offset, block length), sorted by id
+# segment-NNNNNN.uidx  (user_id, receipt_id, created_at, total, payment type),
+#                      sorted by user and id, so listings never decompress
+#                      receipts that are filtered out
+# purged-before        created_at cutoff of the last retention purge; older
+#                      receipts are not served, even while still stored
+# The .idx file is renamed into place last; a segment without it is ignored.
+ID_ENTRY = struct.Struct("<qQI")
+USER_ENTRY = struct.Struct("<qqddB")
+PAYMENT_TYPES = ["cash", "cashless"]
+EPOCH = datetime(1970, 1, 1)
+PURGED_FILE = "purged-before"
+
+
+def to_timestamp(value: datetime) -> float:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - EPOCH).total_seconds()
+
+
+class EntryKeys:
+    """Sequence view of the leading key fields of a packed index, for bisect."""
+
+    def __init__(self, buffer, entry: struct.Struct, fields: int):
+        self.buffer = buffer
+        self.entry = entry
+        self.fields = fields
+
+    def __len__(self):
+        return len(self.buffer) // self.entry.size
+
+    def __getitem__(self, index):
+        return self.entry.unpack_from(self.buffer, index * self.entry.size)[
+            : self.fields
+        ]
+
+
+class Segment:
+    def __init__(self, path: str):
+        self.path = path
+        self._files = []
+        self.data = self._map(path + ".dat")
+        self.ids = self._map(path + ".idx")
+        self.users = self._map(path + ".uidx")
+        keys = EntryKeys(self.ids, ID_ENTRY, 1)
+        self.min_id = keys[0][0]
+        self.max_id = keys[len(keys) - 1][0]
+
+    def _map(self, path: str) -> mmap.mmap:
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._files.append(mapped)
+        return mapped
+
+    def close(self):
+        for mapped in self._files:
+            mapped.close()
+
+    def get(self, receipt_id: int) -> Optional[dict]:
+        keys = EntryKeys(self.ids, ID_ENTRY, 1)
+        index = bisect.bisect_left(keys, (receipt_id,))
+        if index == len(keys):
+            return None
+        found_id, offset, length = ID_ENTRY.unpack_from(self.ids, index * ID_ENTRY.size)
+        if found_id != receipt_id:
+            return None
+        block = json.loads(zlib.decompress(self.data[offset : offset + length]))
+        for record in block:
+            if record["id"] == receipt_id:
+                return record
+        return None
+
+    def records(self):
+        """Every record in the segment, in id order."""
+        last_offset = None
+        for index in range(len(self.ids) // ID_ENTRY.size):
+            _, offset, length = ID_ENTRY.unpack_from(self.ids, index * ID_ENTRY.size)
+            if offset != last_offset:
+                last_offset = offset
+                yield from json.loads(
+                    zlib.decompress(self.data[offset : offset + length])
+                )
+
+    def entries(self):
+        """Every user index entry in the segment."""
+        for index in range(len(self.users) // USER_ENTRY.size):
+            yield USER_ENTRY.unpack_from(self.users, index * USER_ENTRY.size)
+
+    def user_entries(self, user_id: int):
+        keys = EntryKeys(self.users, USER_ENTRY, 1)
+        index = bisect.bisect_left(keys, (user_id,))
+        while index < len(keys):
+            entry = USER_ENTRY.unpack_from(self.users, index * USER_ENTRY.size)
+            if entry[0] != user_id:
+                break
+            yield entry
+            index += 1
+
+
+class Archive:
+    """
+    Read side of the cold-storage archive of old receipts.
+
+    Looking up a receipt costs a binary search in the memory-mapped id index of
+    the segment covering its id, plus decompressing one block. Segments added or
+    removed by the archive and purge jobs are picked up when the directory
+    changes. Receipts created before `purged_before` are not returned. A
+    user's index entries are cached until the directory changes, so paging
+    through a listing or counting it reads the indexes once.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = os.path.abspath(directory)
+        self.purged_before = None
+        self._segments = []
+        # Bumped whenever `_segments` or `purged_before` is reloaded.
+        self._generation = 0
+        self._loaded_mtime = None
+        self._lock = threading.Lock()
+        # (user_id, generation) -> the user's index entries in every segment
+        self._user_entries = TTLCache(
+            ttl=settings.ARCHIVE_CACHE_TTL, maxsize=settings.ARCHIVE_CACHE_USERS
+        )
+
+    def reopen(self, directory: str):
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
+            self.directory = os.path.abspath(directory)
+            self.purged_before = None
+            self._segments = []
+            self._generation += 1
+            self._loaded_mtime = None
+
+    def segments(self) -> List[Segment]:
+        return self.snapshot()[1]
+
+    def snapshot(self) -> tuple:
+        """`(generation, segments)` after picking up changes to the directory."""
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return self._generation, []
+        if mtime != self._loaded_mtime:
+            with self._lock:
+                names = os.listdir(self.directory)
+                # Removed segments are only dropped; readers may still use them.
+                segments = [
+                    segment
+                    for segment in self._segments
+                    if os.path.basename(segment.path) + ".idx" in names
+                ]
+                known = {segment.path for segment in segments}
+                for name in sorted(names):
+                    path = os.path.join(self.directory, name[: -len(".idx")])
+                    if name.endswith(".idx") and path not in known:
+                        segments.append(Segment(path))
+                self.purged_before = read_purged_before(self.directory)
+                self._segments = segments
+                self._generation += 1
+                self._loaded_mtime = mtime
+        with self._lock:
+            return self._generation, self._segments
+
+    def get(self, receipt_id: int) -> Optional[dict]:
+        for segment in self.segments():
+            if segment.min_id <= receipt_id <= segment.max_id:
+                record = segment.get(receipt_id)
+                if record is not None:
+                    return None if self.purged(record) else record
+        return None
+
+    def purged(self, record: dict) -> bool:
+        return self.purged_before is not None and to_timestamp(
+            datetime.fromisoformat(record["created_at"])
+        ) < to_timestamp(self.purged_before)
+
+    def find_user_receipts(
+        self,
+        user_id: int,
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+        min_total: Optional[float] = None,
+        payment_type: Optional[str] = None,
+    ) -> List[int]:
+        """Ids of the user's archived receipts matching the `list_receipts` filters."""
+        start = to_timestamp(start_date) if start_date else None
+        end = to_timestamp(end_date) if end_date else None
+        payment = PAYMENT_TYPES.index(payment_type) if payment_type else None
+
+        generation, segments = self.snapshot()
+        if self.purged_before is not None:
+            purged = to_timestamp(self.purged_before)
+            start = purged if start is None else max(start, purged)
+
+        entries = self._user_entries.get((user_id, generation))
+        if entries is None:
+            # A purge interrupted while rewriting a segment can leave a receipt
+            # in two segments.
+            entries = sorted(
+                {
+                    entry[1]: entry[1:]
+                    for segment in segments
+                    for entry in segment.user_entries(user_id)
+                }.values()
+            )
+            self._user_entries.set((user_id, generation), entries)
+
+        return [
+            receipt_id
+            for receipt_id, created, total, paid_with in entries
+            if (start is None or created >= start)
+            and (end is None or created <= end)
+            and not (min_total and total < min_total)
+            and (payment is None or paid_with == payment)
+        ]
+
+
+def receipt_view(record: dict) -> SimpleNamespace:
+    """Expose an archived record with the attributes of a `Receipt` row."""
+    return SimpleNamespace(
+        id=record["id"],
+        user_id=record["user_id"],
+        owner=SimpleNamespace(name=record["owner"][0], surname=record["owner"][1]),
+        total=record["total"],
+        created_at=datetime.fromisoformat(record["created_at"]),
+        payment_type=record["payment_type"],
+        payment_amount=record["payment_amount"],
+    )
+
+
+def product_views(record: dict) -> List[SimpleNamespace]:
+    return [
+        SimpleNamespace(name=name, price=price, quantity=quantity)
+        for name, price, quantity in record["products"]
+    ]
+
+
+def write_segment(directory: str, records: List[dict], block_records: int) -> str:
+    """Write `records` (sorted by id) as a new segment and return its path."""
+    os.makedirs(directory, exist_ok=True)
+    existing = [name for name in os.listdir(directory) if name.endswith(".idx")]
+    number = max((int(name[8:14]) for name in existing), default=0) + 1
+    path = os.path.join(directory, f"segment-{number:06d}")
+
+    id_entries = []
+    user_entries = []
+    with open(path + ".dat.tmp", "wb") as data:
+        for start in range(0, len(records), block_records):
+            block = records[start : start + block_records]
+            compressed = zlib.compress(
+                json.dumps(block, separators=(",", ":")).encode(), 9
+            )
+            offset = data.tell()
+            data.write(compressed)
+            for record in block:
+                id_entries.append((record["id"], offset, len(compressed)))
+                user_entries.append(
+                    (
+                        record["user_id"],
+                        record["id"],
+                        to_timestamp(datetime.fromisoformat(record["created_at"])),
+                        record["total"],
+                        PAYMENT_TYPES.index(record["payment_type"]),
+                    )
+                )
+        data.flush()
+        os.fsync(data.fileno())
+
+    user_entries.sort()
+    for suffix, entry, entries in (
+        (".uidx", USER_ENTRY, user_entries),
+        (".idx", ID_ENTRY, id_entries),
+    ):
+        with open(path + suffix + ".tmp", "wb") as index:
+            index.write(b"".join(entry.pack(*values) for values in entries))
+            index.flush()
+            os.fsync(index.fileno())
+
+    for suffix in (".dat", ".uidx", ".idx"):
+        os.replace(path + suffix + ".tmp", path + suffix)
+    return path
+
+
+def load_records(
+    db: Session, before: datetime, limit: int, shard: int = 0
+) -> List[dict]:
+    receipts = db.execute(
+        text(
+            """
+            SELECT r.id, r.user_id, u.name, u.surname, r.total, r.created_at,
+                   r.payment_type, r.payment_amount
+            FROM receipts r
+            JOIN users u ON u.id = r.user_id
+            WHERE r.created_at < :before
+            ORDER BY r.id
+            LIMIT :limit
+            """
+        ),
+        {"before": before, "limit": limit},
+    ).fetchall()
+    if not receipts:
+        return []
+
+    products = {}
+    for row in db.execute(
+        text(
+            """
+            SELECT rp.receipt_id, p.name, p.price, rp.quantity
+            FROM receipt_product rp
+            JOIN products p ON p.id = rp.product_id
+            WHERE rp.receipt_id BETWEEN :first AND :last
+            """
+        ),
+        {"first": receipts[0].id, "last": receipts[-1].id},
+    ):
+        products.setdefault(row.receipt_id, []).append(
+            [row.name, row.price, row.quantity]
+        )
+
+    return [
+        {
+            "id": global_receipt_id(shard, r.id),
+            "user_id": r.user_id,
+            "owner": [r.name, r.surname],
+            "total": r.total,
+            "created_at": (
+                r.created_at
+                if isinstance(r.created_at, datetime)
+                else datetime.fromisoformat(r.created_at)
+            ).isoformat(),
+            "payment_type": r.payment_type,
+            "payment_amount": r.payment_amount,
+            "products": products.get(r.id, []),
+        }
+        for r in receipts
+    ]
+
+
+def archive_receipts(
+    db: Session,
+    archive: Archive,
+    before: datetime,
+    segment_receipts: int = None,
+    shard: int = 0,
+) -> int:
+    """
+    Move receipts created before `before` from the live tables of `shard` into
+    new archive segments and return how many were moved. Archived receipts keep
+    their public ids, so the shards share one archive.
+
+    Each segment is written and synced before its rows are deleted. If the job
+    is interrupted in between, the next run finds the rows already archived and
+    only deletes them.
+    """
+    segment_receipts = segment_receipts or settings.ARCHIVE_SEGMENT_RECEIPTS
+    moved = 0
+    while True:
+        records = load_records(db, before, segment_receipts, shard)
+        if not records:
+            return moved
+
+        fresh = [record for record in records if archive.get(record["id"]) is None]
+        if fresh:
+            write_segment(archive.directory, fresh, settings.ARCHIVE_BLOCK_RECEIPTS)
+
+        ids = [split_receipt_id(record["id"])[1] for record in records]
+        for start in range(0, len(ids), 1000):
+            chunk = ids[start : start + 1000]
+            db.execute(
+                receipt_product.delete().where(receipt_product.c.receipt_id.in_(chunk))
+            )
+            db.execute(Receipt.__table__.delete().where(Receipt.id.in_(chunk)))
+        db.commit()
+        moved += len(records)
+
+
+def read_purged_before(directory: str) -> Optional[datetime]:
+    try:
+        with open(os.path.join(directory, PURGED_FILE)) as file:
+            return datetime.fromisoformat(file.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def write_purged_before(directory: str, cutoff: datetime):
+    path = os.path.join(directory, PURGED_FILE)
+    with open(path + ".tmp", "w") as file:
+        file.write(cutoff.isoformat())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def remove_segment(path: str):
+    # The .idx file goes first, so a partly removed segment is ignored.
+    for suffix in (".idx", ".uidx", ".dat"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def purge_archive(archive: Archive, cutoff: datetime):
+    """
+    Delete the archived receipts created before `cutoff`. Yields the
+    `(user_id, receipt_id)` pairs removed from each segment once it is done.
+
+    The cutoff is recorded first, so readers stop returning those receipts at
+    once. Segments holding only expired receipts are then removed, and the
+    others are rewritten without them; the new segment is in place before the
+    old one is removed.
+    """
+    os.makedirs(archive.directory, exist_ok=True)
+    purged_before = read_purged_before(archive.directory)
+    if purged_before is None or purged_before < cutoff:
+        write_purged_before(archive.directory, cutoff)
+
+    limit = to_timestamp(cutoff)
+    for segment in list(archive.segments()):
+        expired = [
+            (user_id, receipt_id)
+            for user_id, receipt_id, created, _, _ in segment.entries()
+            if created < limit
+        ]
+        if not expired:
+            continue
+        if len(expired) < len(segment.users) // USER_ENTRY.size:
+            kept = [
+                record
+                for record in segment.records()
+                if to_timestamp(datetime.fromisoformat(record["created_at"])) >= limit
+            ]
+            write_segment(archive.directory, kept, settings.ARCHIVE_BLOCK_RECEIPTS)
+        remove_segment(segment.path)
+        yield expired
+
+
+archive = Archive(settings.ARCHIVE_DIR)
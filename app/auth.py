@@ -1,3 +1,5 @@
+import uuid
+from typing import Optional
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta, timezone
@@ -5,9 +7,14 @@ from app.config import settings
 from fastapi import HTTPException
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from app.models import User
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, make_transient_to_detached
+from app.cache import TTLCache
+from app.models import User, RevokedToken
+from app.profiling import profiled
 from app.database import get_db
+from app.invalidation import bus
+from app.revocation import revocation_list, utcnow
 
 SECRET_KEY = settings.SECRET_KEY
 ALGORITHM = "HS256"
@@ -17,6 +24,12 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/users/login")
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# username -> column values of the user; publish the username on the "users"
+# topic whenever one of these columns changes.
+user_cache = TTLCache(ttl=settings.USER_CACHE_TTL)
+bus.subscribe("users", user_cache)
+USER_CACHE_COLUMNS = ("id", "username", "hashed_password", "name", "surname", "shard")
+
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -39,20 +52,58 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
 def create_refresh_token(data: dict):
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
-def verify_refresh_token(token: str):
+def verify_refresh_token(token: str, db: Session) -> dict:
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        return username
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid refresh token")
 
+    jti = payload.get("jti")
+    if jti is None or revocation_list.is_revoked(db, jti):
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    return payload
+
+
+def revoke_refresh_token(payload: dict, db: Session):
+    """
+    Record the token's `jti` as revoked and commit.
+    Fails with 401 if the token was already revoked, e.g. by a concurrent refresh.
+    """
+    expires_at = token_expiry(payload)
+    db.add(RevokedToken(jti=payload["jti"], expires_at=expires_at, revoked_at=utcnow()))
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    revocation_list.add(payload["jti"])
+
 
+def token_expiry(payload: dict) -> datetime:
+    return datetime.fromtimestamp(payload["exp"], timezone.utc).replace(tzinfo=None)
+
+
+def find_user(db: Session, username: str) -> Optional[User]:
+    cached = user_cache.get(username)
+    if cached is not None:
+        # Attach a copy to this session without querying; columns left out of
+        # the cache (receipt_count) are loaded on first access.
+        user = User(**cached)
+        make_transient_to_detached(user)
+        return db.merge(user, load=False)
+
+    user = db.query(User).filter(User.username == username).first()
+    if user is not None:
+        user_cache.set(username, {c: getattr(user, c) for c in USER_CACHE_COLUMNS})
+    return user
+
+
+@profiled
 def get_current_user(
     token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)
 ) -> User:
@@ -67,7 +118,7 @@ def get_current_user(
     except JWTError:
         raise credentials_exception
 
-    user = db.query(User).filter(User.username == username).first()
+    user = find_user(db, username)
     if user is None:
         raise credentials_exception
     return user
@@ -0,0 +1,277 @@
+import functools
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import queue
+import threading
+import time
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode
+from jose import JWTError, jwt
+from app.config import settings
+
+# Request and response fields whose values are never written to a capture.
+SECRET_FIELDS = {"password", "access_token", "refresh_token", "token"}
+# Captured usernames are replaced by pseudonyms; see `pseudonym`.
+USERNAME_FIELDS = {"username"}
+JSON_TYPES = ("application/json",)
+FORM_TYPES = ("application/x-www-form-urlencoded",)
+STREAM_TYPES = ("text/event-stream",)
+FLUSH_SECONDS = 1.0
+
+
+def pseudonym(username: str) -> str:
+    """
+    A stable stand-in for `username`, keyed with SECRET_KEY so it cannot be
+    reversed by hashing guesses. Replays create users with these names.
+    """
+    digest = hmac.new(
+        settings.SECRET_KEY.encode(), f"capture:{username}".encode(), hashlib.sha256
+    )
+    return "u_" + digest.hexdigest()[:12]
+
+
+def token_subject(token: str) -> Optional[str]:
+    """The username a JWT issued by this API belongs to, expired or not."""
+    try:
+        payload = jwt.decode(
+            token,
+            settings.SECRET_KEY,
+            algorithms=["HS256"],
+            options={"verify_exp": False},
+        )
+    except JWTError:
+        return None
+    return payload.get("sub")
+
+
+# Clients send the same access token for many requests.
+@functools.lru_cache(maxsize=4096)
+def bearer_pseudonym(token: str) -> Optional[str]:
+    subject = token_subject(token)
+    return pseudonym(subject) if subject is not None else None
+
+
+def sanitize(value, record: dict):
+    """
+    Copy of a request body with secrets blanked and usernames pseudonymized.
+    The user a refresh token belongs to is noted on the record, since the
+    request itself carries no Authorization header.
+    """
+    if isinstance(value, list):
+        return [sanitize(item, record) for item in value]
+    if not isinstance(value, dict):
+        return value
+    result = {}
+    for key, item in value.items():
+        if key in SECRET_FIELDS:
+            if key == "refresh_token" and isinstance(item, str):
+                subject = token_subject(item)
+                if subject is not None:
+                    record["user"] = pseudonym(subject)
+            result[key] = None
+        elif key in USERNAME_FIELDS and isinstance(item, str):
+            result[key] = pseudonym(item)
+        else:
+            result[key] = sanitize(item, record)
+    return result
+
+
+def media_type(headers) -> str:
+    for name, value in headers:
+        if name == b"content-type":
+            return value.decode("latin-1").split(";", 1)[0].strip().lower()
+    return ""
+
+
+def capture_record(scope, started_at, seconds, body, body_size, status, response):
+    """Build the log record of one request; runs on the writer thread."""
+    method = scope["method"]
+    route = scope.get("route")
+    record = {
+        "ts": round(started_at, 6),
+        "method": method,
+        "route": getattr(route, "path", None),
+        "path": scope["path"],
+    }
+    if scope.get("path_params"):
+        record["path_params"] = {
+            name: str(value) for name, value in scope["path_params"].items()
+        }
+    query = scope.get("query_string", b"").decode("latin-1")
+    if query:
+        params = sanitize(dict(parse_qsl(query, keep_blank_values=True)), record)
+        record["query"] = urlencode(
+            [(key, "" if value is None else value) for key, value in params.items()]
+        )
+
+    headers = scope["headers"]
+    for name, value in headers:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() == "bearer":
+                record["user"] = bearer_pseudonym(token)
+        elif name == b"last-event-id":
+            record["last_event_id"] = value.decode("latin-1")
+    content_type = media_type(headers)
+    if body_size:
+        record["content_type"] = content_type
+        record["body_size"] = body_size
+        parsed = None
+        if body is not None and content_type in JSON_TYPES:
+            try:
+                parsed = json.loads(body)
+            except ValueError:
+                pass
+            else:
+                record["json"] = sanitize(parsed, record)
+        elif body is not None and content_type in FORM_TYPES:
+            form = dict(parse_qsl(body.decode("latin-1"), keep_blank_values=True))
+            record["form"] = sanitize(form, record)
+
+    record["status"] = status if status is not None else 500
+    record["duration_ms"] = round(seconds * 1000, 3)
+    response_type, response_body = response
+    if response_type in STREAM_TYPES:
+        record["stream"] = True
+    elif response_body is not None:
+        # Lets a replay map ids of receipts created during the capture.
+        try:
+            created = json.loads(response_body)
+        except ValueError:
+            created = None
+        if isinstance(created, dict) and isinstance(created.get("id"), int):
+            record["created_id"] = created["id"]
+    return record
+
+
+class CaptureLog:
+    """
+    Gzip-compressed JSON lines of captured requests. Requests hand their raw
+    data to a queue; a writer thread builds the records off the event loop and
+    writes them, flushing every second so a capture can be read while it runs.
+    After `max_records` records new requests are no longer captured.
+    """
+
+    def __init__(self, path: str, max_records: int, max_body_bytes: int):
+        self.path = path.replace("{pid}", str(os.getpid()))
+        self.max_records = max_records
+        self.max_body_bytes = max_body_bytes
+        self.records = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+
+    def accepting(self) -> bool:
+        return self._thread is not None and self.records < self.max_records
+
+    def put(self, *raw):
+        self.records += 1
+        self._queue.put(raw)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="traffic-capture", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        # Append a new gzip member so an existing capture is kept.
+        with gzip.open(self.path, "at", encoding="utf-8") as out:
+            last_flush = time.monotonic()
+            while True:
+                try:
+                    raw = self._queue.get(timeout=FLUSH_SECONDS)
+                except queue.Empty:
+                    raw = ()
+                if raw is None:
+                    break
+                if raw:
+                    record = capture_record(*raw)
+                    out.write(json.dumps(record, separators=(",", ":")) + "\n")
+                if time.monotonic() - last_flush >= FLUSH_SECONDS:
+                    out.flush()
+                    last_flush = time.monotonic()
+
+
+class TrafficCapture:
+    """
+    ASGI middleware that logs the shape and timing of every HTTP request to a
+    `CaptureLog` for `python -m app.cli replay`.
+
+    Headers are not kept, except that a bearer token is reduced to a pseudonym
+    of its user. JSON and form bodies up to the log's `max_body_bytes` are kept
+    with passwords and tokens blanked and usernames pseudonymized. Other
+    bodies, such as import uploads, only have their size logged.
+    """
+
+    def __init__(self, app, log: CaptureLog):
+        self.app = app
+        self.log = log
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.log.accepting():
+            await self.app(scope, receive, send)
+            return
+
+        started_at = time.time()
+        started = time.perf_counter()
+        keep_body = media_type(scope["headers"]) in JSON_TYPES + FORM_TYPES
+        body = bytearray()
+        body_size = 0
+        status = None
+        response_type = None
+        response_body = None
+        max_body = self.log.max_body_bytes
+
+        async def capture_receive():
+            nonlocal body_size
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                body_size += len(chunk)
+                if keep_body and body_size <= max_body:
+                    body.extend(chunk)
+            return message
+
+        async def capture_send(message):
+            nonlocal status, response_type, response_body
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                response_type = media_type(message.get("headers", ()))
+                if scope["method"] == "POST" and response_type in JSON_TYPES:
+                    response_body = bytearray()
+            elif message["type"] == "http.response.body" and response_body is not None:
+                response_body.extend(message.get("body", b""))
+                if len(response_body) > max_body:
+                    response_body = None
+            await send(message)
+
+        try:
+            await self.app(scope, capture_receive, capture_send)
+        finally:
+            self.log.put(
+                scope,
+                started_at,
+                time.perf_counter() - started,
+                bytes(body) if keep_body and body_size <= max_body else None,
+                body_size,
+                status,
+                (
+                    response_type,
+                    bytes(response_body) if response_body is not None else None,
+                ),
+            )
+
+
+capture_log = CaptureLog(
+    settings.CAPTURE_FILE, settings.CAPTURE_MAX_RECORDS, settings.CAPTURE_MAX_BODY_BYTES
+)
@@ -0,0 +1,219 @@
+import hmac
+import json
+from datetime import datetime
+from typing import List, Optional
+from fastapi import HTTPException, Request
+from sqlalchemy import delete, func, insert, select, text
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.models import ChangeCompaction, ChangeConsumer, ReceiptChange
+from app.revocation import utcnow
+from app.schemas import ReceiptOut
+
+API_KEY_HEADER = "X-API-Key"
+COMPACTION_NAME = "receipts"
+# Largest batch served by GET /changes.
+MAX_BATCH = 10000
+# Key of the PostgreSQL advisory lock that orders appends to the change log.
+APPEND_LOCK_KEY = 7_316_115_042
+
+
+def consumer_keys() -> dict:
+    """The consumers configured in CHANGES_API_KEYS, as name -> key."""
+    keys = {}
+    for pair in settings.CHANGES_API_KEYS.split(","):
+        name, _, key = pair.strip().partition(":")
+        if name and key:
+            keys[name] = key
+    return keys
+
+
+def get_consumer(request: Request) -> str:
+    """The name of the consumer whose key is in the X-API-Key header."""
+    api_key = request.headers.get(API_KEY_HEADER)
+    if not api_key:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    for name, key in consumer_keys().items():
+        if hmac.compare_digest(key.encode(), api_key.encode()):
+            return name
+    raise HTTPException(status_code=403, detail="Invalid API key")
+
+
+def created_change(receipt: dict, user_id: int) -> dict:
+    """A change log row for a receipt as returned by `create_receipt`."""
+    return {
+        "kind": "created",
+        "receipt_id": receipt["id"],
+        "user_id": user_id,
+        "changed_at": utcnow(),
+        "payload": ReceiptOut.model_validate(receipt).model_dump_json(),
+    }
+
+
+def deleted_change(receipt_id: int, user_id: int) -> dict:
+    return {
+        "kind": "deleted",
+        "receipt_id": receipt_id,
+        "user_id": user_id,
+        "changed_at": utcnow(),
+        "payload": None,
+    }
+
+
+def append_changes(db: Session, changes: List[dict]):
+    """
+    Add rows to the change log in the caller's transaction, so they are
+    committed together with the receipts they describe, or not at all.
+
+    A consumer reads past every offset it has seen, so a change must never
+    become visible after one with a larger offset. SQLite runs one write
+    transaction at a time; PostgreSQL hands out sequence values on insert, so
+    appends take a transaction-level advisory lock and commit in offset order.
+    The lock is held until the commit: call this last.
+    """
+    if not changes:
+        return
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": APPEND_LOCK_KEY})
+    db.execute(insert(ReceiptChange), changes)
+
+
+def compacted_offset(db: Session) -> int:
+    compaction = db.get(ChangeCompaction, COMPACTION_NAME)
+    return compaction.offset if compaction else 0
+
+
+def last_offset(db: Session) -> int:
+    return db.execute(select(func.max(ReceiptChange.offset))).scalar() or 0
+
+
+def read_changes(db: Session, after: int, limit: int) -> list:
+    """Up to `limit + 1` changes after `after`, by a range scan of the key."""
+    return db.execute(
+        select(
+            ReceiptChange.offset,
+            ReceiptChange.kind,
+            ReceiptChange.receipt_id,
+            ReceiptChange.user_id,
+            ReceiptChange.changed_at,
+            ReceiptChange.payload,
+        )
+        .where(ReceiptChange.offset > after)
+        .order_by(ReceiptChange.offset)
+        .limit(limit + 1)
+    ).all()
+
+
+def render_batch(shard: int, after: int, rows: list, limit: int) -> str:
+    """
+    A ChangeBatch as JSON. The stored receipts are already JSON and are
+    spliced in as they are instead of being parsed and serialized again.
+    """
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    changes = ",".join(
+        '{"offset":%d,"kind":%s,"receipt_id":%d,"user_id":%d,'
+        '"changed_at":"%s","receipt":%s}'
+        % (
+            row.offset,
+            json.dumps(row.kind),
+            row.receipt_id,
+            row.user_id,
+            row.changed_at.isoformat(),
+            row.payload or "null",
+        )
+        for row in rows
+    )
+    head = json.dumps(
+        {
+            "shard": shard,
+            "after": after,
+            "next_after": rows[-1].offset if rows else after,
+            "has_more": has_more,
+        }
+    )
+    return f'{head[:-1]},"changes":[{changes}]}}'
+
+
+def get_checkpoint(db: Session, consumer: str) -> int:
+    checkpoint = db.get(ChangeConsumer, consumer)
+    return checkpoint.offset if checkpoint else 0
+
+
+def set_checkpoint(db: Session, consumer: str, offset: int):
+    checkpoint = db.get(ChangeConsumer, consumer)
+    if checkpoint is None:
+        checkpoint = ChangeConsumer(name=consumer)
+        db.add(checkpoint)
+    checkpoint.offset = offset
+    checkpoint.updated_at = utcnow()
+    db.commit()
+
+
+def compact_changes(
+    db: Session,
+    cutoff: datetime,
+    consumers: Optional[List[str]] = None,
+    batch_size: int = settings.CHANGES_COMPACT_BATCH,
+) -> dict:
+    """
+    Delete the changes every consumer has checkpointed past, and the ones
+    changed before `cutoff` whether consumed or not, oldest first.
+
+    `consumers` defaults to the ones in CHANGES_API_KEYS; one without a
+    checkpoint holds back everything newer than `cutoff`. Each batch of
+    `batch_size` changes is deleted in its own transaction together with the
+    new compacted offset, below which GET /changes answers 410.
+    """
+    if consumers is None:
+        consumers = list(consumer_keys())
+    checkpoints = dict(
+        db.execute(
+            select(ChangeConsumer.name, ChangeConsumer.offset).where(
+                ChangeConsumer.name.in_(consumers)
+            )
+        ).all()
+    )
+    consumed = min((checkpoints.get(name, 0) for name in consumers), default=0)
+    compaction = db.get(ChangeCompaction, COMPACTION_NAME)
+    if compaction is None:
+        compaction = ChangeCompaction(
+            name=COMPACTION_NAME, offset=0, changes_deleted=0, updated_at=utcnow()
+        )
+        db.add(compaction)
+        db.commit()
+
+    result = {"changes": 0, "batches": 0}
+    while True:
+        rows = db.execute(
+            select(ReceiptChange.offset, ReceiptChange.changed_at)
+            .where(ReceiptChange.offset > compaction.offset)
+            .order_by(ReceiptChange.offset)
+            .limit(batch_size)
+        ).all()
+        last = None
+        for offset, changed_at in rows:
+            if offset > consumed and changed_at >= cutoff:
+                break
+            last = offset
+        if last is None:
+            break
+
+        deleted = db.execute(
+            delete(ReceiptChange).where(
+                ReceiptChange.offset > compaction.offset,
+                ReceiptChange.offset <= last,
+            )
+        ).rowcount
+        compaction.offset = last
+        compaction.changes_deleted += deleted
+        compaction.updated_at = utcnow()
+        db.commit()
+        result["changes"] += deleted
+        result["batches"] += 1
+        if last != rows[-1].offset or len(rows) < batch_size:
+            break
+
+    result["compacted_offset"] = compaction.offset
+    result["consumed_offset"] = consumed
+    return result
@@ -0,0 +1,392 @@
+"""
+Maintenance commands.
+
+    python -m app.cli provision-users cashiers.json
+    python -m app.cli seed --users 1000 --receipts 1000000 --seed 42
+    python -m app.cli archive --older-than-days 365
+    python -m app.cli rebalance --dry-run
+    python -m app.cli rebuild-leaderboard
+    python -m app.cli purge --older-than-days 1825 --max-seconds 600
+    python -m app.cli compact-changes
+    python -m app.cli prune-revoked-tokens
+    python -m app.cli profile-token --minutes 15
+    python -m app.cli replay capture-*.ndjson.gz --speed 2 --concurrency 64
+"""
+
+import argparse
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+from app.config import settings
+from app.database import SessionLocal, engine
+
+
+def read_records(path: str):
+    """Read a JSON array or JSON lines from `path` ("-" for stdin)."""
+    stream = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    with stream:
+        text = stream.read()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def provision_users(args):
+    from app.provisioning import register_users, shutdown_hash_pool
+    from app.schemas import UserCreate
+
+    users = [UserCreate(**record) for record in read_records(args.file)]
+    counts = {}
+    db = SessionLocal()
+    try:
+        for start in range(0, len(users), args.batch_size):
+            for result in register_users(db, users[start : start + args.batch_size]):
+                counts[result["status"]] = counts.get(result["status"], 0) + 1
+                print(json.dumps(result))
+    finally:
+        db.close()
+        shutdown_hash_pool()
+    print(json.dumps(counts), file=sys.stderr)
+
+
+def seed(args):
+    from sqlalchemy import create_engine
+    from app.seeding import SeedOptions, seed_database
+
+    options = SeedOptions(
+        users=args.users,
+        products=args.products,
+        receipts=args.receipts,
+        basket_mean=args.basket_mean,
+        basket_max=args.basket_max,
+        zipf_exponent=args.zipf,
+        days=args.days,
+        end=args.end,
+        cash_share=args.cash_share,
+        seed=args.seed,
+        batch_size=args.batch_size,
+    )
+
+    def progress(written, seconds):
+        rows = written["receipts"] + written["receipt_product"]
+        print(
+            f"{written['receipts']:,} receipts, {rows:,} rows,"
+            f" {rows / seconds * 60:,.0f} rows/min",
+            file=sys.stderr,
+        )
+
+    target = create_engine(args.database_url) if args.database_url else engine
+    print(json.dumps(seed_database(target, options, progress)))
+
+
+def archive(args):
+    from app.archive import archive, archive_receipts
+    from app.revocation import utcnow
+    from app.sharding import shard_router
+
+    before = utcnow() - timedelta(days=args.older_than_days)
+    moved = 0
+    for shard in range(shard_router.count):
+        db = shard_router.session(shard)
+        try:
+            moved += archive_receipts(db, archive, before, args.segment_receipts, shard)
+        finally:
+            db.close()
+    print(json.dumps({"archived": moved, "before": before.isoformat()}))
+
+
+def rebalance(args):
+    from app.invalidation import bus
+    from app.sharding import rebalance as rebalance_shards, shard_router
+
+    def progress(user_id, source, target, moved):
+        print(
+            json.dumps(
+                {"user_id": user_id, "from": source, "to": target, "receipts": moved}
+            )
+        )
+
+    if settings.INVALIDATION_BACKEND == "memory" and not args.dry_run:
+        # Only this process would see the switches; the API workers would keep
+        # using the old shards and stale counters until their caches expire.
+        sys.exit(
+            "rebalance needs INVALIDATION_BACKEND=postgres or file to reach the"
+            " API workers"
+        )
+    # Started so the moved users' cache invalidations reach the API workers.
+    bus.start()
+    try:
+        result = rebalance_shards(shard_router, args.dry_run, args.batch_size, progress)
+    finally:
+        bus.stop()
+    print(json.dumps(result), file=sys.stderr)
+
+
+def rebuild_leaderboard(args):
+    from app.leaderboard import rebuild_sales
+    from app.sharding import shard_router
+
+    sessions = [shard_router.session(shard) for shard in range(shard_router.count)]
+    try:
+        rows = rebuild_sales(sessions)
+    finally:
+        for db in sessions:
+            db.close()
+    print(json.dumps({"rows": rows}))
+
+
+def purge(args):
+    from app.archive import archive
+    from app.invalidation import bus
+    from app.retention import (
+        count_expired,
+        lag_seconds,
+        purge_archived_receipts,
+        purge_receipts,
+    )
+    from app.revocation import utcnow
+    from app.sharding import shard_router
+
+    cutoff = utcnow() - timedelta(days=args.older_than_days)
+    deadline = None
+    if args.max_seconds is not None:
+        deadline = time.monotonic() + args.max_seconds
+    remaining = args.max_receipts
+    results = []
+    summary = {"cutoff": cutoff.isoformat(), "shards": results}
+
+    def progress(metrics):
+        print(json.dumps(metrics))
+
+    # Started so the purged receipts' cache invalidations reach the API workers.
+    bus.start()
+    try:
+        for shard in range(shard_router.count):
+            db = shard_router.session(shard)
+            try:
+                if args.dry_run:
+                    results.append(
+                        {
+                            "shard": shard,
+                            "receipts": count_expired(db, cutoff),
+                            "lag_seconds": lag_seconds(db, cutoff),
+                        }
+                    )
+                    continue
+                max_seconds = None
+                if deadline is not None:
+                    max_seconds = deadline - time.monotonic()
+                    if max_seconds <= 0:
+                        break
+                result = purge_receipts(
+                    db, shard, cutoff, max_seconds, remaining, progress=progress
+                )
+                results.append(result)
+                if remaining is not None:
+                    remaining -= result["receipts"]
+                    if remaining <= 0:
+                        break
+            finally:
+                db.close()
+        # The archive goes last, once the live tables are done within budget.
+        if not args.dry_run and len(results) == shard_router.count:
+            if all(result["finished"] for result in results):
+                summary["archive"] = purge_archived_receipts(
+                    shard_router, archive, cutoff
+                )
+    finally:
+        bus.stop()
+    print(json.dumps(summary), file=sys.stderr)
+
+
+def prune_revoked_tokens(args):
+    from app.revocation import delete_expired
+
+    db = SessionLocal()
+    try:
+        print(json.dumps({"deleted": delete_expired(db)}))
+    finally:
+        db.close()
+
+
+def compact_changes(args):
+    from app.changes import compact_changes
+    from app.revocation import utcnow
+    from app.sharding import shard_router
+
+    cutoff = utcnow() - timedelta(days=args.older_than_days)
+    results = []
+    for shard in range(shard_router.count):
+        db = shard_router.session(shard)
+        try:
+            result = compact_changes(db, cutoff, batch_size=args.batch_size)
+        finally:
+            db.close()
+        results.append({"shard": shard, **result})
+    print(json.dumps({"cutoff": cutoff.isoformat(), "shards": results}))
+
+
+def profile_token(args):
+    from app.profiling import create_profile_token
+
+    print(create_profile_token(int(args.minutes * 60)))
+
+
+def replay(args):
+    import asyncio
+    from app.replay import compare, read_capture, replay
+
+    records = read_capture(args.files)
+
+    def progress(metrics):
+        print(json.dumps(metrics), file=sys.stderr)
+
+    report = asyncio.run(
+        replay(
+            records,
+            args.base_url,
+            speed=args.speed,
+            concurrency=args.concurrency,
+            progress=progress,
+            timeout=args.timeout,
+        )
+    )
+    if args.baseline:
+        with open(args.baseline) as f:
+            report = compare(report, json.load(f))
+    print(json.dumps(report, indent=2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.cli")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser(
+        "provision-users",
+        help="Register users from a JSON array or JSON lines of UserCreate records",
+    )
+    command.add_argument("file", help='Input file, or "-" for stdin')
+    command.add_argument("--batch-size", type=int, default=5000)
+    command.set_defaults(handler=provision_users)
+
+    command = commands.add_parser(
+        "seed", help="Bulk load deterministic synthetic data for performance testing"
+    )
+    command.add_argument("--users", type=int, default=1000)
+    command.add_argument("--products", type=int, default=10000)
+    command.add_argument("--receipts", type=int, default=100000)
+    command.add_argument("--basket-mean", type=float, default=4.0)
+    command.add_argument("--basket-max", type=int, default=30)
+    command.add_argument(
+        "--zipf", type=float, default=1.1, help="Product popularity exponent"
+    )
+    command.add_argument("--days", type=int, default=365)
+    command.add_argument(
+        "--end",
+        type=datetime.fromisoformat,
+        default=None,
+        help="Newest receipt date (default: today); fix it for byte-identical runs",
+    )
+    command.add_argument("--cash-share", type=float, default=0.4)
+    command.add_argument("--seed", type=int, default=42)
+    command.add_argument("--batch-size", type=int, default=10000)
+    command.add_argument(
+        "--database-url", default=None, help="Defaults to DATABASE_URL"
+    )
+    command.set_defaults(handler=seed)
+
+    command = commands.add_parser(
+        "archive", help="Move old receipts from the live tables to the archive"
+    )
+    command.add_argument(
+        "--older-than-days", type=int, default=settings.ARCHIVE_AFTER_DAYS
+    )
+    command.add_argument("--segment-receipts", type=int, default=None)
+    command.set_defaults(handler=archive)
+
+    command = commands.add_parser(
+        "rebalance",
+        help="Move users whose shard differs from the placement for SHARD_DATABASE_URLS",
+    )
+    command.add_argument(
+        "--dry-run", action="store_true", help="Only count the users to move"
+    )
+    command.add_argument("--batch-size", type=int, default=None)
+    command.set_defaults(handler=rebalance)
+
+    command = commands.add_parser(
+        "rebuild-leaderboard",
+        help="Recount the current best sellers leaderboard from the stored receipts",
+    )
+    command.set_defaults(handler=rebuild_leaderboard)
+
+    command = commands.add_parser(
+        "purge",
+        help="Delete receipts past their retention period in small throttled batches",
+    )
+    command.add_argument("--older-than-days", type=int, default=settings.RETENTION_DAYS)
+    command.add_argument(
+        "--max-seconds", type=float, default=None, help="Stop after this long"
+    )
+    command.add_argument(
+        "--max-receipts", type=int, default=None, help="Stop after this many receipts"
+    )
+    command.add_argument(
+        "--dry-run", action="store_true", help="Only count the expired receipts"
+    )
+    command.set_defaults(handler=purge)
+
+    command = commands.add_parser(
+        "prune-revoked-tokens",
+        help="Delete the revocations of refresh tokens that have expired",
+    )
+    command.set_defaults(handler=prune_revoked_tokens)
+
+    command = commands.add_parser(
+        "compact-changes",
+        help="Delete the receipt changes every consumer has checkpointed past",
+    )
+    command.add_argument(
+        "--older-than-days",
+        type=int,
+        default=settings.CHANGES_RETENTION_DAYS,
+        help="Also delete unconsumed changes older than this",
+    )
+    command.add_argument(
+        "--batch-size", type=int, default=settings.CHANGES_COMPACT_BATCH
+    )
+    command.set_defaults(handler=compact_changes)
+
+    command = commands.add_parser(
+        "profile-token",
+        help="Print an X-Profile-Token header value that profiles requests",
+    )
+    command.add_argument("--minutes", type=float, default=15.0)
+    command.set_defaults(handler=profile_token)
+
+    command = commands.add_parser(
+        "replay",
+        help="Re-issue captured traffic (CAPTURE_FILE) and report latency per route",
+    )
+    command.add_argument("files", nargs="+", help="Capture files, one per worker")
+    command.add_argument("--base-url", default="http://127.0.0.1:8000")
+    command.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Time compression of the captured schedule; 0 sends as fast as possible",
+    )
+    command.add_argument("--concurrency", type=int, default=32)
+    command.add_argument("--timeout", type=float, default=30.0)
+    command.add_argument(
+        "--baseline", default=None, help="An earlier report to compare latencies with"
+    )
+    command.set_defaults(handler=replay)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,88 @@ class Settings(BaseSettings):
     DATABASE_URL_TEST: str
     SECRET_KEY: str
 
+    RECEIPT_COUNT_CACHE_TTL: float = 5.0
+    RECEIPT_COUNT_ESTIMATE_THRESHOLD: int = 100000
+    REVOCATION_SYNC_SECONDS: float = 30.0
+    # Revoked refresh-token ids the in-memory filter holds before a rebuild.
+    REVOCATION_FILTER_CAPACITY: int = 1000000
+
+    # "memory" (single worker), "file" or "postgres"
+    INVALIDATION_BACKEND: str = "memory"
+    INVALIDATION_FILE: str = "/tmp/receipt-api-invalidation.log"
+    INVALIDATION_BATCH_SECONDS: float = 0.05
+    INVALIDATION_FALLBACK_TTL: float = 5.0
+    USER_CACHE_TTL: float = 60.0
+    PRODUCT_CACHE_TTL: float = 300.0
+    RECEIPT_TEXT_CACHE_TTL: float = 300.0
+
+    BULK_REGISTER_MAX_USERS: int = 10000
+    # Sent in the X-API-Key header of POST /users/register/bulk; empty disables
+    # the endpoint.
+    PROVISIONING_API_KEY: str = ""
+
+    # Relative to the working directory the process starts in; the CLI and
+    # every worker must resolve it to the same directory.
+    ARCHIVE_DIR: str = "archive"
+    ARCHIVE_AFTER_DAYS: int = 365
+    ARCHIVE_SEGMENT_RECEIPTS: int = 100000
+    ARCHIVE_BLOCK_RECEIPTS: int = 64
+    ARCHIVE_CACHE_TTL: float = 600.0
+    ARCHIVE_CACHE_USERS: int = 1024
+
+    INSIGHTS_CACHE_TTL: float = 600.0
+    INSIGHTS_CACHE_USERS: int = 256
+    # How long after a receipt id is read a lower one may still commit.
+    INSIGHTS_OVERLAP_SECONDS: float = 10.0
+
+    # Comma-separated database URLs of shards 1..N-1; shard 0 is DATABASE_URL.
+    SHARD_DATABASE_URLS: str = ""
+
+    IMPORT_BATCH_RECEIPTS: int = 1000
+    IMPORT_MAX_LINE_BYTES: int = 1048576
+    IMPORT_MAX_ERRORS: int = 1000
+    IMPORT_STALE_SECONDS: float = 300.0
+
+    LEADERBOARD_CAPACITY: int = 1000
+    LEADERBOARD_FLUSH_SECONDS: float = 5.0
+    LEADERBOARD_RETENTION_DAYS: int = 90
+
+    SUGGEST_REFRESH_SECONDS: float = 30.0
+    SUGGEST_REBUILD_SECONDS: float = 3600.0
+    SUGGEST_CACHE_TTL: float = 5.0
+
+    STREAM_QUEUE_SIZE: int = 256
+    STREAM_HEARTBEAT_SECONDS: float = 15.0
+    STREAM_REPLAY_BATCH: int = 100
+    STREAM_MAX_SECONDS: float = 3600.0
+
+    RETENTION_DAYS: int = 1825
+    PURGE_BATCH_RECEIPTS: int = 500
+    PURGE_MIN_BATCH_RECEIPTS: int = 20
+    # Batches slower than this shrink; faster ones grow back.
+    PURGE_TARGET_BATCH_SECONDS: float = 0.1
+    # Share of wall time spent deleting; the rest is left to live traffic.
+    PURGE_DUTY_CYCLE: float = 0.5
+
+    # Consumers of GET /changes as comma-separated "name:key" pairs; the key is
+    # sent in the X-API-Key header.
+    CHANGES_API_KEYS: str = ""
+    # Changes older than this are compacted even if not every consumer has
+    # checkpointed past them.
+    CHANGES_RETENTION_DAYS: int = 7
+    CHANGES_COMPACT_BATCH: int = 10000
+
+    # Share of requests profiled without a signed X-Profile-Token header.
+    PROFILE_SAMPLE_RATE: float = 0.0
+    PROFILE_DIR: str = "profiles"
+    PROFILE_MAX_PROFILES: int = 200
+
+    # Log requests for `python -m app.cli replay` when set; "{pid}" in the path
+    # is replaced by the worker's process id.
+    CAPTURE_FILE: str = ""
+    CAPTURE_MAX_RECORDS: int = 1000000
+    CAPTURE_MAX_BODY_BYTES: int = 65536
+
     class Config:
         env_file = ".env"
 
@@ -0,0 +1,346 @@
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List, Optional, Tuple
+from fastapi import HTTPException
+from pydantic import ValidationError
+from sqlalchemy import insert, select, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from app.cache import TTLCache
+from app.changes import append_changes, created_change
+from app.config import settings
+from app.invalidation import bus
+from app.leaderboard import leaderboard
+from app.models import (
+    ImportJob,
+    ImportJobError,
+    Product,
+    Receipt,
+    User,
+    receipt_product,
+)
+from app.pagination import invalidate_receipt_counts
+from app.revocation import utcnow
+from app.schemas import ReceiptCreate, ReceiptImport
+from app.sharding import global_receipt_id
+from app.streaming import receipt_broker
+from app.suggestions import product_index
+
+# Upper bound on the output of one zlib call, so a highly compressed chunk is
+# inflated piece by piece.
+MAX_INFLATE_BYTES = 1 << 20
+PRODUCT_LOOKUP_CHUNK_SIZE = 500
+MAX_ERROR_DETAIL = 500
+
+
+def price_receipt(receipt: ReceiptCreate) -> Tuple[list, float]:
+    """Return the bought products and the total, or fail like `create_receipt`."""
+    valid_products = [p for p in receipt.products if p.quantity > 0]
+    if not valid_products:
+        raise HTTPException(status_code=400, detail="No products were bought.")
+
+    total = sum([p.price * p.quantity for p in valid_products])
+    if receipt.payment.amount < total:
+        raise HTTPException(status_code=400, detail="Insufficient payment")
+    return valid_products, total
+
+
+class LineSplitter:
+    """
+    Split an NDJSON byte stream, optionally gzip-compressed (also several
+    concatenated gzip members), into numbered lines as chunks arrive.
+
+    Lines longer than `max_line_bytes` are yielded as None instead of being
+    buffered, so memory stays bounded whatever the input.
+    """
+
+    def __init__(self, compressed: bool, max_line_bytes: int):
+        self.compressed = compressed
+        self.max_line_bytes = max_line_bytes
+        self.number = 0
+        self._buffer = bytearray()
+        self._oversized = False
+        self._decompressor = None
+        self._member_started = False
+
+    def feed(self, chunk: bytes) -> Iterator[Tuple[int, Optional[bytes]]]:
+        for data in self._inflate(chunk) if self.compressed else (chunk,):
+            yield from self._split(data)
+
+    def finish(self) -> Iterator[Tuple[int, Optional[bytes]]]:
+        if self.compressed and self._member_started:
+            raise ValueError("Truncated gzip stream")
+        if self._buffer or self._oversized:
+            yield self._end_line(b"")
+
+    def _inflate(self, chunk: bytes) -> Iterator[bytes]:
+        while chunk:
+            if self._decompressor is None:
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._member_started = True
+            try:
+                data = self._decompressor.decompress(chunk, MAX_INFLATE_BYTES)
+            except zlib.error:
+                raise ValueError("Invalid gzip data")
+            yield data
+            if self._decompressor.eof:
+                chunk = self._decompressor.unused_data
+                self._decompressor = None
+                self._member_started = False
+            else:
+                chunk = self._decompressor.unconsumed_tail
+
+    def _split(self, data: bytes) -> Iterator[Tuple[int, Optional[bytes]]]:
+        start = 0
+        while True:
+            end = data.find(b"\n", start)
+            if end < 0:
+                self._append(data[start:])
+                return
+            yield self._end_line(data[start:end])
+            start = end + 1
+
+    def _append(self, data: bytes):
+        if not self._oversized:
+            self._buffer += data
+            if len(self._buffer) > self.max_line_bytes:
+                self._oversized = True
+                self._buffer.clear()
+
+    def _end_line(self, data: bytes) -> Tuple[int, Optional[bytes]]:
+        self._append(data)
+        self.number += 1
+        line = None if self._oversized else bytes(self._buffer)
+        self._buffer.clear()
+        self._oversized = False
+        return self.number, line
+
+
+def error_detail(error: Exception) -> str:
+    if isinstance(error, ValidationError):
+        detail = "; ".join(
+            f"{'.'.join(str(part) for part in e['loc']) or 'line'}: {e['msg']}"
+            for e in error.errors()
+        )
+    elif isinstance(error, HTTPException):
+        detail = error.detail
+    else:
+        detail = str(error)
+    return detail[:MAX_ERROR_DETAIL]
+
+
+def normalize_created_at(value: Optional[datetime]) -> datetime:
+    if value is None:
+        return utcnow()
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+class ReceiptImporter:
+    """
+    Validates raw NDJSON lines and writes them for one import job in batches.
+
+    Each batch of receipts is committed together with the job's progress, so
+    `lines_committed` always tells exactly where a resumed upload continues.
+    """
+
+    def __init__(
+        self, db: Session, job: ImportJob, shard: int, product_cache: TTLCache
+    ):
+        self.db = db
+        self.job = job
+        self.shard = shard
+        self.product_cache = product_cache
+
+    def write_batch(self, lines: List[Tuple[int, Optional[bytes]]]):
+        receipts = []
+        errors = []
+        for number, line in lines:
+            if line is None:
+                errors.append((number, "Line too long"))
+                continue
+            if not line.strip():
+                continue
+            try:
+                receipt = ReceiptImport.model_validate_json(line)
+                products, total = price_receipt(receipt)
+            except (ValidationError, HTTPException) as error:
+                errors.append((number, error_detail(error)))
+                continue
+            receipts.append((receipt, products, total))
+
+        try:
+            product_ids = self.store(lines, receipts, errors, use_cache=True)
+        except IntegrityError:
+            # The retention purge deleted a product between its lookup and the
+            # insert. Look all of them up again once.
+            self.db.rollback()
+            product_ids = self.store(lines, receipts, errors, use_cache=False)
+
+        for key, product_id in product_ids.items():
+            self.product_cache.set((self.shard,) + key, product_id)
+        if receipts:
+            user_id = self.job.user_id
+            invalidate_receipt_counts(user_id)
+            bus.publish("insights", user_id)
+            receipt_broker.notify(user_id)
+        for receipt, products, _ in receipts:
+            sold = [(p.name, p.price, p.quantity) for p in products]
+            leaderboard.record(normalize_created_at(receipt.created_at), sold)
+            product_index.record(sold)
+
+    def store(self, lines: list, receipts: list, errors: list, use_cache: bool) -> dict:
+        """
+        Write the batch and the job's progress in one transaction and return
+        the product ids used.
+        """
+        product_ids = self.resolve_products(
+            {(p.name, p.price) for _, products, _ in receipts for p in products},
+            use_cache,
+        )
+        changes = []
+        if receipts:
+            changes = self.insert_receipts(receipts, product_ids)
+
+        job = self.job
+        # Errors are stored in line order until the limit is reached.
+        room = max(0, settings.IMPORT_MAX_ERRORS - job.error_count)
+        if errors[:room]:
+            self.db.execute(
+                insert(ImportJobError),
+                [
+                    {"job_id": job.id, "line": number, "detail": detail}
+                    for number, detail in errors[:room]
+                ],
+            )
+        if lines:
+            job.lines_committed = max(job.lines_committed, lines[-1][0])
+        job.receipts_imported += len(receipts)
+        job.error_count += len(errors)
+        job.updated_at = utcnow()
+        append_changes(self.db, changes)
+        self.db.commit()
+        return product_ids
+
+    def resolve_products(self, keys: set, use_cache: bool = True) -> dict:
+        """Map `(name, price)` to product ids, creating the missing products."""
+        product_ids = {}
+        missing = []
+        for key in keys:
+            product_id = (
+                self.product_cache.get((self.shard,) + key) if use_cache else None
+            )
+            if product_id is None:
+                missing.append(key)
+            else:
+                product_ids[key] = product_id
+
+        for start in range(0, len(missing), PRODUCT_LOOKUP_CHUNK_SIZE):
+            chunk = missing[start : start + PRODUCT_LOOKUP_CHUNK_SIZE]
+            for product_id, name, price in self.db.execute(
+                select(Product.id, Product.name, Product.price).where(
+                    tuple_(Product.name, Product.price).in_(chunk)
+                )
+            ):
+                product_ids.setdefault((name, price), product_id)
+
+        new = [key for key in missing if key not in product_ids]
+        if new:
+            created = self.db.execute(
+                insert(Product).returning(Product.id, sort_by_parameter_order=True),
+                [{"name": name, "price": price} for name, price in new],
+            ).scalars()
+            product_ids.update(zip(new, created))
+        return product_ids
+
+    def insert_receipts(self, receipts: list, product_ids: dict):
+        user_id = self.job.user_id
+        created_at = [normalize_created_at(r.created_at) for r, _, _ in receipts]
+        # A cashless payment is stored as exactly the total, like `create_receipt`.
+        amounts = [
+            receipt.payment.amount if receipt.payment.type == "cash" else total
+            for receipt, _, total in receipts
+        ]
+        receipt_ids = self.db.execute(
+            insert(Receipt).returning(Receipt.id, sort_by_parameter_order=True),
+            [
+                {
+                    "total": total,
+                    "created_at": created,
+                    "payment_type": receipt.payment.type,
+                    "payment_amount": amount,
+                    "user_id": user_id,
+                }
+                for (receipt, _, total), created, amount in zip(
+                    receipts, created_at, amounts
+                )
+            ],
+        ).scalars()
+
+        items = []
+        changes = []
+        for receipt_id, (receipt, products, total), created, amount in zip(
+            receipt_ids, receipts, created_at, amounts
+        ):
+            # A product listed twice on one receipt becomes one line item.
+            quantities = {}
+            for p in products:
+                key = (p.name, p.price)
+                quantities[key] = quantities.get(key, 0) + p.quantity
+            items.extend(
+                {
+                    "receipt_id": receipt_id,
+                    "product_id": product_ids[key],
+                    "quantity": q,
+                }
+                for key, q in quantities.items()
+            )
+            changes.append(
+                created_change(
+                    {
+                        "id": global_receipt_id(self.shard, receipt_id),
+                        "products": [
+                            {"name": name, "price": price, "total": price * q}
+                            for (name, price), q in quantities.items()
+                        ],
+                        "total": total,
+                        "rest": amount - total,
+                        "created_at": created,
+                        "payment": {"type": receipt.payment.type, "amount": amount},
+                    },
+                    user_id,
+                )
+            )
+        self.db.execute(receipt_product.insert(), items)
+        self.db.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(receipt_count=User.receipt_count + len(receipts))
+        )
+        return changes
+
+    def set_status(self, status: str):
+        self.job.status = status
+        self.job.updated_at = utcnow()
+        self.db.commit()
+
+
+def claim_job(db: Session, job: ImportJob) -> bool:
+    """
+    Mark the job as receiving an upload. Fails while another upload is active,
+    unless that one has not made progress for IMPORT_STALE_SECONDS.
+    """
+    stale_before = utcnow() - timedelta(seconds=settings.IMPORT_STALE_SECONDS)
+    claimed = db.execute(
+        update(ImportJob)
+        .where(
+            ImportJob.id == job.id,
+            ImportJob.status != "completed",
+            (ImportJob.status != "running") | (ImportJob.updated_at < stale_before),
+        )
+        .values(status="running", updated_at=utcnow())
+    ).rowcount
+    db.commit()
+    db.refresh(job)
+    return bool(claimed)
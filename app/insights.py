@@ -0,0 +1,253 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import List
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from app.cache import TTLCache
+from app.config import settings
+from app.invalidation import bus
+from app.revocation import utcnow
+
+PERCENTILES = [10, 25, 50, 75, 90, 99]
+
+LINE_ITEMS_QUERY = """
+    SELECT r.id, r.total, r.created_at, rp.product_id, rp.quantity, p.price, p.name
+    FROM receipts r
+    JOIN receipt_product rp ON rp.receipt_id = r.id
+    JOIN products p ON p.id = rp.product_id
+    WHERE r.user_id = :user_id AND r.id > :after_id
+    ORDER BY r.created_at, r.id
+"""
+
+
+class GrowableColumn:
+    """NumPy array with amortized O(1) appends."""
+
+    def __init__(self, dtype, capacity: int = 64):
+        self._data = np.empty(capacity, dtype=dtype)
+        self._size = 0
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self._data.dtype)
+        needed = self._size + len(values)
+        if needed > len(self._data):
+            grown = np.empty(max(needed, 2 * len(self._data)), dtype=self._data.dtype)
+            grown[: self._size] = self._data[: self._size]
+            self._data = grown
+        self._data[self._size : needed] = values
+        self._size = needed
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._data[: self._size]
+
+    def __len__(self):
+        return self._size
+
+
+class SpendingColumns:
+    """
+    A user's receipts and line items as compact column arrays.
+
+    Line items refer to their receipt and product by position, so product names
+    are stored once per product rather than once per line.
+
+    Receipt ids are handed out on insert but become visible on commit, so a
+    receipt can show up after one with a higher id. Catching up therefore reads
+    everything above `settled_until`, the highest id held INSIGHTS_OVERLAP_SECONDS
+    ago, and skips the receipts in `recent_ids`, the ones above it already held.
+    The first load settles every receipt created before the overlap window.
+    """
+
+    def __init__(self):
+        self.receipt_ids = GrowableColumn(np.int64)
+        self.totals = GrowableColumn(np.float64)
+        self.created_at = GrowableColumn("datetime64[s]")
+        self.item_receipt = GrowableColumn(np.int32)
+        self.item_product = GrowableColumn(np.int32)
+        self.item_quantity = GrowableColumn(np.int32)
+        self.item_price = GrowableColumn(np.float64)
+        self.product_index = {}
+        self.product_names = []
+        self.product_prices = []
+        self.settled_until = 0
+        self.recent_ids = set()
+        self._watermarks = deque()
+        self.lock = threading.Lock()
+
+    def catch_up(self, rows: list):
+        """Append line item rows of receipts above `settled_until` not yet held."""
+        first_load = not len(self.receipt_ids)
+        rows = [row for row in rows if row[0] not in self.recent_ids]
+        self.append_rows(rows)
+        if first_load and rows:
+            ids = self.receipt_ids.values
+            created_before = utcnow() - timedelta(
+                seconds=settings.INSIGHTS_OVERLAP_SECONDS
+            )
+            settled = ids[self.created_at.values <= np.datetime64(created_before, "s")]
+            if len(settled):
+                self.settled_until = int(settled.max())
+            self.recent_ids = set(ids[ids > self.settled_until].tolist())
+        else:
+            self.recent_ids.update(row[0] for row in rows)
+
+        now = time.monotonic()
+        if self.recent_ids:
+            self._watermarks.append((now, max(self.recent_ids)))
+        cutoff = now - settings.INSIGHTS_OVERLAP_SECONDS
+        while self._watermarks and self._watermarks[0][0] <= cutoff:
+            self.settled_until = max(self.settled_until, self._watermarks.popleft()[1])
+        self.recent_ids = {i for i in self.recent_ids if i > self.settled_until}
+
+    def append_rows(self, rows: list):
+        """
+        Append line item rows `(receipt_id, total, created_at, product_id,
+        quantity, price, name)`, grouped by receipt.
+        """
+        if not rows:
+            return
+        receipt_ids, totals, created, product_ids, quantities, prices, names = zip(
+            *rows
+        )
+        receipt_ids = np.array(receipt_ids, dtype=np.int64)
+        starts = np.flatnonzero(np.r_[True, receipt_ids[1:] != receipt_ids[:-1]])
+
+        products = np.empty(len(rows), dtype=np.int32)
+        for i, product_id in enumerate(product_ids):
+            position = self.product_index.get(product_id)
+            if position is None:
+                position = len(self.product_names)
+                self.product_index[product_id] = position
+                self.product_names.append(names[i])
+                self.product_prices.append(prices[i])
+            products[i] = position
+
+        first_position = len(self.receipt_ids)
+        self.receipt_ids.extend(receipt_ids[starts])
+        self.totals.extend(np.array(totals, dtype=np.float64)[starts])
+        self.created_at.extend(
+            np.array([normalize(created[i]) for i in starts], dtype="datetime64[s]")
+        )
+        self.item_receipt.extend(
+            first_position + np.cumsum(np.r_[0, np.diff(receipt_ids) != 0])
+        )
+        self.item_product.extend(products)
+        self.item_quantity.extend(quantities)
+        self.item_price.extend(prices)
+
+    def summary(self, top: int) -> dict:
+        totals = self.totals.values
+        if not len(totals):
+            return {
+                "receipt_count": 0,
+                "total_spent": 0.0,
+                "total_percentiles": {},
+                "median_basket_items": 0.0,
+                "top_products": [],
+                "heatmap": np.zeros((7, 24), dtype=np.int64).tolist(),
+            }
+
+        quantity = self.item_quantity.values
+        spent = quantity * self.item_price.values
+        item_receipt = self.item_receipt.values
+        item_product = self.item_product.values
+
+        basket_items = np.bincount(
+            item_receipt, weights=quantity, minlength=len(totals)
+        )
+        product_quantity = np.bincount(item_product, weights=quantity)
+        product_spent = np.bincount(item_product, weights=spent)
+
+        top = min(top, len(product_spent))
+        best = np.argpartition(-product_spent, top - 1)[:top]
+        best = best[np.argsort(-product_spent[best], kind="stable")]
+
+        seconds = self.created_at.values.astype(np.int64)
+        days = seconds // 86400
+        weekday = (days + 3) % 7  # 1970-01-01 was a Thursday; Monday is 0.
+        hour = (seconds // 3600) % 24
+        heatmap = np.bincount(weekday * 24 + hour, minlength=7 * 24).reshape(7, 24)
+
+        return {
+            "receipt_count": int(len(totals)),
+            "total_spent": float(totals.sum()),
+            "total_percentiles": {
+                f"p{p}": float(v)
+                for p, v in zip(PERCENTILES, np.percentile(totals, PERCENTILES))
+            },
+            "median_basket_items": float(np.median(basket_items)),
+            "top_products": [
+                {
+                    "name": self.product_names[i],
+                    "price": self.product_prices[i],
+                    "quantity": int(product_quantity[i]),
+                    "spent": float(product_spent[i]),
+                }
+                for i in best
+            ],
+            "heatmap": heatmap.tolist(),
+        }
+
+
+def normalize(value) -> datetime:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+# user_id -> SpendingColumns; publish the user id on the "insights" topic when
+# receipts are deleted or changed.
+spending_cache = TTLCache(
+    ttl=settings.INSIGHTS_CACHE_TTL, maxsize=settings.INSIGHTS_CACHE_USERS
+)
+bus.subscribe("insights", spending_cache)
+
+
+def load_rows(db: Session, user_id: int, after_id: int) -> list:
+    return db.execute(
+        text(LINE_ITEMS_QUERY), {"user_id": user_id, "after_id": after_id}
+    ).fetchall()
+
+
+def get_insights(db: Session, user_id: int, top: int = 10) -> dict:
+    """
+    Spending statistics for one user.
+
+    The first call loads all of the user's line items in one query. Later calls
+    only fetch receipts above the settled id, which picks up receipts created by
+    other workers. Imports publish the user on the "insights" topic, since their
+    receipts may be dated before the overlap window.
+    """
+    columns = spending_cache.get(user_id)
+    if columns is None:
+        columns = SpendingColumns()
+        spending_cache.set(user_id, columns)
+    with columns.lock:
+        columns.catch_up(load_rows(db, user_id, columns.settled_until))
+        return columns.summary(top)
+
+
+def record_receipt(user_id: int, receipt_id: int, total, created_at, items: List):
+    """
+    Append a receipt created in this worker to the user's cached columns.
+    `items` are `(product_id, name, price, quantity)` tuples.
+    """
+    columns = spending_cache.get(user_id)
+    if columns is None:
+        return
+    with columns.lock:
+        if receipt_id <= columns.settled_until or receipt_id in columns.recent_ids:
+            return
+        columns.recent_ids.add(receipt_id)
+        columns.append_rows(
+            [
+                (receipt_id, total, created_at, product_id, quantity, price, name)
+                for product_id, name, price, quantity in items
+            ]
+        )
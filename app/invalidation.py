@@ -0,0 +1,383 @@
+import hashlib
+import json
+import logging
+import os
+import select
+import tempfile
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from sqlalchemy.engine import make_url
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Topics with more pending keys than this are sent as a single "clear" message.
+MAX_KEYS_PER_TOPIC = 256
+POSTGRES_CHANNEL = "cache_invalidation"
+POSTGRES_MAX_PAYLOAD = 7900
+
+
+def _hashable(key):
+    if isinstance(key, list):
+        return tuple(_hashable(k) for k in key)
+    return key
+
+
+def worker_directory() -> str:
+    """Where the workers using DATABASE_URL on this machine register."""
+    digest = hashlib.sha1(settings.DATABASE_URL.encode()).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f"receipt-api-workers-{digest}")
+
+
+def register_worker(directory: str) -> int:
+    """Register this process in `directory` and count the live ones there."""
+    os.makedirs(directory, exist_ok=True)
+    open(os.path.join(directory, str(os.getpid())), "w").close()
+    live = 0
+    for name in os.listdir(directory):
+        try:
+            os.kill(int(name), 0)
+        except (ValueError, ProcessLookupError):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+            continue
+        except PermissionError:
+            pass
+        live += 1
+    return live
+
+
+def unregister_worker(directory: str):
+    try:
+        os.remove(os.path.join(directory, str(os.getpid())))
+    except OSError:
+        pass
+
+
+class InvalidationBus:
+    """
+    Evicts subscribed caches when keys are published on a topic.
+
+    This base class only delivers within the current process, which is enough
+    for a single worker. Caches must provide `evict(key)`, `clear()` and
+    `cap_ttl(seconds)`. Starting it warns when other workers on this machine
+    use the same database, since they would keep serving stale entries.
+    """
+
+    def __init__(self, batch_interval: float = 0.05, fallback_ttl: float = 5.0):
+        self.batch_interval = batch_interval
+        self.fallback_ttl = fallback_ttl
+        self.degraded = False
+        self._subscribers = defaultdict(list)
+        self._never_clear = set()
+
+    def subscribe(self, topic: str, cache, never_clear: bool = False):
+        """
+        Evict `cache` entries published on `topic`. With `never_clear` the
+        topic's keys are always sent, however many there are.
+        """
+        self._subscribers[topic].append(cache)
+        if never_clear:
+            self._never_clear.add(topic)
+        cache.cap_ttl(self.fallback_ttl if self.degraded else None)
+
+    def publish(self, topic: str, *keys):
+        self._apply(topic, keys)
+
+    def start(self):
+        try:
+            workers = register_worker(worker_directory())
+        except OSError:
+            return
+        if workers > 1:
+            logger.warning(
+                "%d workers share the database but INVALIDATION_BACKEND=memory "
+                "only invalidates caches within each worker; set it to "
+                '"postgres" or "file"',
+                workers,
+            )
+
+    def stop(self):
+        unregister_worker(worker_directory())
+
+    def _apply(self, topic: str, keys):
+        for cache in self._subscribers.get(topic, ()):
+            if keys is None:
+                cache.clear()
+            else:
+                for key in keys:
+                    cache.evict(_hashable(key))
+
+    def _clear_all(self):
+        for caches in self._subscribers.values():
+            for cache in caches:
+                cache.clear()
+
+    def _set_degraded(self, degraded: bool):
+        self.degraded = degraded
+        for caches in self._subscribers.values():
+            for cache in caches:
+                cache.cap_ttl(self.fallback_ttl if degraded else None)
+
+
+class BackendInvalidationBus(InvalidationBus, ABC):
+    """
+    Base class for buses that share invalidations between processes.
+
+    Published keys are evicted locally right away, then collected for
+    `batch_interval` seconds and sent to the other workers as one message by a
+    background thread. A topic with too many pending keys is sent as "clear the
+    whole topic" instead, unless it was subscribed with `never_clear`. While
+    the backend is unreachable the bus is degraded: subscribed caches have
+    their TTL capped at `fallback_ttl`, reconnects back off exponentially, and
+    all caches are cleared once the connection is back since messages may have
+    been missed.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.origin = uuid.uuid4().hex
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def publish(self, topic: str, *keys):
+        super().publish(topic, *keys)
+        if self._thread is not None:
+            self._queue(topic, keys)
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._set_degraded(True)
+            self._thread = threading.Thread(
+                target=self._run, name="invalidation-bus", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+            if self._connected():
+                self._flush()
+            self._disconnect()
+
+    def _queue(self, topic: str, keys):
+        with self._lock:
+            pending = self._pending.get(topic, set())
+            if pending is None:
+                return
+            if keys is None or (
+                len(pending) + len(keys) > MAX_KEYS_PER_TOPIC
+                and topic not in self._never_clear
+            ):
+                self._pending[topic] = None
+            else:
+                pending.update(_hashable(k) for k in keys)
+                self._pending[topic] = pending
+
+    def _flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        try:
+            self._send(
+                {
+                    "o": self.origin,
+                    "b": {
+                        topic: None if keys is None else list(keys)
+                        for topic, keys in batch.items()
+                    },
+                }
+            )
+        except Exception:
+            for topic, keys in batch.items():
+                self._queue(topic, keys)
+            raise
+
+    def _receive_message(self, message: dict):
+        if message.get("o") == self.origin:
+            return
+        for topic, keys in message.get("b", {}).items():
+            self._apply(topic, keys)
+
+    def _run(self):
+        backoff = self.batch_interval
+        while not self._stopped.is_set():
+            if not self._connected():
+                try:
+                    self._connect()
+                except Exception:
+                    logger.warning("Invalidation bus connect failed", exc_info=True)
+                    self._stopped.wait(backoff)
+                    backoff = min(backoff * 2, 30.0)
+                    continue
+                backoff = self.batch_interval
+                self._clear_all()
+                self._set_degraded(False)
+
+            try:
+                self._flush()
+                for message in self._receive(self.batch_interval):
+                    self._receive_message(message)
+            except Exception:
+                logger.warning("Invalidation bus connection lost", exc_info=True)
+                self._disconnect()
+                self._set_degraded(True)
+
+    @abstractmethod
+    def _connected(self) -> bool:
+        """Whether the backend connection is open."""
+
+    @abstractmethod
+    def _connect(self):
+        """Open the backend connection; raises when it is unreachable."""
+
+    @abstractmethod
+    def _disconnect(self):
+        """Close the backend connection, if open."""
+
+    @abstractmethod
+    def _send(self, message: dict):
+        """Deliver `message` to the other workers."""
+
+    @abstractmethod
+    def _receive(self, timeout: float) -> list:
+        """Wait up to `timeout` seconds and return the messages received."""
+
+
+class FileInvalidationBus(BackendInvalidationBus):
+    """
+    Shares invalidations through an append-only JSON-lines file.
+    Meant for tests and several workers on one machine.
+    """
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._file = None
+        self._offset = 0
+
+    def _connected(self) -> bool:
+        return self._file is not None
+
+    def _connect(self):
+        self._file = open(self.path, "a+b")
+        self._offset = self._file.seek(0, os.SEEK_END)
+
+    def _disconnect(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _send(self, message: dict):
+        # A single O_APPEND write keeps lines from different workers intact.
+        os.write(self._file.fileno(), json.dumps(message).encode() + b"\n")
+
+    def _receive(self, timeout: float) -> list:
+        self._stopped.wait(timeout)
+        size = os.fstat(self._file.fileno()).st_size
+        if size < self._offset:
+            # The file was truncated; whatever was in it is lost to us.
+            self._offset = 0
+            self._clear_all()
+        if size == self._offset:
+            return []
+
+        self._file.seek(self._offset)
+        data = self._file.read(size - self._offset)
+        end = data.rfind(b"\n") + 1
+        self._offset += end
+        return [json.loads(line) for line in data[:end].splitlines() if line]
+
+
+class PostgresInvalidationBus(BackendInvalidationBus):
+    """Shares invalidations through PostgreSQL LISTEN/NOTIFY."""
+
+    def __init__(self, database_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.dsn = (
+            make_url(database_url)
+            .set(drivername="postgresql")
+            .render_as_string(hide_password=False)
+        )
+        self._conn = None
+
+    def _connected(self) -> bool:
+        return self._conn is not None and not self._conn.closed
+
+    def _connect(self):
+        import psycopg2
+
+        self._conn = psycopg2.connect(self.dsn)
+        self._conn.autocommit = True
+        with self._conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {POSTGRES_CHANNEL}")
+
+    def _disconnect(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _send(self, message: dict):
+        with self._conn.cursor() as cursor:
+            for payload in self._payloads(message):
+                cursor.execute("SELECT pg_notify(%s, %s)", (POSTGRES_CHANNEL, payload))
+
+    def _payloads(self, message: dict):
+        payload = json.dumps(message)
+        if len(payload) <= POSTGRES_MAX_PAYLOAD:
+            yield payload
+            return
+        for topic, keys in message["b"].items():
+            if topic in self._never_clear and keys is not None:
+                yield from self._split(message["o"], topic, keys)
+                continue
+            payload = json.dumps({"o": message["o"], "b": {topic: keys}})
+            if len(payload) > POSTGRES_MAX_PAYLOAD:
+                payload = json.dumps({"o": message["o"], "b": {topic: None}})
+            yield payload
+
+    def _split(self, origin: str, topic: str, keys: list):
+        payload = json.dumps({"o": origin, "b": {topic: keys}})
+        if len(payload) <= POSTGRES_MAX_PAYLOAD or len(keys) == 1:
+            yield payload
+            return
+        middle = len(keys) // 2
+        yield from self._split(origin, topic, keys[:middle])
+        yield from self._split(origin, topic, keys[middle:])
+
+    def _receive(self, timeout: float) -> list:
+        select.select([self._conn], [], [], timeout)
+        self._conn.poll()
+        messages = []
+        while self._conn.notifies:
+            notify = self._conn.notifies.pop(0)
+            messages.append(json.loads(notify.payload))
+        return messages
+
+
+def create_bus() -> InvalidationBus:
+    options = {
+        "batch_interval": settings.INVALIDATION_BATCH_SECONDS,
+        "fallback_ttl": settings.INVALIDATION_FALLBACK_TTL,
+    }
+    if settings.INVALIDATION_BACKEND == "postgres":
+        return PostgresInvalidationBus(settings.DATABASE_URL, **options)
+    if settings.INVALIDATION_BACKEND == "file":
+        return FileInvalidationBus(settings.INVALIDATION_FILE, **options)
+    return InvalidationBus(**options)
+
+
+bus = create_bus()
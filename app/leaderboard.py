@@ -0,0 +1,340 @@
+import heapq
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, sessionmaker
+from app.config import settings
+from app.database import SessionLocal
+from app.models import Product, ProductSales, Receipt, receipt_product
+from app.revocation import utcnow
+
+logger = logging.getLogger(__name__)
+
+WINDOWS = ("hour", "day", "all")
+# `started_at` of the all-time window.
+ALL_TIME = datetime(1970, 1, 1)
+# Largest `k` served; rankings are kept sorted up to this length.
+TOP_LIMIT = 100
+
+
+def window_start(window: str, at: datetime) -> datetime:
+    if window == "hour":
+        return at.replace(minute=0, second=0, microsecond=0)
+    if window == "day":
+        return at.replace(hour=0, minute=0, second=0, microsecond=0)
+    return ALL_TIME
+
+
+def naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+class SpaceSaving:
+    """
+    Space-saving top-k sketch with at most `capacity` counters.
+
+    A product that is not tracked while the sketch is full takes the place of
+    the one with the smallest count and starts from that count, so counts are
+    overestimated by at most the smallest count, and every product that sold
+    more than 1/capacity of all units is tracked.
+    """
+
+    def __init__(self, started_at: datetime, capacity: int):
+        self.started_at = started_at
+        self.capacity = capacity
+        # (name, price) -> [quantity, revenue]
+        self.counters = {}
+        # (quantity, key) entries; outdated ones are skipped when popped.
+        self._heap = []
+        self._ranking = None
+
+    def add(self, key: tuple, quantity: int, revenue: float):
+        counter = self.counters.get(key)
+        if counter is None:
+            floor = self._evict_smallest() if len(self.counters) >= self.capacity else 0
+            counter = self.counters[key] = [floor, 0.0]
+        counter[0] += quantity
+        counter[1] += revenue
+        heapq.heappush(self._heap, (counter[0], key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(c[0], k) for k, c in self.counters.items()]
+            heapq.heapify(self._heap)
+        self._ranking = None
+
+    def _evict_smallest(self) -> int:
+        while True:
+            quantity, key = heapq.heappop(self._heap)
+            counter = self.counters.get(key)
+            if counter is not None and counter[0] == quantity:
+                del self.counters[key]
+                return quantity
+
+    def top(self, k: int) -> List[tuple]:
+        """Return up to `k` `(name, price, quantity, revenue)`, best first."""
+        if self._ranking is None:
+            self._ranking = [
+                (key[0], key[1], counter[0], counter[1])
+                for key, counter in heapq.nlargest(
+                    TOP_LIMIT,
+                    self.counters.items(),
+                    key=lambda item: (item[1][0], item[1][1]),
+                )
+            ]
+        return self._ranking[:k]
+
+
+class Leaderboard:
+    """
+    Best-selling products of the current UTC hour, the current UTC day and all
+    time.
+
+    Products are counted by `(name, price)`, which identifies them on every
+    shard. Each window keeps a `SpaceSaving` sketch in memory, so reading the
+    ranking never touches the database. Sales are also collected as deltas that
+    a background thread adds to `product_sales` every `flush_interval` seconds;
+    after each flush the sketches are reloaded from the table, which replaces
+    their estimates with exact counts and brings in the sales made by other
+    workers.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        flush_interval: float,
+        retention_days: int,
+        session_factory: sessionmaker = SessionLocal,
+    ):
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self.session_factory = session_factory
+        self._sketches = {}
+        # (window, started_at, name, price) -> [quantity, revenue] not yet flushed
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def record(self, created_at: datetime, items: List[tuple]):
+        """Count the `(name, price, quantity)` items of a receipt."""
+        at = naive_utc(created_at)
+        oldest = self._oldest_kept()
+        with self._lock:
+            for window in WINDOWS:
+                started_at = window_start(window, at)
+                if window != "all" and started_at < oldest:
+                    continue
+                sketch = self._sketch(window)
+                for name, price, quantity in items:
+                    revenue = price * quantity
+                    delta = self._pending.setdefault(
+                        (window, started_at, name, price), [0, 0.0]
+                    )
+                    delta[0] += quantity
+                    delta[1] += revenue
+                    if started_at == sketch.started_at:
+                        sketch.add((name, price), quantity, revenue)
+
+    def top(self, window: str, k: int) -> dict:
+        with self._lock:
+            sketch = self._sketch(window)
+            products = sketch.top(k)
+        return {
+            "window": window,
+            "since": None if window == "all" else sketch.started_at,
+            "products": [
+                {"name": name, "price": price, "quantity": quantity, "revenue": revenue}
+                for name, price, quantity, revenue in products
+            ],
+        }
+
+    def _sketch(self, window: str) -> SpaceSaving:
+        """The sketch of the window's current period; call with the lock held."""
+        started_at = window_start(window, utcnow())
+        sketch = self._sketches.get(window)
+        if sketch is None or sketch.started_at != started_at:
+            sketch = self._sketches[window] = SpaceSaving(started_at, self.capacity)
+        return sketch
+
+    def _oldest_kept(self) -> datetime:
+        return window_start("day", utcnow()) - timedelta(days=self.retention_days)
+
+    def flush(self):
+        """Write pending sales to `product_sales` and reload the sketches."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        db = self.session_factory()
+        try:
+            try:
+                if pending:
+                    write_sales(db, pending)
+                db.execute(
+                    delete(ProductSales).where(
+                        ProductSales.period.in_(("hour", "day")),
+                        ProductSales.started_at < self._oldest_kept(),
+                    )
+                )
+                db.commit()
+            except Exception:
+                db.rollback()
+                with self._lock:
+                    merge_sales(self._pending, pending)
+                raise
+            self.load(db)
+        finally:
+            db.close()
+
+    def load(self, db: Session):
+        now = utcnow()
+        loaded = {
+            window: db.execute(
+                select(
+                    ProductSales.name,
+                    ProductSales.price,
+                    ProductSales.quantity,
+                    ProductSales.revenue,
+                )
+                .where(
+                    ProductSales.period == window,
+                    ProductSales.started_at == window_start(window, now),
+                )
+                .order_by(ProductSales.quantity.desc())
+                .limit(self.capacity)
+            ).all()
+            for window in WINDOWS
+        }
+        with self._lock:
+            for window, rows in loaded.items():
+                sketch = SpaceSaving(window_start(window, now), self.capacity)
+                for name, price, quantity, revenue in rows:
+                    sketch.add((name, price), quantity, revenue)
+                # Sales recorded since the flush are not in the table yet.
+                for (period, started_at, name, price), delta in self._pending.items():
+                    if period == window and started_at == sketch.started_at:
+                        sketch.add((name, price), *delta)
+                self._sketches[window] = sketch
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="leaderboard", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+            self._flush_logged()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._flush_logged()
+            self._stopped.wait(self.flush_interval)
+
+    def _flush_logged(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.warning("Leaderboard flush failed", exc_info=True)
+
+    def clear(self):
+        with self._lock:
+            self._sketches.clear()
+            self._pending.clear()
+
+
+def merge_sales(into: dict, sales: dict):
+    for key, (quantity, revenue) in sales.items():
+        delta = into.setdefault(key, [0, 0.0])
+        delta[0] += quantity
+        delta[1] += revenue
+
+
+def write_sales(db: Session, sales: dict):
+    """Add `(window, started_at, name, price) -> [quantity, revenue]` to the table."""
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    table = ProductSales.__table__
+    statement = dialect.insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=["period", "started_at", "name", "price"],
+        set_={
+            "quantity": table.c.quantity + statement.excluded.quantity,
+            "revenue": table.c.revenue + statement.excluded.revenue,
+        },
+    )
+    db.execute(
+        statement,
+        [
+            {
+                "period": window,
+                "started_at": started_at,
+                "name": name,
+                "price": price,
+                "quantity": quantity,
+                "revenue": revenue,
+            }
+            # Sorted so concurrent flushes lock rows in the same order.
+            for (window, started_at, name, price), (quantity, revenue) in sorted(
+                sales.items()
+            )
+        ],
+    )
+
+
+def rebuild_sales(sessions: List[Session], now: Optional[datetime] = None) -> int:
+    """
+    Recount the current windows of `product_sales` from the receipts on every
+    shard; the first session is the primary database, which holds the table.
+    Archived receipts are not counted. Returns the number of rows written.
+    """
+    now = now or utcnow()
+    sales = {}
+    for window in WINDOWS:
+        started_at = window_start(window, now)
+        for db in sessions:
+            query = (
+                select(
+                    Product.name,
+                    Product.price,
+                    func.sum(receipt_product.c.quantity),
+                    func.sum(receipt_product.c.quantity * Product.price),
+                )
+                .join(receipt_product, receipt_product.c.product_id == Product.id)
+                .group_by(Product.name, Product.price)
+            )
+            if window != "all":
+                query = query.join(
+                    Receipt, Receipt.id == receipt_product.c.receipt_id
+                ).where(Receipt.created_at >= started_at)
+            for name, price, quantity, revenue in db.execute(query):
+                merge_sales(
+                    sales, {(window, started_at, name, price): (quantity, revenue)}
+                )
+
+    primary = sessions[0]
+    for window in WINDOWS:
+        primary.execute(
+            delete(ProductSales).where(
+                ProductSales.period == window,
+                ProductSales.started_at == window_start(window, now),
+            )
+        )
+    if sales:
+        write_sales(primary, sales)
+    primary.commit()
+    return len(sales)
+
+
+leaderboard = Leaderboard(
+    capacity=settings.LEADERBOARD_CAPACITY,
+    flush_interval=settings.LEADERBOARD_FLUSH_SECONDS,
+    retention_days=settings.LEADERBOARD_RETENTION_DAYS,
+)
@@ -1,6 +1,29 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 
-from app.routers import users, receipts
+from app.capture import TrafficCapture, capture_log
+from app.config import settings
+from app.invalidation import bus
+from app.leaderboard import leaderboard
+from app.provisioning import shutdown_hash_pool
+from app.suggestions import product_index
+from app.routers import users, receipts, imports, products, profiles, changes
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    bus.start()
+    leaderboard.start()
+    product_index.start()
+    if settings.CAPTURE_FILE:
+        capture_log.start()
+    yield
+    capture_log.stop()
+    product_index.stop()
+    leaderboard.stop()
+    bus.stop()
+    shutdown_hash_pool()
+
 
 app = FastAPI(
     title="Receipt API",
@@ -10,10 +33,18 @@ app = FastAPI(
         "name": "Oleksandr Chaban",
         "email": "toer1xe@gmail.com",
     },
+    lifespan=lifespan,
 )
 
+if settings.CAPTURE_FILE:
+    app.add_middleware(TrafficCapture, log=capture_log)
+
 app.include_router(users.router, prefix="/users", tags=["users"])
+app.include_router(imports.router, prefix="/receipts/imports", tags=["receipts"])
 app.include_router(receipts.router, prefix="/receipts", tags=["receipts"])
+app.include_router(products.router, prefix="/products", tags=["products"])
+app.include_router(profiles.router, prefix="/profiles", tags=["profiles"])
+app.include_router(changes.router, prefix="/changes", tags=["changes"])
 
 
 @app.get("/")
@@ -1,4 +1,15 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Table
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Integer,
+    String,
+    Float,
+    DateTime,
+    ForeignKey,
+    Index,
+    Table,
+    Text,
+)
 from sqlalchemy.orm import relationship
 from datetime import datetime, timezone
 from app.database import Base
@@ -12,12 +23,15 @@ class User(Base):
     hashed_password = Column(String, nullable=False)
     name = Column(String, nullable=False)
     surname = Column(String, nullable=False)
+    receipt_count = Column(Integer, nullable=False, default=0, server_default="0")
+    shard = Column(Integer, nullable=False, default=0, server_default="0")
 
     receipts = relationship("Receipt", back_populates="owner")
 
 
 class Product(Base):
     __tablename__ = "products"
+    __table_args__ = (Index("ix_products_name_price", "name", "price"),)
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
@@ -30,6 +44,10 @@ class Product(Base):
 
 class Receipt(Base):
     __tablename__ = "receipts"
+    __table_args__ = (
+        Index("ix_receipts_user_id_created_at", "user_id", "created_at"),
+        Index("ix_receipts_created_at", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     total = Column(Float, nullable=False)
@@ -44,10 +62,135 @@ class Receipt(Base):
     )
 
 
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+
+    jti = Column(String, primary_key=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    revoked_at = Column(DateTime, nullable=False, index=True)
+
+
+class ImportJob(Base):
+    __tablename__ = "import_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    status = Column(String, nullable=False, default="created")
+    # Line number up to which the upload has been processed and committed.
+    lines_committed = Column(Integer, nullable=False, default=0)
+    receipts_imported = Column(Integer, nullable=False, default=0)
+    error_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class ImportJobError(Base):
+    __tablename__ = "import_job_errors"
+
+    job_id = Column(Integer, ForeignKey("import_jobs.id"), primary_key=True)
+    line = Column(Integer, primary_key=True)
+    detail = Column(String, nullable=False)
+
+
+class ReceiptForward(Base):
+    """Public id of a receipt moved to another shard -> its new public id."""
+
+    __tablename__ = "receipt_forwards"
+
+    old_id = Column(BigInteger, primary_key=True)
+    new_id = Column(BigInteger, nullable=False, index=True)
+
+
+class ImportJobForward(Base):
+    """Public id of an import job moved to another shard -> its new public id."""
+
+    __tablename__ = "import_job_forwards"
+
+    old_id = Column(BigInteger, primary_key=True)
+    new_id = Column(BigInteger, nullable=False, index=True)
+
+
+class ProductSales(Base):
+    """Units sold and revenue per product in one leaderboard window."""
+
+    __tablename__ = "product_sales"
+    __table_args__ = (
+        Index("ix_product_sales_ranking", "period", "started_at", "quantity"),
+    )
+
+    # "hour", "day" or "all"; `started_at` is the start of the hour or day.
+    period = Column(String, primary_key=True)
+    started_at = Column(DateTime, primary_key=True)
+    name = Column(String, primary_key=True)
+    price = Column(Float, primary_key=True)
+    quantity = Column(BigInteger, nullable=False)
+    revenue = Column(Float, nullable=False)
+
+
+class PurgeCheckpoint(Base):
+    """Progress of the retention purge on one database."""
+
+    __tablename__ = "purge_checkpoints"
+
+    name = Column(String, primary_key=True)
+    # Sort key of the last receipt deleted; null when the next run starts over.
+    after_created_at = Column(DateTime, nullable=True)
+    after_id = Column(Integer, nullable=True)
+    receipts_deleted = Column(BigInteger, nullable=False, default=0)
+    products_deleted = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class ReceiptChange(Base):
+    """
+    One entry of the receipt change log (outbox), written in the transaction
+    that changed the receipt. Offsets only grow, also across compactions.
+    """
+
+    __tablename__ = "receipt_changes"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    offset = Column(
+        BigInteger().with_variant(Integer, "sqlite"),
+        primary_key=True,
+        autoincrement=True,
+    )
+    # "created" or "deleted"
+    kind = Column(String, nullable=False)
+    # Public receipt id
+    receipt_id = Column(BigInteger, nullable=False)
+    user_id = Column(Integer, nullable=False)
+    changed_at = Column(DateTime, nullable=False)
+    # The receipt as ReceiptOut JSON; null for deletions.
+    payload = Column(Text, nullable=True)
+
+
+class ChangeConsumer(Base):
+    """Offset up to which a consumer has processed the change log."""
+
+    __tablename__ = "change_consumers"
+
+    name = Column(String, primary_key=True)
+    offset = Column(BigInteger, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class ChangeCompaction(Base):
+    """Offset up to which the change log has been compacted."""
+
+    __tablename__ = "change_compactions"
+
+    name = Column(String, primary_key=True)
+    offset = Column(BigInteger, nullable=False)
+    changes_deleted = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False)
+
+
 receipt_product = Table(
     "receipt_product",
     Base.metadata,
     Column("receipt_id", Integer, ForeignKey("receipts.id"), primary_key=True),
     Column("product_id", Integer, ForeignKey("products.id"), primary_key=True),
     Column("quantity", Integer, nullable=False),
+    Index("ix_receipt_product_product_id", "product_id"),
 )
@@ -0,0 +1,83 @@
+import itertools
+from typing import Literal, Optional, Tuple
+from sqlalchemy.orm import Query, Session
+from app.archive import archive
+from app.cache import TTLCache
+from app.config import settings
+from app.invalidation import bus
+from app.models import User
+
+CountMode = Literal["exact", "estimate"]
+
+# (user_id, version, filter key) -> count. A user's version is dropped from
+# `receipt_count_versions` whenever their receipts change, which makes all of
+# their cached counts unreachable; they age out of the LRU.
+receipt_count_cache = TTLCache(ttl=settings.RECEIPT_COUNT_CACHE_TTL)
+# user_id -> version, published on the "receipt_counts" topic.
+receipt_count_versions = TTLCache(ttl=settings.RECEIPT_COUNT_CACHE_TTL)
+bus.subscribe("receipt_counts", receipt_count_versions)
+_versions = itertools.count()
+
+
+def count_version(user_id: int) -> int:
+    version = receipt_count_versions.get(user_id)
+    if version is None:
+        version = next(_versions)
+        receipt_count_versions.set(user_id, version)
+    return version
+
+
+def count_receipts(
+    db: Session, user_id: int, query: Query, filters: tuple, mode: CountMode
+) -> Tuple[int, str]:
+    """
+    Return `(total, mode)` for a filtered `list_receipts` query.
+
+    Unfiltered totals come from the maintained `users.receipt_count` counter,
+    which keeps counting receipts moved to the archive. Filtered totals are
+    served from a short-lived per-user cache, or from the planner's row estimate
+    in `estimate` mode when the result set is large; archived matches are
+    counted from the archive's user index.
+    """
+    if not any(filters):
+        total = db.query(User.receipt_count).filter(User.id == user_id).scalar()
+        return total or 0, "exact"
+
+    if mode == "estimate":
+        estimate = estimate_rows(db, query)
+        if (
+            estimate is not None
+            and estimate >= settings.RECEIPT_COUNT_ESTIMATE_THRESHOLD
+        ):
+            archived = len(archive.find_user_receipts(user_id, *filters))
+            return estimate + archived, "estimate"
+
+    key = (user_id, count_version(user_id), filters)
+    total = receipt_count_cache.get(key)
+    if total is None:
+        total = query.order_by(None).count()
+        total += len(archive.find_user_receipts(user_id, *filters))
+        receipt_count_cache.set(key, total)
+    return total, "exact"
+
+
+def estimate_rows(db: Session, query: Query) -> Optional[int]:
+    """
+    Ask the query planner how many rows `query` will return.
+    Only PostgreSQL keeps the statistics needed for this; other backends return None.
+    """
+    dialect = db.get_bind().dialect
+    if dialect.name != "postgresql":
+        return None
+
+    compiled = query.order_by(None).statement.compile(dialect=dialect)
+    plan = (
+        db.connection()
+        .exec_driver_sql("EXPLAIN (FORMAT JSON) " + str(compiled), compiled.params)
+        .scalar()
+    )
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def invalidate_receipt_counts(user_id: int):
+    bus.publish("receipt_counts", user_id)
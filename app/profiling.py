@@ -0,0 +1,348 @@
+import asyncio
+import contextvars
+import cProfile
+import functools
+import hashlib
+import hmac
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import types
+import uuid
+from collections import Counter, defaultdict
+from typing import List, Optional
+from fastapi import HTTPException
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from app.config import settings
+from app.revocation import utcnow
+
+PROFILE_HEADER = "X-Profile-Token"
+PROFILE_ID_HEADER = "X-Profile-Id"
+FORMATS = {"pstats": ".pstats", "collapsed": ".collapsed"}
+# Paths whose share of the request is smaller are left out of collapsed stacks.
+MIN_STACK_SHARE = 0.0005
+MAX_STACK_DEPTH = 96
+PROFILE_ID = re.compile(r"^[0-9]{20}-[0-9a-f]{8}$")
+
+# The request profile being taken in this context; copied into the worker
+# threads FastAPI runs sync endpoints and dependencies in.
+current_profile = contextvars.ContextVar("current_profile", default=None)
+_profiling_thread = threading.local()
+
+
+def profile_token_digest(expires: int) -> str:
+    return hmac.new(
+        settings.SECRET_KEY.encode(), f"profile:{expires}".encode(), hashlib.sha256
+    ).hexdigest()
+
+
+def create_profile_token(seconds: int) -> str:
+    """A `X-Profile-Token` value that is accepted for `seconds` seconds."""
+    expires = int(time.time()) + seconds
+    return f"{expires}.{profile_token_digest(expires)}"
+
+
+def verify_profile_token(token: Optional[str]) -> bool:
+    if not token:
+        return False
+    expires, _, digest = token.partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(digest, profile_token_digest(int(expires)))
+
+
+def profile_trigger(request: Request) -> Optional[str]:
+    """Why the request should be profiled, or None for almost all requests."""
+    token = request.headers.get(PROFILE_HEADER)
+    if token is not None and verify_profile_token(token):
+        return "token"
+    rate = settings.PROFILE_SAMPLE_RATE
+    if rate and random.random() < rate:
+        return "sample"
+    return None
+
+
+def require_profile_token(request: Request):
+    if not verify_profile_token(request.headers.get(PROFILE_HEADER)):
+        raise HTTPException(status_code=403, detail="Invalid profile token")
+
+
+class RequestProfile:
+    """
+    The profilers of one request. cProfile only sees the thread it is enabled
+    in, so every thread the request runs code in gets its own profiler, and
+    their statistics are merged at the end.
+    """
+
+    def __init__(self):
+        self.loop_profile = cProfile.Profile()
+        self._profiles = [self.loop_profile]
+        self._lock = threading.Lock()
+
+    def thread_profile(self) -> cProfile.Profile:
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        return profile
+
+    def stats(self) -> pstats.Stats:
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+def profiled(func):
+    """
+    Include calls of the sync function `func` in the current request's profile,
+    if one is being taken, when FastAPI runs it in a worker thread.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        request_profile = current_profile.get()
+        if request_profile is None or getattr(_profiling_thread, "active", False):
+            return func(*args, **kwargs)
+        profile = request_profile.thread_profile()
+        _profiling_thread.active = True
+        profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            _profiling_thread.active = False
+
+    wrapper.__profiled__ = True
+    return wrapper
+
+
+@types.coroutine
+def _run_profiled(coroutine, profile: cProfile.Profile):
+    """
+    Await `coroutine` with `profile` enabled only while the coroutine itself
+    runs, so the other requests the event loop serves in between are left out.
+    """
+    value, error = None, None
+    while True:
+        _profiling_thread.active = True
+        profile.enable()
+        try:
+            if error is not None:
+                step = coroutine.throw(error)
+            else:
+                step = coroutine.send(value)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            profile.disable()
+            _profiling_thread.active = False
+        try:
+            value, error = (yield step), None
+        except BaseException as exc:
+            value, error = None, exc
+
+
+def _frame_label(func) -> str:
+    filename, line, name = func
+    if filename == "~":
+        label = name
+    else:
+        for prefix in ("site-packages" + os.sep, os.getcwd() + os.sep):
+            index = filename.rfind(prefix)
+            if index >= 0:
+                filename = filename[index + len(prefix) :]
+                break
+        label = f"{name} ({filename}:{line})"
+    return label.replace(";", ",")
+
+
+def collapsed_stacks(stats: pstats.Stats) -> str:
+    """
+    Render `stats` in the collapsed-stack format read by flamegraph.pl and
+    speedscope: one `frame;frame;frame microseconds` line per call path.
+
+    cProfile only records caller-callee pairs, so a function's time is split
+    over its callers in proportion to the time each call edge took.
+    """
+    entries = stats.stats
+    callees = defaultdict(list)
+    for func, (_, _, _, _, callers) in entries.items():
+        for caller, edge in callers.items():
+            callees[caller].append((func, edge[3]))
+    roots = [func for func, entry in entries.items() if not entry[4]]
+    total = sum(entries[func][3] for func in roots) or 1.0
+    stacks = Counter()
+
+    def walk(func, path, on_path, seconds):
+        _, _, own, cumulative, _ = entries[func]
+        share = seconds / cumulative if cumulative else 0.0
+        self_seconds = own * share
+        if len(path) < MAX_STACK_DEPTH:
+            for callee, edge_seconds in callees.get(func, ()):
+                child_seconds = edge_seconds * share
+                # Recursive calls are already counted in the outer call.
+                if callee in on_path or child_seconds < total * MIN_STACK_SHARE:
+                    continue
+                path.append(_frame_label(callee))
+                on_path.add(callee)
+                walk(callee, path, on_path, child_seconds)
+                on_path.discard(callee)
+                path.pop()
+        stacks[";".join(path)] += self_seconds
+
+    for root in roots:
+        walk(root, [_frame_label(root)], {root}, entries[root][3])
+    lines = []
+    for stack, seconds in stacks.items():
+        microseconds = round(seconds * 1e6)
+        if microseconds > 0:
+            lines.append(f"{stack} {microseconds}\n")
+    return "".join(sorted(lines))
+
+
+class ProfileStore:
+    """
+    The newest `max_profiles` request profiles in `directory`, each a
+    `.pstats` file, a `.collapsed` file and a `.json` summary. Saving one more
+    deletes the oldest, so the directory works as a ring buffer; its size is
+    bounded by the number of profiles rather than by time.
+    """
+
+    def __init__(self, directory: str, max_profiles: int):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self._lock = threading.Lock()
+
+    def save(self, summary: dict, stats: pstats.Stats) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        profile_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        summary = {"id": profile_id, **summary}
+        base = os.path.join(self.directory, profile_id)
+        stats.dump_stats(base + ".pstats.tmp")
+        with open(base + ".collapsed.tmp", "w") as f:
+            f.write(collapsed_stacks(stats))
+        with open(base + ".json.tmp", "w") as f:
+            json.dump(summary, f)
+        # The summary is renamed last: listed profiles are complete.
+        for suffix in (".pstats", ".collapsed", ".json"):
+            os.replace(base + suffix + ".tmp", base + suffix)
+        self.prune()
+        return profile_id
+
+    def ids(self) -> List[str]:
+        """Stored profile ids, oldest first."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(
+            name[: -len(".json")]
+            for name in names
+            if name.endswith(".json") and PROFILE_ID.match(name[: -len(".json")])
+        )
+
+    def prune(self):
+        with self._lock:
+            ids = self.ids()
+            for profile_id in ids[: max(0, len(ids) - self.max_profiles)]:
+                for suffix in (".json", ".pstats", ".collapsed"):
+                    try:
+                        os.remove(os.path.join(self.directory, profile_id + suffix))
+                    except FileNotFoundError:
+                        pass
+
+    def list(self) -> List[dict]:
+        """Summaries of the stored profiles, newest first."""
+        summaries = []
+        for profile_id in reversed(self.ids()):
+            try:
+                with open(os.path.join(self.directory, profile_id + ".json")) as f:
+                    summaries.append(json.load(f))
+            except FileNotFoundError:
+                pass  # Pruned meanwhile.
+        return summaries
+
+    def path(self, profile_id: str, format: str) -> Optional[str]:
+        if not PROFILE_ID.match(profile_id) or format not in FORMATS:
+            return None
+        path = os.path.join(self.directory, profile_id + FORMATS[format])
+        return path if os.path.exists(path) else None
+
+
+profile_store = ProfileStore(settings.PROFILE_DIR, settings.PROFILE_MAX_PROFILES)
+
+
+async def profile_request(handler, request: Request, trigger: str, route: str):
+    request_profile = RequestProfile()
+    token = current_profile.set(request_profile)
+    started = time.perf_counter()
+    status_code = 500
+    response = None
+    try:
+        response = await _run_profiled(handler(request), request_profile.loop_profile)
+        status_code = response.status_code
+        return response
+    except HTTPException as exc:
+        status_code = exc.status_code
+        raise
+    except RequestValidationError:
+        status_code = 422
+        raise
+    finally:
+        current_profile.reset(token)
+        summary = {
+            "method": request.method,
+            "route": route,
+            "path": request.url.path,
+            "status_code": status_code,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+            "trigger": trigger,
+            "created_at": utcnow().isoformat(),
+        }
+        profile_id = await run_in_threadpool(
+            profile_store.save, summary, request_profile.stats()
+        )
+        if response is not None:
+            response.headers[PROFILE_ID_HEADER] = profile_id
+
+
+class ProfiledRoute(APIRoute):
+    """
+    A route that profiles the requests carrying a valid `X-Profile-Token`
+    header, and a PROFILE_SAMPLE_RATE share of the others, with cProfile.
+
+    The profile covers the request's own work on the event loop (parsing,
+    validation, serialization, async endpoints) and its sync endpoint in the
+    worker thread; sync dependencies are included when decorated with
+    `profiled`. Other requests' work is not. Unprofiled requests only pay for
+    the header lookup.
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        # Routes are copied by `include_router`; wrap the endpoint only once.
+        if not asyncio.iscoroutinefunction(endpoint) and not hasattr(
+            endpoint, "__profiled__"
+        ):
+            endpoint = profiled(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        route = self.path
+
+        async def profiling_handler(request: Request):
+            trigger = profile_trigger(request)
+            if trigger is None:
+                return await handler(request)
+            return await profile_request(handler, request, trigger, route)
+
+        return profiling_handler
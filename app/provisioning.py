@@ -0,0 +1,147 @@
+import hmac
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+from fastapi import HTTPException, Request
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from app.auth import get_password_hash
+from app.changes import API_KEY_HEADER
+from app.config import settings
+from app.models import User
+from app.schemas import UserCreate
+from app.sharding import shard_router
+
+# Usernames checked per `IN (...)` query.
+LOOKUP_CHUNK_SIZE = 1000
+INSERT_ATTEMPTS = 3
+
+_hash_pool = None
+
+
+def require_provisioning_key(request: Request):
+    """Accept only requests with PROVISIONING_API_KEY in the X-API-Key header."""
+    api_key = request.headers.get(API_KEY_HEADER)
+    if not api_key:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    key = settings.PROVISIONING_API_KEY
+    if not key or not hmac.compare_digest(key.encode(), api_key.encode()):
+        raise HTTPException(status_code=403, detail="Invalid API key")
+
+
+def get_hash_pool() -> ProcessPoolExecutor:
+    global _hash_pool
+    if _hash_pool is None:
+        # spawn rather than fork: the server process runs several threads.
+        _hash_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count() or 1,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _hash_pool
+
+
+def shutdown_hash_pool():
+    global _hash_pool
+    if _hash_pool is not None:
+        _hash_pool.shutdown()
+        _hash_pool = None
+
+
+def hash_passwords(passwords: List[str]) -> List[str]:
+    workers = os.cpu_count() or 1
+    if len(passwords) < 2 or workers < 2:
+        return [get_password_hash(password) for password in passwords]
+    chunksize = max(1, len(passwords) // (workers * 4))
+    return list(get_hash_pool().map(get_password_hash, passwords, chunksize=chunksize))
+
+
+def existing_usernames(db: Session, usernames: List[str]) -> set:
+    existing = set()
+    for start in range(0, len(usernames), LOOKUP_CHUNK_SIZE):
+        chunk = usernames[start : start + LOOKUP_CHUNK_SIZE]
+        existing.update(
+            username
+            for (username,) in db.query(User.username).filter(User.username.in_(chunk))
+        )
+    return existing
+
+
+def register_users(db: Session, users: List[UserCreate]) -> List[dict]:
+    """
+    Register many users at once and return one result per input record, in order.
+
+    Passwords are hashed in parallel in a process pool and the users are written
+    with multi-row inserts in a single transaction. Usernames that already exist
+    or repeat within the request are reported instead of failing the batch.
+    """
+    results = [None] * len(users)
+    first_index = {}
+    for index, user in enumerate(users):
+        if user.username in first_index:
+            results[index] = {
+                "username": user.username,
+                "status": "duplicate",
+                "detail": "Username appears earlier in the request",
+            }
+        else:
+            first_index[user.username] = index
+
+    hashed = {}
+    for _ in range(INSERT_ATTEMPTS):
+        taken = existing_usernames(db, list(first_index))
+        for username in taken:
+            results[first_index.pop(username)] = {
+                "username": username,
+                "status": "conflict",
+                "detail": "Username already registered",
+            }
+        if not first_index:
+            return results
+
+        to_hash = [name for name in first_index if name not in hashed]
+        passwords = [users[first_index[name]].password for name in to_hash]
+        hashed.update(zip(to_hash, hash_passwords(passwords)))
+
+        rows = [
+            {
+                "username": username,
+                "hashed_password": hashed[username],
+                "name": users[index].name,
+                "surname": users[index].surname,
+            }
+            for username, index in first_index.items()
+        ]
+        try:
+            created = db.execute(
+                insert(User).returning(
+                    User.id, User.username, sort_by_parameter_order=True
+                ),
+                rows,
+            ).all()
+            placements = [
+                {"id": user_id, "shard": shard_router.shard_for(user_id)}
+                for user_id, _ in created
+            ]
+            placements = [p for p in placements if p["shard"]]
+            if placements:
+                db.execute(update(User), placements)
+            db.commit()
+        except IntegrityError:
+            # A concurrent registration took one of the names; look again.
+            db.rollback()
+            continue
+
+        for user_id, username in created:
+            results[first_index[username]] = {
+                "username": username,
+                "status": "created",
+                "id": user_id,
+            }
+        return results
+
+    raise HTTPException(
+        status_code=409,
+        detail="Could not register users due to concurrent registrations",
+    )
@@ -0,0 +1,246 @@
+import asyncio
+import gzip
+import json
+import time
+import zlib
+from collections import Counter, defaultdict
+from typing import Callable, Dict, Iterable, List, Optional
+from urllib.parse import parse_qsl, urlencode
+import httpx
+import numpy as np
+
+REPLAY_PASSWORD = "replay-password"
+# Access tokens last 30 minutes; log in again well before.
+TOKEN_MAX_AGE_SECONDS = 15 * 60
+PERCENTILES = (50, 90, 99)
+
+
+def read_capture(paths: Iterable[str]) -> List[dict]:
+    """
+    The records of one or more capture files (one per worker), ordered by
+    arrival. A file cut short by a crash is read up to its last whole line.
+    """
+    records = []
+    for path in paths:
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.endswith("\n"):
+                        records.append(json.loads(line))
+        except (EOFError, zlib.error):
+            pass
+    records.sort(key=lambda record: record["ts"])
+    return records
+
+
+def replayable(record: dict) -> bool:
+    """Streams and bodies that were not captured, like uploads, are skipped."""
+    if record.get("stream"):
+        return False
+    return not record.get("body_size") or "json" in record or "form" in record
+
+
+def route_key(record: dict) -> str:
+    return f"{record['method']} {record.get('route') or 'unmatched'}"
+
+
+class Replayer:
+    """
+    Re-issues captured requests with `client` on the captured schedule,
+    `speed` times faster (0 sends them as fast as possible), with at most
+    `concurrency` in flight. When all are busy, later requests wait and the
+    delay is reported as schedule lag.
+
+    Every captured user is registered on the target as its pseudonym with
+    REPLAY_PASSWORD. Ids of receipts created during the capture are mapped to
+    the ids their replayed creation returned.
+    """
+
+    def __init__(self, client: httpx.AsyncClient, speed: float, concurrency: int):
+        self.client = client
+        self.speed = speed
+        self.concurrency = concurrency
+        self.tokens: Dict[str, dict] = {}
+        self.receipt_ids: Dict[str, str] = {}
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.failures = Counter()
+        self.max_lag = 0.0
+
+    async def log_in(self, username: str) -> dict:
+        tokens = self.tokens.get(username)
+        if tokens is None or time.monotonic() - tokens["at"] > TOKEN_MAX_AGE_SECONDS:
+            response = await self.client.post(
+                "/users/login",
+                data={"username": username, "password": REPLAY_PASSWORD},
+            )
+            response.raise_for_status()
+            tokens = {**response.json(), "at": time.monotonic()}
+            self.tokens[username] = tokens
+        return tokens
+
+    async def prepare(self, records: List[dict]):
+        """Register and log in the captured users before the clock starts."""
+        users = {record["user"] for record in records if record.get("user")}
+        for username in sorted(users):
+            await self.client.post(
+                "/users/register",
+                json={
+                    "username": username,
+                    "password": REPLAY_PASSWORD,
+                    "name": "Replay",
+                    "surname": "User",
+                },
+            )
+            await self.log_in(username)
+
+    def fill(self, value, tokens: Optional[dict]):
+        if isinstance(value, list):
+            return [self.fill(item, tokens) for item in value]
+        if not isinstance(value, dict):
+            return value
+        result = {}
+        for key, item in value.items():
+            if key == "password":
+                item = REPLAY_PASSWORD
+            elif key in ("refresh_token", "access_token") and tokens is not None:
+                item = tokens[key]
+            result[key] = self.fill(item, tokens)
+        return result
+
+    async def build(self, record: dict) -> dict:
+        path = record["path"]
+        params = record.get("path_params", {})
+        if "receipt_id" in params and params["receipt_id"] in self.receipt_ids:
+            path = record["route"].format(
+                **{**params, "receipt_id": self.receipt_ids[params["receipt_id"]]}
+            )
+        tokens = await self.log_in(record["user"]) if record.get("user") else None
+        if record.get("query"):
+            params = dict(parse_qsl(record["query"], keep_blank_values=True))
+            path = f"{path}?{urlencode(self.fill(params, tokens))}"
+        request = {"method": record["method"], "url": path, "headers": {}}
+        if tokens is not None:
+            request["headers"]["Authorization"] = f"Bearer {tokens['access_token']}"
+        if "last_event_id" in record:
+            request["headers"]["Last-Event-ID"] = record["last_event_id"]
+        if "json" in record:
+            request["json"] = self.fill(record["json"], tokens)
+        elif "form" in record:
+            request["data"] = self.fill(record["form"], tokens)
+        return request
+
+    async def send(self, record: dict, slots: asyncio.Semaphore):
+        key = route_key(record)
+        try:
+            request = await self.build(record)
+            started = time.perf_counter()
+            response = await self.client.request(**request)
+            seconds = time.perf_counter() - started
+        except httpx.HTTPError as exc:
+            self.failures[key] += 1
+            self.statuses[key][type(exc).__name__] += 1
+            return
+        finally:
+            slots.release()
+        self.latencies[key].append(seconds)
+        self.statuses[key][str(response.status_code)] += 1
+        if response.status_code != 200 or record["method"] != "POST":
+            return
+        try:
+            body = response.json()
+        except ValueError:
+            return
+        if not isinstance(body, dict):
+            return
+        if "created_id" in record and isinstance(body.get("id"), int):
+            self.receipt_ids[str(record["created_id"])] = str(body["id"])
+        if record.get("user") and "refresh_token" in body:
+            # A replayed refresh revoked the user's previous refresh token.
+            self.tokens[record["user"]] = {**body, "at": time.monotonic()}
+
+    async def run(
+        self, records: List[dict], progress: Optional[Callable[[dict], None]] = None
+    ) -> dict:
+        records = [record for record in records if replayable(record)]
+        await self.prepare(records)
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        first = records[0]["ts"] if records else 0.0
+        started = time.monotonic()
+        for n, record in enumerate(records, 1):
+            if self.speed:
+                due = started + (record["ts"] - first) / self.speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await slots.acquire()
+            if self.speed:
+                self.max_lag = max(self.max_lag, time.monotonic() - due)
+            task = asyncio.create_task(self.send(record, slots))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            if progress and n % 1000 == 0:
+                progress({"sent": n, "seconds": round(time.monotonic() - started, 3)})
+        if tasks:
+            await asyncio.gather(*tasks)
+        return {"sent": len(records), "seconds": time.monotonic() - started}
+
+    def report(self, skipped: int, seconds: float) -> dict:
+        routes = {}
+        for key in sorted(set(self.latencies) | set(self.statuses)):
+            latencies = np.array(self.latencies.get(key, ())) * 1000
+            route = {
+                "count": sum(self.statuses[key].values()),
+                "statuses": dict(sorted(self.statuses[key].items())),
+                "failures": self.failures[key],
+            }
+            if len(latencies):
+                for p, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+                    route[f"p{p}_ms"] = round(float(value), 3)
+                route["max_ms"] = round(float(latencies.max()), 3)
+            routes[key] = route
+        sent = sum(route["count"] for route in routes.values())
+        return {
+            "requests": sent,
+            "skipped": skipped,
+            "seconds": round(seconds, 3),
+            "requests_per_second": round(sent / seconds, 1) if seconds else 0.0,
+            "speed": self.speed,
+            "concurrency": self.concurrency,
+            "max_lag_ms": round(self.max_lag * 1000, 3),
+            "routes": routes,
+        }
+
+
+def compare(report: dict, baseline: dict) -> dict:
+    """Add each route's latency percentiles relative to `baseline`'s."""
+    for key, route in report["routes"].items():
+        before = baseline.get("routes", {}).get(key)
+        if not before:
+            continue
+        for p in PERCENTILES:
+            name = f"p{p}_ms"
+            if before.get(name) and name in route:
+                route[f"p{p}_ratio"] = round(route[name] / before[name], 3)
+    return report
+
+
+async def replay(
+    records: List[dict],
+    base_url: str,
+    speed: float = 1.0,
+    concurrency: int = 32,
+    progress: Optional[Callable[[dict], None]] = None,
+    transport: Optional[httpx.AsyncBaseTransport] = None,
+    timeout: float = 30.0,
+) -> dict:
+    """Replay `records` against the API at `base_url` and report latencies."""
+    skipped = sum(1 for record in records if not replayable(record))
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url, transport=transport, limits=limits, timeout=timeout
+    ) as client:
+        replayer = Replayer(client, speed, concurrency)
+        result = await replayer.run(records, progress)
+    return replayer.report(skipped, result["seconds"])
@@ -0,0 +1,331 @@
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Callable, Optional
+from sqlalchemy import bindparam, delete, exists, func, select, tuple_
+from sqlalchemy.orm import Session
+from app.archive import Archive, purge_archive
+from app.changes import append_changes, deleted_change
+from app.config import settings
+from app.invalidation import bus
+from app.models import Product, PurgeCheckpoint, Receipt, User, receipt_product
+from app.revocation import utcnow
+from app.sharding import ShardRouter, global_receipt_id, split_receipt_id
+
+CHECKPOINT_NAME = "receipts"
+
+
+class Pacer:
+    """
+    Sizes purge batches by how long they take. A batch slower than
+    `target_seconds` halves the next one and a faster one grows it by a quarter,
+    between `min_batch` and `max_batch`. After each batch the purge pauses so it
+    only works `duty_cycle` of the time, leaving the database to live traffic
+    in between.
+    """
+
+    def __init__(
+        self,
+        max_batch: int,
+        min_batch: int,
+        target_seconds: float,
+        duty_cycle: float,
+    ):
+        self.max_batch = max_batch
+        self.min_batch = min(min_batch, max_batch)
+        self.target_seconds = target_seconds
+        self.duty_cycle = duty_cycle
+        self.batch = self.min_batch
+
+    def done(self, seconds: float) -> float:
+        """Record how long a batch took and return the pause before the next."""
+        if seconds > self.target_seconds:
+            self.batch = max(self.min_batch, self.batch // 2)
+        else:
+            self.batch = min(self.max_batch, self.batch + max(1, self.batch // 4))
+        return seconds * (1 - self.duty_cycle) / self.duty_cycle
+
+
+def default_pacer() -> Pacer:
+    return Pacer(
+        max_batch=settings.PURGE_BATCH_RECEIPTS,
+        min_batch=settings.PURGE_MIN_BATCH_RECEIPTS,
+        target_seconds=settings.PURGE_TARGET_BATCH_SECONDS,
+        duty_cycle=settings.PURGE_DUTY_CYCLE,
+    )
+
+
+def get_checkpoint(db: Session) -> PurgeCheckpoint:
+    checkpoint = db.get(PurgeCheckpoint, CHECKPOINT_NAME)
+    if checkpoint is None:
+        checkpoint = PurgeCheckpoint(
+            name=CHECKPOINT_NAME,
+            receipts_deleted=0,
+            products_deleted=0,
+            updated_at=utcnow(),
+        )
+        db.add(checkpoint)
+        db.commit()
+    return checkpoint
+
+
+def purge_batch(
+    db: Session, shard: int, checkpoint: PurgeCheckpoint, cutoff: datetime, limit: int
+) -> Optional[dict]:
+    """
+    Delete the next `limit` receipts created before `cutoff` in one
+    transaction and return what was deleted, or None when none are left.
+    """
+    query = select(Receipt.id, Receipt.user_id, Receipt.created_at).where(
+        Receipt.created_at < cutoff
+    )
+    if checkpoint.after_id is not None:
+        query = query.where(
+            tuple_(Receipt.created_at, Receipt.id)
+            > tuple_(checkpoint.after_created_at, checkpoint.after_id)
+        )
+    receipts = db.execute(
+        query.order_by(Receipt.created_at, Receipt.id).limit(limit)
+    ).all()
+    if not receipts:
+        # Start over next time: rows may since have been imported behind the
+        # checkpoint.
+        checkpoint.after_created_at = checkpoint.after_id = None
+        checkpoint.updated_at = utcnow()
+        db.commit()
+        return None
+
+    ids = [receipt.id for receipt in receipts]
+    product_ids = (
+        db.execute(
+            select(receipt_product.c.product_id)
+            .where(receipt_product.c.receipt_id.in_(ids))
+            .distinct()
+        )
+        .scalars()
+        .all()
+    )
+    line_items = db.execute(
+        delete(receipt_product).where(receipt_product.c.receipt_id.in_(ids))
+    ).rowcount
+    db.execute(Receipt.__table__.delete().where(Receipt.id.in_(ids)))
+
+    owners = Counter(receipt.user_id for receipt in receipts)
+    users = User.__table__
+    db.execute(
+        users.update()
+        .where(users.c.id == bindparam("b_user"))
+        .values(receipt_count=users.c.receipt_count - bindparam("b_count")),
+        [{"b_user": user_id, "b_count": n} for user_id, n in owners.items()],
+    )
+
+    # Only products the deleted receipts used can have become unreferenced.
+    # Products being put on a receipt right now are locked by the foreign key
+    # check and skipped; a receipt that looked up a product deleted here fails
+    # its foreign key and looks its products up again.
+    unreferenced = ~exists().where(receipt_product.c.product_id == Product.id)
+    products = db.execute(
+        select(Product.id, Product.name, Product.price)
+        .where(Product.id.in_(product_ids), unreferenced)
+        .with_for_update(skip_locked=True)
+    ).all()
+    products_deleted = 0
+    if products:
+        products_deleted = db.execute(
+            Product.__table__.delete().where(
+                Product.id.in_([product.id for product in products]), unreferenced
+            )
+        ).rowcount
+
+    last = receipts[-1]
+    checkpoint.after_created_at = last.created_at
+    checkpoint.after_id = last.id
+    checkpoint.receipts_deleted += len(ids)
+    checkpoint.products_deleted += products_deleted
+    checkpoint.updated_at = utcnow()
+    append_changes(
+        db,
+        [
+            deleted_change(global_receipt_id(shard, receipt.id), receipt.user_id)
+            for receipt in receipts
+        ],
+    )
+    db.commit()
+
+    user_ids = list(owners)
+    bus.publish("receipt_counts", *user_ids)
+    bus.publish("insights", *user_ids)
+    bus.publish("receipts", *(global_receipt_id(shard, i) for i in ids))
+    if products:
+        bus.publish("products", *((shard, p.name, p.price) for p in products))
+    return {
+        "receipts": len(ids),
+        "line_items": line_items,
+        "products": products_deleted,
+        "last_created_at": last.created_at,
+    }
+
+
+def lag_seconds(db: Session, cutoff: datetime) -> float:
+    """How long the oldest receipt has been past its retention period."""
+    oldest = db.execute(select(func.min(Receipt.created_at))).scalar()
+    if oldest is None or oldest >= cutoff:
+        return 0.0
+    return (cutoff - oldest).total_seconds()
+
+
+def count_expired(db: Session, cutoff: datetime) -> int:
+    return db.execute(
+        select(func.count()).select_from(Receipt).where(Receipt.created_at < cutoff)
+    ).scalar()
+
+
+def purge_receipts(
+    db: Session,
+    shard: int,
+    cutoff: datetime,
+    max_seconds: Optional[float] = None,
+    max_receipts: Optional[int] = None,
+    pacer: Optional[Pacer] = None,
+    progress: Optional[Callable[[dict], None]] = None,
+    sleep: Callable[[float], None] = time.sleep,
+) -> dict:
+    """
+    Delete the receipts created before `cutoff`, oldest first, with their line
+    items and the products no longer referenced afterwards, and return totals
+    and metrics.
+
+    Receipts are deleted in small batches ordered by `(created_at, id)`. Each
+    batch is one transaction that also decrements the owners' `receipt_count`
+    and stores the key of its last receipt in `purge_checkpoints`, so an
+    interrupted run resumes where it stopped without scanning the deleted rows
+    again. The run stops once `max_seconds` or `max_receipts` is used up;
+    `finished` tells whether it got through all expired receipts.
+    """
+    pacer = pacer or default_pacer()
+    started = time.monotonic()
+    checkpoint = get_checkpoint(db)
+    result = {
+        "shard": shard,
+        "receipts": 0,
+        "line_items": 0,
+        "products": 0,
+        "batches": 0,
+        "finished": False,
+    }
+
+    def remaining_seconds() -> float:
+        if max_seconds is None:
+            return float("inf")
+        return max_seconds - (time.monotonic() - started)
+
+    while remaining_seconds() > 0:
+        limit = pacer.batch
+        if max_receipts is not None:
+            limit = min(limit, max_receipts - result["receipts"])
+            if limit <= 0:
+                break
+
+        batch_started = time.monotonic()
+        deleted = purge_batch(db, shard, checkpoint, cutoff, limit)
+        seconds = time.monotonic() - batch_started
+        if deleted is None:
+            result["finished"] = True
+            break
+
+        result["batches"] += 1
+        for key in ("receipts", "line_items", "products"):
+            result[key] += deleted[key]
+        pause = pacer.done(seconds)
+        if progress:
+            elapsed = time.monotonic() - started
+            progress(
+                {
+                    "shard": shard,
+                    "receipts": result["receipts"],
+                    "batch_receipts": deleted["receipts"],
+                    "batch_seconds": round(seconds, 4),
+                    "next_batch": pacer.batch,
+                    "rows_per_second": round(
+                        (result["receipts"] + result["line_items"]) / elapsed, 1
+                    ),
+                    "lag_seconds": (
+                        cutoff - deleted["last_created_at"]
+                    ).total_seconds(),
+                }
+            )
+        sleep(max(0.0, min(pause, remaining_seconds())))
+
+    seconds = time.monotonic() - started
+    result["seconds"] = round(seconds, 3)
+    result["rows_per_second"] = round(
+        (result["receipts"] + result["line_items"]) / seconds if seconds else 0.0, 1
+    )
+    result["lag_seconds"] = lag_seconds(db, cutoff)
+    return result
+
+
+def purge_archived_receipts(
+    router: ShardRouter, archive: Archive, cutoff: datetime
+) -> dict:
+    """
+    Delete the archived receipts created before `cutoff` and return totals.
+
+    After each archive segment is purged, the owners' `receipt_count` is
+    decremented on the shard they are on now, and a `deleted` change is
+    logged on the shard each receipt was created on.
+    """
+    result = {"receipts": 0, "segments": 0}
+    for purged in purge_archive(archive, cutoff):
+        owners = Counter(user_id for user_id, _ in purged)
+        user_ids = list(owners)
+        primary = router.session(0)
+        try:
+            placement = {}
+            for start in range(0, len(user_ids), 1000):
+                placement.update(
+                    primary.execute(
+                        select(User.id, User.shard).where(
+                            User.id.in_(user_ids[start : start + 1000])
+                        )
+                    ).all()
+                )
+        finally:
+            primary.close()
+
+        changes = {}
+        for user_id, receipt_id in purged:
+            changes.setdefault(split_receipt_id(receipt_id)[0], []).append(
+                deleted_change(receipt_id, user_id)
+            )
+        counts = {}
+        for user_id, shard in placement.items():
+            counts.setdefault(shard, []).append(
+                {"b_user": user_id, "b_count": owners[user_id]}
+            )
+
+        users = User.__table__
+        for shard in sorted(
+            (counts.keys() | changes.keys()) & set(range(router.count))
+        ):
+            db = router.session(shard)
+            try:
+                if shard in counts:
+                    db.execute(
+                        users.update()
+                        .where(users.c.id == bindparam("b_user"))
+                        .values(
+                            receipt_count=users.c.receipt_count - bindparam("b_count")
+                        ),
+                        counts[shard],
+                    )
+                append_changes(db, changes.get(shard, []))
+                db.commit()
+            finally:
+                db.close()
+
+        bus.publish("receipt_counts", *user_ids)
+        bus.publish("receipts", *(receipt_id for _, receipt_id in purged))
+        result["receipts"] += len(purged)
+        result["segments"] += 1
+    return result
@@ -0,0 +1,142 @@
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.models import RevokedToken
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class BloomFilter:
+    """
+    Fixed-size set of strings that may report false positives but never false
+    negatives. Sized for `capacity` strings at `error_rate`.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+class RevocationList:
+    """
+    In-memory Bloom filter of revoked refresh-token ids.
+
+    Revocations are written to `revoked_tokens` by the request that revokes the
+    token, and the primary key on `jti` lets only one request revoke it, on any
+    worker. Checking a token is a filter lookup; only a possible hit is
+    confirmed with a primary key lookup. The filter is refreshed incrementally
+    from the table at most once every `sync_interval` seconds, and rebuilt from
+    the unexpired rows once it holds `capacity` ids, which also drops expired
+    ones. A revocation made by another worker and not synced yet is still
+    caught by the primary key when the token is revoked again.
+    """
+
+    def __init__(self, sync_interval: float, capacity: int, error_rate: float = 0.01):
+        self.sync_interval = sync_interval
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._filter = BloomFilter(capacity, error_rate)
+        self._watermark = None
+        self._next_sync = 0.0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def is_revoked(self, db: Session, jti: str) -> bool:
+        if time.monotonic() >= self._next_sync:
+            self.sync(db)
+        if jti not in self._filter:
+            return False
+        return (
+            db.execute(select(RevokedToken.jti).where(RevokedToken.jti == jti)).first()
+            is not None
+        )
+
+    def add(self, jti: str):
+        with self._lock:
+            self._filter.add(jti)
+
+    def sync(self, db: Session):
+        # One request syncs; the others keep checking the current filter.
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() < self._next_sync:
+                return
+
+            rebuild = self._watermark is None or self._filter.count >= self.capacity
+            query = select(RevokedToken.jti, RevokedToken.revoked_at).where(
+                RevokedToken.expires_at > utcnow()
+            )
+            if not rebuild:
+                # Overlap with the previous sync so rows committed late by other
+                # workers are not skipped; re-adding a jti is harmless.
+                query = query.where(
+                    RevokedToken.revoked_at
+                    >= self._watermark - timedelta(seconds=self.sync_interval)
+                )
+            rows = db.execute(query).all()
+
+            watermark = None if rebuild else self._watermark
+            with self._lock:
+                if rebuild:
+                    self._filter = BloomFilter(self.capacity, self.error_rate)
+                for jti, revoked_at in rows:
+                    self._filter.add(jti)
+                    if watermark is None or revoked_at > watermark:
+                        watermark = revoked_at
+                self._watermark = watermark or utcnow()
+            self._next_sync = time.monotonic() + self.sync_interval
+        finally:
+            self._sync_lock.release()
+
+    def clear(self):
+        with self._lock:
+            self._filter = BloomFilter(self.capacity, self.error_rate)
+            self._watermark = None
+            self._next_sync = 0.0
+
+    def __len__(self):
+        return self._filter.count
+
+
+def delete_expired(db: Session) -> int:
+    """Delete the revocations of tokens that have expired anyway."""
+    deleted = db.execute(
+        delete(RevokedToken).where(RevokedToken.expires_at <= utcnow())
+    ).rowcount
+    db.commit()
+    return deleted
+
+
+revocation_list = RevocationList(
+    sync_interval=settings.REVOCATION_SYNC_SECONDS,
+    capacity=settings.REVOCATION_FILTER_CAPACITY,
+)
@@ -0,0 +1,135 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from sqlalchemy.orm import Session
+from app.changes import (
+    MAX_BATCH,
+    compacted_offset,
+    get_checkpoint,
+    get_consumer,
+    last_offset,
+    read_changes,
+    render_batch,
+    set_checkpoint,
+)
+from app.database import get_db
+from app.profiling import ProfiledRoute
+from app.schemas import ChangeBatch, ChangeCheckpoint, ChangeCheckpointUpdate
+from app.sharding import shard_router
+
+router = APIRouter(route_class=ProfiledRoute)
+
+
+def open_shard(shard: int, db: Session) -> Session:
+    if not 0 <= shard < shard_router.count:
+        raise HTTPException(status_code=404, detail="Shard not found")
+    return db if shard == 0 else shard_router.session(shard)
+
+
+@router.get(
+    "/",
+    response_model=ChangeBatch,
+    summary="Read the receipt change log",
+    description="""
+    Returns the next batch of changes to the receipts of one shard, oldest first, with each created receipt in full.
+    \n- `shard`: The shard whose change log is read; every shard has its own offsets.
+    \n- `after`: Return the changes after this offset. Defaults to the consumer's checkpoint.
+    \n- `limit`: Maximum number of changes to return (at most 10000).
+    \n- Requires an `X-API-Key` header with a consumer key from CHANGES_API_KEYS.
+    \nRequest the next batch after `next_after` while `has_more` is true, and store `next_after` with
+    `PUT /changes/checkpoint` once a batch is processed. Changes up to the compacted offset have been deleted;
+    asking for them returns a 410 error.
+    """,
+)
+def list_changes(
+    shard: int = Query(0, description="Shard whose change log is read"),
+    after: Optional[int] = Query(
+        None, ge=0, description="Return the changes after this offset"
+    ),
+    limit: int = Query(
+        1000, ge=1, le=MAX_BATCH, description="Maximum number of changes to return"
+    ),
+    consumer: str = Depends(get_consumer),
+    db: Session = Depends(get_db),
+):
+    shard_db = open_shard(shard, db)
+    try:
+        if after is None:
+            after = get_checkpoint(shard_db, consumer)
+        floor = compacted_offset(shard_db)
+        if after < floor:
+            raise HTTPException(
+                status_code=410,
+                detail=f"Changes up to offset {floor} were compacted",
+            )
+        rows = read_changes(shard_db, after, limit)
+    finally:
+        if shard_db is not db:
+            shard_db.close()
+    return Response(
+        render_batch(shard, after, rows, limit), media_type="application/json"
+    )
+
+
+@router.get(
+    "/checkpoint",
+    response_model=ChangeCheckpoint,
+    summary="Get the consumer's checkpoint",
+    description="""
+    Returns the offset the authenticated consumer last checkpointed in the change log of a shard.
+    \n- Requires an `X-API-Key` header with a consumer key from CHANGES_API_KEYS.
+    """,
+)
+def read_checkpoint(
+    shard: int = Query(0, description="Shard whose change log is read"),
+    consumer: str = Depends(get_consumer),
+    db: Session = Depends(get_db),
+):
+    shard_db = open_shard(shard, db)
+    try:
+        return {
+            "shard": shard,
+            "consumer": consumer,
+            "offset": get_checkpoint(shard_db, consumer),
+            "compacted_offset": compacted_offset(shard_db),
+        }
+    finally:
+        if shard_db is not db:
+            shard_db.close()
+
+
+@router.put(
+    "/checkpoint",
+    response_model=ChangeCheckpoint,
+    summary="Store the consumer's checkpoint",
+    description="""
+    Stores the offset up to which the authenticated consumer has processed the change log of a shard.
+    Compaction only deletes changes every configured consumer has checkpointed past, unless they are
+    older than CHANGES_RETENTION_DAYS.
+    \n- Requires an `X-API-Key` header with a consumer key from CHANGES_API_KEYS.
+    \n- If the offset is negative or past the last change, it returns a 400 error.
+    """,
+)
+def write_checkpoint(
+    checkpoint: ChangeCheckpointUpdate,
+    shard: int = Query(0, description="Shard whose change log is read"),
+    consumer: str = Depends(get_consumer),
+    db: Session = Depends(get_db),
+):
+    shard_db = open_shard(shard, db)
+    try:
+        # Compaction may have deleted every change, the last one included.
+        end = max(last_offset(shard_db), compacted_offset(shard_db))
+        if not 0 <= checkpoint.offset <= end:
+            raise HTTPException(
+                status_code=400, detail="Offset is outside the change log"
+            )
+        set_checkpoint(shard_db, consumer, checkpoint.offset)
+        return {
+            "shard": shard,
+            "consumer": consumer,
+            "offset": checkpoint.offset,
+            "compacted_offset": compacted_offset(shard_db),
+        }
+    finally:
+        if shard_db is not db:
+            shard_db.close()
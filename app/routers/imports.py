@@ -0,0 +1,187 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+from starlette.requests import ClientDisconnect
+from app.auth import get_current_user
+from app.config import settings
+from app.database import get_db
+from app.importing import LineSplitter, ReceiptImporter, claim_job
+from app.models import ImportJob, ImportJobError, ImportJobForward, User
+from app.profiling import ProfiledRoute
+from app.revocation import utcnow
+from app.routers.receipts import product_cache
+from app.schemas import ImportJobOut, ImportLineError
+from app.sharding import (
+    get_shard_db,
+    global_receipt_id,
+    shard_router,
+    shard_session,
+    split_receipt_id,
+)
+
+router = APIRouter(route_class=ProfiledRoute)
+
+
+def locate_job(
+    job_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+) -> tuple:
+    """
+    Return `(shard, id on the shard)` of an import job. Job ids carry their
+    shard like receipt ids; jobs moved with their user to another shard are
+    found through their forwarding entry.
+    """
+    shard, local_id = split_receipt_id(job_id)
+    if shard != current_user.shard:
+        forward = db.get(ImportJobForward, job_id)
+        if forward is not None:
+            shard, local_id = split_receipt_id(forward.new_id)
+    if not 0 <= shard < shard_router.count:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    return shard, local_id
+
+
+def get_job_db(
+    location: tuple = Depends(locate_job),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Session on the shard holding the import job."""
+    yield from shard_session(db, location[0], current_user)
+
+
+def get_job(db: Session, user: User, job_id: int) -> ImportJob:
+    job = db.get(ImportJob, job_id)
+    if job is None or job.user_id != user.id:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    return job
+
+
+def job_out(
+    db: Session,
+    shard: int,
+    job: ImportJob,
+    errors_skip: int = 0,
+    errors_limit: int = 100,
+):
+    errors = (
+        db.query(ImportJobError)
+        .filter(ImportJobError.job_id == job.id)
+        .order_by(ImportJobError.line)
+        .offset(errors_skip)
+        .limit(errors_limit)
+        .all()
+    )
+    out = ImportJobOut.model_validate(job)
+    out.id = global_receipt_id(shard, job.id)
+    out.errors = [ImportLineError.model_validate(error) for error in errors]
+    return out
+
+
+@router.post(
+    "/",
+    response_model=ImportJobOut,
+    status_code=201,
+    summary="Create a receipt import job",
+    description="""
+    Creates an import job for the authenticated user. Upload the receipts with
+    `POST /receipts/imports/{job_id}/lines`.
+    """,
+)
+def create_import_job(
+    db: Session = Depends(get_shard_db),
+    current_user: User = Depends(get_current_user),
+):
+    now = utcnow()
+    job = ImportJob(user_id=current_user.id, created_at=now, updated_at=now)
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job_out(db, current_user.shard, job)
+
+
+@router.post(
+    "/{job_id}/lines",
+    response_model=ImportJobOut,
+    summary="Upload receipts to an import job",
+    description="""
+    Streams receipts into an import job. The body holds one receipt per line in the format of
+    `POST /receipts/`, optionally with a `created_at` timestamp, and may be gzip-compressed
+    (`Content-Encoding: gzip` or `Content-Type: application/gzip`).
+    \n- The body is parsed while it arrives and written in batches, so files of any size can be uploaded.
+    \n- Invalid lines are skipped and reported in `errors`; the other lines are imported.
+    \n- If an upload is interrupted, upload the same file again: lines already processed
+    (`lines_committed`) are skipped.
+    """,
+)
+async def upload_import_lines(
+    request: Request,
+    location: tuple = Depends(locate_job),
+    db: Session = Depends(get_job_db),
+    current_user: User = Depends(get_current_user),
+):
+    shard, job_id = location
+    job = await run_in_threadpool(get_job, db, current_user, job_id)
+    if job.status == "completed":
+        raise HTTPException(status_code=409, detail="Import job already completed")
+    if not await run_in_threadpool(claim_job, db, job):
+        raise HTTPException(
+            status_code=409, detail="Another upload to this job is in progress"
+        )
+
+    compressed = (
+        request.headers.get("content-encoding", "").lower() == "gzip"
+        or request.headers.get("content-type", "").lower() == "application/gzip"
+    )
+    splitter = LineSplitter(compressed, settings.IMPORT_MAX_LINE_BYTES)
+    importer = ReceiptImporter(db, job, shard, product_cache)
+    resume_after = job.lines_committed
+    batch = []
+
+    async def add(lines):
+        for number, line in lines:
+            if number > resume_after:
+                batch.append((number, line))
+            if len(batch) >= settings.IMPORT_BATCH_RECEIPTS:
+                await run_in_threadpool(importer.write_batch, batch[:])
+                batch.clear()
+
+    try:
+        async for chunk in request.stream():
+            await add(splitter.feed(chunk))
+        await add(splitter.finish())
+    except ClientDisconnect:
+        # Nobody is waiting for the response; keep what arrived for a resume.
+        await run_in_threadpool(importer.write_batch, batch)
+        await run_in_threadpool(importer.set_status, "interrupted")
+        return None
+    except ValueError as error:
+        await run_in_threadpool(importer.write_batch, batch)
+        await run_in_threadpool(importer.set_status, "failed")
+        raise HTTPException(status_code=400, detail=str(error))
+
+    await run_in_threadpool(importer.write_batch, batch)
+    await run_in_threadpool(importer.set_status, "completed")
+    return await run_in_threadpool(job_out, db, shard, job)
+
+
+@router.get(
+    "/{job_id}",
+    response_model=ImportJobOut,
+    summary="Get a receipt import job",
+    description="""
+    Returns the progress of an import job and the lines it rejected.
+    \n- `errors_skip`, `errors_limit`: Page through the rejected lines.
+    """,
+)
+def get_import_job(
+    errors_skip: int = Query(0, ge=0),
+    errors_limit: int = Query(100, ge=1, le=1000),
+    location: tuple = Depends(locate_job),
+    db: Session = Depends(get_job_db),
+    current_user: User = Depends(get_current_user),
+):
+    shard, job_id = location
+    job = get_job(db, current_user, job_id)
+    return job_out(db, shard, job, errors_skip, errors_limit)
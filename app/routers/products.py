@@ -0,0 +1,51 @@
+from typing import Literal
+from fastapi import APIRouter, Depends, Query
+from app.auth import get_current_user
+from app.leaderboard import TOP_LIMIT, leaderboard
+from app.models import User
+from app.profiling import ProfiledRoute
+from app.schemas import ProductLeaderboard, ProductSuggestions
+from app.suggestions import SUGGEST_LIMIT, product_index
+
+router = APIRouter(route_class=ProfiledRoute)
+
+
+@router.get(
+    "/top",
+    response_model=ProductLeaderboard,
+    summary="Best-selling products",
+    description="""
+    The products with the most units sold across all users, served from memory.
+    \n- `window`: `hour` (the current UTC hour), `day` (the current UTC day) or `all` (all time).
+    \n- `k`: The number of products to return.
+    \nCounts are shared between workers every few seconds. Until then a product that just
+    entered the ranking may be counted slightly too high.
+    """,
+)
+def top_products(
+    window: Literal["hour", "day", "all"] = Query("day", description="Time window"),
+    k: int = Query(10, ge=1, le=TOP_LIMIT, description="Number of products"),
+    current_user: User = Depends(get_current_user),
+):
+    return leaderboard.top(window, k)
+
+
+@router.get(
+    "/suggest",
+    response_model=ProductSuggestions,
+    summary="Suggest products by name prefix",
+    description="""
+    Products whose names start with `prefix`, ignoring case, for type-ahead when entering a
+    receipt, so an existing `(name, price)` product is reused instead of creating a near-duplicate.
+    \n- `prefix`: The beginning of the product name.
+    \n- `k`: The number of products to return.
+    \nProducts are ranked by units sold and served from memory. Products created by other
+    workers are included within SUGGEST_REFRESH_SECONDS (30 by default).
+    """,
+)
+def suggest_products(
+    prefix: str = Query(..., min_length=1, max_length=100, description="Name prefix"),
+    k: int = Query(10, ge=1, le=SUGGEST_LIMIT, description="Number of products"),
+    current_user: User = Depends(get_current_user),
+):
+    return {"prefix": prefix, "products": product_index.suggest(prefix, k)}
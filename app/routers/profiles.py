@@ -0,0 +1,42 @@
+from typing import List, Literal
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import FileResponse
+from app.profiling import profile_store, require_profile_token
+from app.schemas import ProfileSummary
+
+router = APIRouter(dependencies=[Depends(require_profile_token)])
+
+
+@router.get(
+    "/",
+    response_model=List[ProfileSummary],
+    summary="List request profiles",
+    description="""
+    The stored request profiles, newest first. Only the most recent PROFILE_MAX_PROFILES are kept.
+    \n- Requires a valid `X-Profile-Token` header (`python -m app.cli profile-token`).
+    \nA request is profiled when it carries the same header, or at random with PROFILE_SAMPLE_RATE.
+    Its response then has the profile's id in the `X-Profile-Id` header.
+    """,
+)
+def list_profiles():
+    return profile_store.list()
+
+
+@router.get(
+    "/{profile_id}",
+    summary="Download a request profile",
+    description="""
+    Downloads a stored request profile.
+    \n- `format`: `pstats` (binary, for `python -m pstats` or snakeviz) or `collapsed` (text, for flamegraph.pl or speedscope).
+    \n- Requires a valid `X-Profile-Token` header.
+    \n- If the profile does not exist or was already replaced by newer ones, it returns a 404 error.
+    """,
+)
+def download_profile(
+    profile_id: str, format: Literal["pstats", "collapsed"] = Query("collapsed")
+):
+    path = profile_store.path(profile_id, format)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    media_type = "text/plain" if format == "collapsed" else "application/octet-stream"
+    return FileResponse(path, media_type=media_type, filename=f"{profile_id}.{format}")
@@ -1,15 +1,39 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy import text
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from sqlalchemy import func, select, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from app.archive import archive, product_views, receipt_view
+from app.cache import TTLCache
+from app.changes import append_changes, created_change
+from app.config import settings
 from app.database import get_db
-from app.models import Receipt, User, Product, receipt_product
-from app.schemas import ReceiptOut, ProductOut, ReceiptCreate
+from app.importing import price_receipt
+from app.insights import get_insights, record_receipt
+from app.invalidation import bus
+from app.leaderboard import leaderboard
+from app.models import Receipt, ReceiptForward, User, Product, receipt_product
+from app.schemas import ReceiptOut, ProductOut, ReceiptCreate, SpendingInsights
 from app.auth import get_current_user
+from app.pagination import count_receipts, invalidate_receipt_counts
+from app.profiling import ProfiledRoute
+from app.revocation import utcnow
+from app.sharding import get_shard_db, global_receipt_id, shard_router, split_receipt_id
+from app.streaming import receipt_broker, receipt_events
+from app.suggestions import product_index
 from typing import List, Optional, Literal
-from datetime import datetime, timezone
-from fastapi.responses import PlainTextResponse
+from datetime import datetime
+from fastapi.responses import PlainTextResponse, StreamingResponse
 
-router = APIRouter()
+router = APIRouter(route_class=ProfiledRoute)
+
+# (shard, name, price) -> product id, published on the "products" topic.
+product_cache = TTLCache(ttl=settings.PRODUCT_CACHE_TTL, maxsize=100000)
+bus.subscribe("products", product_cache)
+
+# receipt id -> {line_width: rendered text}, published on the "receipts" topic.
+receipt_text_cache = TTLCache(ttl=settings.RECEIPT_TEXT_CACHE_TTL)
+bus.subscribe("receipts", receipt_text_cache)
+MAX_CACHED_WIDTHS_PER_RECEIPT = 8
 
 
 @router.post(
@@ -23,84 +47,110 @@ router = APIRouter()
 )
 def create_receipt(
     receipt: ReceiptCreate,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_shard_db),
     current_user: User = Depends(get_current_user),
 ):
-    valid_products = [p for p in receipt.products if p.quantity > 0]
-
-    if not valid_products:
-        raise HTTPException(status_code=400, detail="No products were bought.")
+    valid_products, total = price_receipt(receipt)
+    try:
+        receipt_id, result, items, resolved_products = insert_receipt(
+            db, current_user, receipt, valid_products, total, use_cache=True
+        )
+    except IntegrityError:
+        # The retention purge deleted a product between its lookup and the
+        # insert. Look all of them up again once.
+        db.rollback()
+        receipt_id, result, items, resolved_products = insert_receipt(
+            db, current_user, receipt, valid_products, total, use_cache=False
+        )
+    created_at = result["created_at"]
+
+    for product_key, product_id in resolved_products.items():
+        product_cache.set(product_key, product_id)
+    invalidate_receipt_counts(current_user.id)
+    record_receipt(current_user.id, receipt_id, total, created_at, items)
+    sold = [(name, price, quantity) for _, name, price, quantity in items]
+    leaderboard.record(created_at, sold)
+    product_index.record(sold)
+    receipt_broker.publish(current_user.id, result)
+    return result
 
-    total = sum([p.price * p.quantity for p in valid_products])
-    if receipt.payment.amount < total:
-        raise HTTPException(status_code=400, detail="Insufficient payment")
 
+def insert_receipt(
+    db: Session,
+    user: User,
+    receipt: ReceiptCreate,
+    valid_products: list,
+    total: float,
+    use_cache: bool,
+):
+    """
+    Write the receipt with its products, line items and change log entry in
+    one transaction. Returns the shard-local id, the receipt, the line items
+    and the products that were looked up or created.
+    """
     new_receipt = Receipt(
         total=total,
-        created_at=datetime.now(timezone.utc),
+        created_at=utcnow(),
         payment_type=receipt.payment.type,
         payment_amount=(
             receipt.payment.amount if receipt.payment.type == "cash" else total
         ),
-        owner=current_user,
+        user_id=user.id,
     )
 
-    rest = new_receipt.payment_amount - total
-
-    db.add(new_receipt)
-    db.commit()
-    db.refresh(new_receipt)
-
+    resolved_products = {}
+    items = []
     for product in valid_products:
-        db_product = (
-            db.query(Product)
-            .filter(Product.name == product.name, Product.price == product.price)
-            .first()
-        )
-        if not db_product:
-            db_product = Product(name=product.name, price=product.price)
-            db.add(db_product)
-            db.commit()
-            db.refresh(db_product)
-
-        db.execute(
-            receipt_product.insert().values(
-                receipt_id=new_receipt.id,
-                product_id=db_product.id,
-                quantity=product.quantity,
-            )
-        )
-
-    db.commit()
+        product_key = (user.shard, product.name, product.price)
+        product_id = product_cache.get(product_key) if use_cache else None
+        if product_id is None:
+            product_id = find_or_create_product(db, product.name, product.price)
+            resolved_products[product_key] = product_id
+        items.append((product_id, product.name, product.price, product.quantity))
 
-    product_out = db.execute(
-        text(
-            """
-            SELECT p.name, p.price, rp.quantity 
-            FROM receipt_product rp
-            JOIN products p ON p.id = rp.product_id
-            WHERE rp.receipt_id = :receipt_id
-            """
-        ),
-        {"receipt_id": new_receipt.id},
-    ).fetchall()
-
-    product_out_list = [
-        ProductOut(name=prod.name, price=prod.price, total=prod.price * prod.quantity)
-        for prod in product_out
-    ]
+    db.add(new_receipt)
+    db.query(User).filter(User.id == user.id).update(
+        {User.receipt_count: User.receipt_count + 1}, synchronize_session=False
+    )
+    db.flush()
+    # Attributes expire on commit; keep what is needed afterwards.
+    receipt_id, created_at = new_receipt.id, new_receipt.created_at
+    db.execute(
+        receipt_product.insert(),
+        [
+            {"receipt_id": receipt_id, "product_id": product_id, "quantity": q}
+            for product_id, _, _, q in items
+        ],
+    )
 
-    return {
-        "id": new_receipt.id,
-        "products": product_out_list,
+    result = {
+        "id": global_receipt_id(user.shard, receipt_id),
+        "products": [
+            ProductOut(name=name, price=price, total=price * quantity)
+            for _, name, price, quantity in items
+        ],
         "total": total,
-        "rest": rest,
-        "created_at": new_receipt.created_at,
+        "rest": new_receipt.payment_amount - total,
+        "created_at": created_at,
         "payment": {
             "type": new_receipt.payment_type,
             "amount": new_receipt.payment_amount,
         },
     }
+    append_changes(db, [created_change(result, user.id)])
+    db.commit()
+    return receipt_id, result, items, resolved_products
+
+
+def find_or_create_product(db: Session, name: str, price: float) -> int:
+    db_product = (
+        db.query(Product).filter(Product.name == name, Product.price == price).first()
+    )
+    if not db_product:
+        db_product = Product(name=name, price=price)
+        db.add(db_product)
+        db.flush()
+    return db_product.id
 
 
 @router.get(
@@ -113,10 +163,14 @@ def create_receipt(
     \n- `end_date`: Filter receipts up to this datetime.
     \n- `min_total`: Minimum total price of receipts.
     \n- `payment_type`: Filter by payment type (cash/cashless).
-    \nPagination is supported using `skip` and `limit`.
+    \nPagination is supported using `skip` and `limit`. Archived receipts follow the live ones.
+    \nPass `count=exact` or `count=estimate` to receive the total number of matching
+    receipts in the `X-Total-Count` header. `X-Total-Count-Mode` tells whether the
+    value is exact or a planner estimate (only used for very large result sets).
     """,
 )
 def list_receipts(
+    response: Response,
     start_date: Optional[datetime] = Query(
         None,
         description="Filter receipts starting from this datetime (inclusive). Format: YYYY-MM-DDTHH:MM:SS",
@@ -138,7 +192,10 @@ def list_receipts(
     limit: Optional[int] = Query(
         10, description="Maximum number of records to return (for pagination)"
     ),
-    db: Session = Depends(get_db),
+    count: Optional[Literal["exact", "estimate"]] = Query(
+        None, description="Return the total number of matching receipts in headers"
+    ),
+    db: Session = Depends(get_shard_db),
     current_user: User = Depends(get_current_user),
 ):
     query = db.query(Receipt).filter(Receipt.user_id == current_user.id)
@@ -152,9 +209,13 @@ def list_receipts(
     if payment_type:
         query = query.filter(Receipt.payment_type == payment_type)
 
-    query = query.offset(skip).limit(limit)
+    if count:
+        filters = (start_date, end_date, min_total, payment_type)
+        total, mode = count_receipts(db, current_user.id, query, filters, count)
+        response.headers["X-Total-Count"] = str(total)
+        response.headers["X-Total-Count-Mode"] = mode
 
-    receipts = query.all()
+    receipts = query.offset(skip).limit(limit).all()
 
     result = []
     for receipt in receipts:
@@ -169,29 +230,142 @@ def list_receipts(
             ),
             {"receipt_id": receipt.id},
         ).fetchall()
+        result.append(receipt_out(receipt, product_out, current_user.shard))
+
+    if limit is None or len(receipts) < limit:
+        # Past the end of the live rows: continue the page with archived receipts.
+        if receipts or not skip:
+            live_total = skip + len(receipts)
+        else:
+            live_total = query.order_by(None).count()
+        archived_ids = archive.find_user_receipts(
+            current_user.id, start_date, end_date, min_total, payment_type
+        )
+        archive_skip = max(0, skip - live_total)
+        archive_stop = None if limit is None else archive_skip + limit - len(receipts)
+        for receipt_id in archived_ids[archive_skip:archive_stop]:
+            record = archive.get(receipt_id)
+            result.append(receipt_out(receipt_view(record), product_views(record)))
+
+    return result
 
-        product_out_list = [
+
+def receipt_out(receipt: Receipt, product_out: list, shard: int = 0) -> dict:
+    return {
+        "id": global_receipt_id(shard, receipt.id),
+        "products": [
             ProductOut(
                 name=prod.name, price=prod.price, total=prod.price * prod.quantity
             )
             for prod in product_out
-        ]
-
-        result.append(
-            {
-                "id": receipt.id,
-                "products": product_out_list,
-                "total": receipt.total,
-                "rest": receipt.payment_amount - receipt.total,
-                "created_at": receipt.created_at,
-                "payment": {
-                    "type": receipt.payment_type,
-                    "amount": receipt.payment_amount,
-                },
-            }
-        )
+        ],
+        "total": receipt.total,
+        "rest": receipt.payment_amount - receipt.total,
+        "created_at": receipt.created_at,
+        "payment": {
+            "type": receipt.payment_type,
+            "amount": receipt.payment_amount,
+        },
+    }
 
-    return result
+
+@router.get(
+    "/insights",
+    response_model=SpendingInsights,
+    summary="Spending insights",
+    description="""
+    Spending statistics for the authenticated user: receipt total percentiles, median basket size,
+    top products by amount spent and a weekday/hour heatmap of purchases.
+    \n- `top`: The number of top products to return.
+    """,
+)
+def spending_insights(
+    top: int = Query(10, ge=1, le=100, description="Number of top products"),
+    db: Session = Depends(get_shard_db),
+    current_user: User = Depends(get_current_user),
+):
+    return get_insights(db, current_user.id, top)
+
+
+@router.get(
+    "/stream",
+    response_class=StreamingResponse,
+    summary="Stream new receipts",
+    description="""
+    Server-sent events (`text/event-stream`) with the authenticated user's receipts as they are
+    created, so clients do not need to poll `GET /receipts/`. Each `receipt` event carries the
+    receipt in the format of `POST /receipts/`, with the receipt id as the event id.
+    \n- `Last-Event-ID`: Resume after this receipt id; receipts created since are sent first.
+    Browsers send it when reconnecting.
+    \nComment lines are sent as heartbeats. The server closes the stream after a while,
+    or when the client cannot keep up; reconnect with `Last-Event-ID` to continue.
+    """,
+)
+async def stream_receipts(
+    last_event_id: Optional[int] = Header(None),
+    db: Session = Depends(get_shard_db),
+    current_user: User = Depends(get_current_user),
+):
+    # `db` is released before the response is streamed and opened again only
+    # while `start` and `fetch` run.
+    user_id, shard = current_user.id, current_user.shard
+
+    def start():
+        try:
+            if last_event_id is not None:
+                if split_receipt_id(last_event_id)[0] == shard:
+                    return last_event_id, True
+                forward = db.get(ReceiptForward, last_event_id)
+                if forward is not None:
+                    return forward.new_id, True
+            # Receipts the user creates from now on get higher ids.
+            latest = db.execute(select(func.max(Receipt.id))).scalar()
+            return global_receipt_id(shard, latest or 0), False
+        finally:
+            db.close()
+
+    def fetch(after_id: int):
+        try:
+            receipts = (
+                db.query(Receipt)
+                .filter(
+                    Receipt.user_id == user_id,
+                    Receipt.id > split_receipt_id(after_id)[1],
+                )
+                .order_by(Receipt.id)
+                .limit(settings.STREAM_REPLAY_BATCH)
+                .all()
+            )
+            products = {receipt.id: [] for receipt in receipts}
+            if receipts:
+                for row in db.execute(
+                    select(
+                        receipt_product.c.receipt_id,
+                        Product.name,
+                        Product.price,
+                        receipt_product.c.quantity,
+                    )
+                    .join(Product, Product.id == receipt_product.c.product_id)
+                    .where(receipt_product.c.receipt_id.in_(products))
+                ):
+                    products[row.receipt_id].append(row)
+            return [
+                (
+                    global_receipt_id(shard, receipt.id),
+                    ReceiptOut.model_validate(
+                        receipt_out(receipt, products[receipt.id], shard)
+                    ).model_dump_json(),
+                )
+                for receipt in receipts
+            ]
+        finally:
+            db.close()
+
+    return StreamingResponse(
+        receipt_events(user_id, start, fetch),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @router.get(
@@ -201,33 +375,67 @@ def list_receipts(
     description="""
     Retrieve a plain text version of a receipt. This endpoint can be accessed by anyone without authentication.
     Customize the width of each line using the `line_width` parameter.
+    Receipts moved to the cold-storage archive are served from there, and receipts moved to
+    another shard are found through their forwarding entry.
     """,
 )
 def get_public_receipt(
     receipt_id: int, line_width: int = 30, db: Session = Depends(get_db)
 ):
-    receipt = db.query(Receipt).filter(Receipt.id == receipt_id).first()
-
-    if not receipt:
-        raise HTTPException(status_code=404, detail="Receipt not found")
-
-    product_out = db.execute(
-        text(
-            """
-            SELECT p.name, p.price, rp.quantity 
-            FROM receipt_product rp
-            JOIN products p ON p.id = rp.product_id
-            WHERE rp.receipt_id = :receipt_id
-            """
-        ),
-        {"receipt_id": receipt.id},
-    ).fetchall()
+    rendered = receipt_text_cache.get(receipt_id)
+    if rendered is not None and line_width in rendered:
+        return rendered[line_width]
+
+    receipt_text = render_stored_receipt(db, receipt_id, line_width)
+    if receipt_text is None:
+        forward = db.get(ReceiptForward, receipt_id)
+        if forward is not None:
+            receipt_text = render_stored_receipt(db, forward.new_id, line_width)
+    if receipt_text is None:
+        record = archive.get(receipt_id)
+        if record is None:
+            raise HTTPException(status_code=404, detail="Receipt not found")
+        receipt_text = build_receipt_text(
+            receipt_view(record), product_views(record), line_width
+        )
 
-    receipt_text = build_receipt_text(receipt, product_out, line_width)
+    if rendered is None or len(rendered) >= MAX_CACHED_WIDTHS_PER_RECEIPT:
+        rendered = {}
+        receipt_text_cache.set(receipt_id, rendered)
+    rendered[line_width] = receipt_text
 
     return receipt_text
 
 
+def render_stored_receipt(
+    db: Session, receipt_id: int, line_width: int
+) -> Optional[str]:
+    """Render a receipt from the shard its id points to, or return None."""
+    shard, local_id = split_receipt_id(receipt_id)
+    if shard >= shard_router.count:
+        return None
+    shard_db = db if shard == 0 else shard_router.session(shard)
+    try:
+        receipt = shard_db.query(Receipt).filter(Receipt.id == local_id).first()
+        if receipt is None:
+            return None
+        product_out = shard_db.execute(
+            text(
+                """
+                SELECT p.name, p.price, rp.quantity 
+                FROM receipt_product rp
+                JOIN products p ON p.id = rp.product_id
+                WHERE rp.receipt_id = :receipt_id
+                """
+            ),
+            {"receipt_id": receipt.id},
+        ).fetchall()
+        return build_receipt_text(receipt, product_out, line_width)
+    finally:
+        if shard_db is not db:
+            shard_db.close()
+
+
 def build_receipt_text(receipt: Receipt, product_out: list, line_width: int) -> str:
     receipt_lines = []
 
@@ -1,18 +1,25 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from sqlalchemy.orm import Session
 from fastapi.security import OAuth2PasswordRequestForm
+from typing import List
+from app.config import settings
 from app.models import User
 from app.database import get_db
-from app.schemas import UserCreate, UserOut, Token
+from app.provisioning import register_users, require_provisioning_key
+from app.profiling import ProfiledRoute
+from app.sharding import shard_router
+from app.schemas import UserCreate, UserOut, Token, BulkUserResult
 from app.auth import (
     get_password_hash,
     verify_password,
     create_access_token,
     create_refresh_token,
     verify_refresh_token,
+    revoke_refresh_token,
+    find_user,
 )
 
-router = APIRouter()
+router = APIRouter(route_class=ProfiledRoute)
 
 
 @router.post(
@@ -37,11 +44,37 @@ def register_user(user: UserCreate, db: Session = Depends(get_db)):
         surname=user.surname,
     )
     db.add(new_user)
+    db.flush()
+    new_user.shard = shard_router.shard_for(new_user.id)
     db.commit()
     db.refresh(new_user)
     return new_user
 
 
+@router.post(
+    "/register/bulk",
+    response_model=List[BulkUserResult],
+    dependencies=[Depends(require_provisioning_key)],
+    summary="Register many users",
+    description="""
+    Registers a list of user accounts in one request, e.g. when onboarding the cashiers of a new store chain.
+    \n- Requires an `X-API-Key` header with PROVISIONING_API_KEY.
+    \n- Returns one result per submitted record, in the same order.
+    \n- Usernames that are already registered or repeated in the request are reported, not created.
+    """,
+)
+def register_users_bulk(
+    users: List[UserCreate],
+    db: Session = Depends(get_db),
+):
+    if len(users) > settings.BULK_REGISTER_MAX_USERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {settings.BULK_REGISTER_MAX_USERS} users per request",
+        )
+    return register_users(db, users)
+
+
 @router.post(
     "/login",
     response_model=Token,
@@ -85,21 +118,40 @@ def login_user(
     response_model=Token,
     summary="Refresh access token",
     description="""
-    Refreshes the access token using a valid refresh token. 
-    \n- Returns a new access token and the same refresh token.
-    \n- If the refresh token is invalid or the user is not found, an error is returned.
+    Exchanges a valid refresh token for a new access token and a new refresh token.
+    \n- The presented refresh token is revoked (rotation) and cannot be used again.
+    \n- If the refresh token is invalid, revoked or the user is not found, an error is returned.
     """,
 )
 def refresh_access_token(refresh_token: str, db: Session = Depends(get_db)):
-    username = verify_refresh_token(refresh_token)
-    db_user = db.query(User).filter(User.username == username).first()
+    payload = verify_refresh_token(refresh_token, db)
+    db_user = find_user(db, payload.get("sub"))
     if not db_user:
         raise HTTPException(status_code=400, detail="User not found")
 
-    access_token = create_access_token(data={"sub": db_user.username})
+    # Attributes expire on commit; keep the username.
+    username = db_user.username
+    revoke_refresh_token(payload, db)
+
+    access_token = create_access_token(data={"sub": username})
+    new_refresh_token = create_refresh_token(data={"sub": username})
 
     return {
         "access_token": access_token,
-        "refresh_token": refresh_token,
+        "refresh_token": new_refresh_token,
         "token_type": "bearer",
     }
+
+
+@router.post(
+    "/logout",
+    status_code=204,
+    summary="Revoke a refresh token",
+    description="""
+    Revokes the given refresh token so it can no longer be used to obtain access tokens.
+    """,
+)
+def logout_user(refresh_token: str, db: Session = Depends(get_db)):
+    payload = verify_refresh_token(refresh_token, db)
+    revoke_refresh_token(payload, db)
+    return Response(status_code=204)
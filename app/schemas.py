@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Literal, Optional
+from typing import Dict, List, Literal, Optional
 from datetime import datetime
 
 
@@ -32,6 +32,21 @@ class UserOut(BaseModel):
         from_attributes = True
 
 
+class BulkUserResult(BaseModel):
+    """
+    Schema for the outcome of one record of a bulk registration.
+    \n- `username`: The username from the submitted record.
+    \n- `status`: `created`, `conflict` (already registered) or `duplicate` (repeated in the request).
+    \n- `id`: The identifier of the created user.
+    \n- `detail`: Why the record was not created.
+    """
+
+    username: str
+    status: Literal["created", "conflict", "duplicate"]
+    id: Optional[int] = None
+    detail: Optional[str] = None
+
+
 class Token(BaseModel):
     """
     Schema for returning JWT token data.
@@ -96,6 +111,15 @@ class ReceiptCreate(BaseModel):
     payment: Payment
 
 
+class ReceiptImport(ReceiptCreate):
+    """
+    Schema for one line of a receipt import.
+    \n- `created_at`: When the receipt was issued; defaults to the time of the import.
+    """
+
+    created_at: Optional[datetime] = None
+
+
 class ReceiptOut(BaseModel):
     """
     Schema for outputting receipt details.
@@ -132,3 +156,199 @@ class ReceiptFilter(BaseModel):
     payment_type: Optional[Literal["cash", "cashless"]] = None
     skip: Optional[int] = 0
     limit: Optional[int] = 10
+
+
+class TopProduct(BaseModel):
+    """
+    Schema for a product in spending insights.
+    \n- `name`: The name of the product.
+    \n- `price`: The price of a single unit of the product.
+    \n- `quantity`: The number of units bought.
+    \n- `spent`: The amount spent on the product.
+    """
+
+    name: str
+    price: float
+    quantity: int
+    spent: float
+
+
+class SpendingInsights(BaseModel):
+    """
+    Schema for a user's spending insights.
+    \n- `receipt_count`: The number of receipts.
+    \n- `total_spent`: The sum of all receipt totals.
+    \n- `total_percentiles`: Percentiles of receipt totals (`p10` ... `p99`); `p50` is the median basket value.
+    \n- `median_basket_items`: The median number of units per receipt.
+    \n- `top_products`: The products the user spent the most on.
+    \n- `heatmap`: Receipt counts by weekday (Monday first) and hour of day (UTC).
+    """
+
+    receipt_count: int
+    total_spent: float
+    total_percentiles: Dict[str, float]
+    median_basket_items: float
+    top_products: List[TopProduct]
+    heatmap: List[List[int]]
+
+
+class BestSeller(BaseModel):
+    """
+    Schema for a product in the best sellers leaderboard.
+    \n- `name`: The name of the product.
+    \n- `price`: The price of a single unit of the product.
+    \n- `quantity`: The number of units sold in the window.
+    \n- `revenue`: The amount the units sold for.
+    """
+
+    name: str
+    price: float
+    quantity: int
+    revenue: float
+
+
+class ProductLeaderboard(BaseModel):
+    """
+    Schema for the best-selling products of a time window.
+    \n- `window`: `hour`, `day` or `all`.
+    \n- `since`: The start of the current hour or day (UTC); null for `all`.
+    \n- `products`: The best sellers, most units sold first.
+    """
+
+    window: str
+    since: Optional[datetime] = None
+    products: List[BestSeller]
+
+
+class ProductSuggestion(BaseModel):
+    """
+    Schema for a product suggested for a name prefix.
+    \n- `name`: The name of the product.
+    \n- `price`: The price of a single unit of the product.
+    \n- `quantity`: The number of units sold so far.
+    """
+
+    name: str
+    price: float
+    quantity: int
+
+
+class ProductSuggestions(BaseModel):
+    """
+    Schema for the products whose names start with a prefix.
+    \n- `prefix`: The prefix as requested.
+    \n- `products`: The matching products, most units sold first.
+    """
+
+    prefix: str
+    products: List[ProductSuggestion]
+
+
+class ImportLineError(BaseModel):
+    """
+    Schema for a line of an import that was rejected.
+    \n- `line`: The line number in the uploaded file, starting at 1.
+    \n- `detail`: Why the line was rejected.
+    """
+
+    line: int
+    detail: str
+
+    class Config:
+        from_attributes = True
+
+
+class ImportJobOut(BaseModel):
+    """
+    Schema for a receipt import job.
+    \n- `status`: `created`, `running`, `interrupted` (upload stopped early), `failed` (unreadable upload) or `completed`.
+    \n- `lines_committed`: The number of lines processed; a resumed upload skips these.
+    \n- `receipts_imported`: The number of receipts saved.
+    \n- `error_count`: The number of rejected lines.
+    \n- `errors`: The rejected lines, up to a server-side limit.
+    """
+
+    id: int
+    status: str
+    lines_committed: int
+    receipts_imported: int
+    error_count: int
+    errors: List[ImportLineError] = []
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class ProfileSummary(BaseModel):
+    """
+    Schema for a stored request profile.
+    \n- `route`: The route path template the request matched.
+    \n- `path`: The requested URL path.
+    \n- `duration_ms`: The request's wall time while profiled, in milliseconds.
+    \n- `trigger`: `token` (signed `X-Profile-Token` header) or `sample` (PROFILE_SAMPLE_RATE).
+    """
+
+    id: str
+    method: str
+    route: str
+    path: str
+    status_code: int
+    duration_ms: float
+    trigger: str
+    created_at: datetime
+
+
+class ChangeOut(BaseModel):
+    """
+    Schema for one entry of the receipt change log.
+    \n- `offset`: Position in the shard's change log; offsets only grow.
+    \n- `kind`: `created` or `deleted`.
+    \n- `receipt_id`: The public id of the receipt.
+    \n- `receipt`: The receipt as created; null for deletions.
+    """
+
+    offset: int
+    kind: str
+    receipt_id: int
+    user_id: int
+    changed_at: datetime
+    receipt: Optional[ReceiptOut] = None
+
+
+class ChangeBatch(BaseModel):
+    """
+    Schema for a batch of the receipt change log.
+    \n- `after`: The offset the batch starts after.
+    \n- `next_after`: The offset to request the next batch after, and to checkpoint once the batch is processed.
+    \n- `has_more`: Whether more changes follow right away.
+    """
+
+    shard: int
+    after: int
+    next_after: int
+    has_more: bool
+    changes: List[ChangeOut]
+
+
+class ChangeCheckpointUpdate(BaseModel):
+    """
+    Schema for storing a consumer's checkpoint.
+    \n- `offset`: The offset up to which the consumer has processed the changes.
+    """
+
+    offset: int
+
+
+class ChangeCheckpoint(BaseModel):
+    """
+    Schema for a consumer's checkpoint in the change log of one shard.
+    \n- `offset`: The checkpointed offset; 0 when none is stored.
+    \n- `compacted_offset`: Changes up to this offset have been deleted.
+    """
+
+    shard: int
+    consumer: str
+    offset: int
+    compacted_offset: int
@@ -0,0 +1,309 @@
+import csv
+import io
+import itertools
+import math
+import random
+import time
+from contextlib import ExitStack
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional
+import bcrypt
+from sqlalchemy import create_engine, func, select, text
+from sqlalchemy.engine import Connection, Engine
+from app.models import Product, Receipt, User, receipt_product
+from app.revocation import utcnow
+from app.sharding import ShardRouter, shard_router
+
+SEED_PASSWORD = "password"
+
+ADJECTIVES = """
+    fresh organic large small red green sweet salted smoked frozen whole sliced
+    dark light spicy classic premium local baked roasted
+""".split()
+NOUNS = """
+    apples bread milk cheese coffee tea soap rice pasta butter yogurt juice water
+    chicken beans eggs tomatoes potatoes chocolate cookies sausage salmon honey
+    oats flour sugar salt pepper onions carrots
+""".split()
+FIRST_NAMES = ["Olena", "Ivan", "Maria", "Petro", "Anna", "Taras"]
+SURNAMES = ["Shevchenko", "Kovalenko", "Bondarenko", "Tkachenko"]
+
+USER_COLUMNS = [
+    "id",
+    "username",
+    "hashed_password",
+    "name",
+    "surname",
+    "receipt_count",
+    "shard",
+]
+PRODUCT_COLUMNS = ["id", "name", "price"]
+RECEIPT_COLUMNS = [
+    "id",
+    "total",
+    "created_at",
+    "payment_type",
+    "payment_amount",
+    "user_id",
+]
+LINE_ITEM_COLUMNS = ["receipt_id", "product_id", "quantity"]
+
+# Relative share of receipts per hour of day: closed at night, peaks at lunch
+# and in the evening.
+HOUR_WEIGHTS = [0] * 6 + [1, 2, 4, 5, 6, 8, 10, 9, 7, 6, 7, 9, 10, 8, 5, 3, 1, 0]
+
+
+@dataclass
+class SeedOptions:
+    users: int = 1000
+    products: int = 10000
+    receipts: int = 100000
+    basket_mean: float = 4.0
+    basket_max: int = 30
+    zipf_exponent: float = 1.1
+    days: int = 365
+    end: Optional[datetime] = None
+    cash_share: float = 0.4
+    seed: int = 42
+    batch_size: int = 10000
+
+
+def zipf_cum_weights(n: int, exponent: float) -> List[float]:
+    return list(
+        itertools.accumulate(1.0 / (rank**exponent) for rank in range(1, n + 1))
+    )
+
+
+def seed_password_hash(rng: random.Random) -> str:
+    # bcrypt with a salt drawn from the seeded generator, so the output is
+    # reproducible and only one hash has to be computed for all users.
+    alphabet = "./ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+    salt = "$2b$12$" + "".join(rng.choice(alphabet) for _ in range(21)) + "e"
+    return bcrypt.hashpw(SEED_PASSWORD.encode(), salt.encode()).decode()
+
+
+class ExecuteManyWriter:
+    """Writes rows with DBAPI executemany (used for SQLite and other backends)."""
+
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        if connection.dialect.name == "sqlite":
+            connection.exec_driver_sql("PRAGMA synchronous=OFF")
+
+    def write(self, table, columns: List[str], rows: List[tuple]):
+        if rows:
+            self.connection.execute(
+                table.insert(), [dict(zip(columns, row)) for row in rows]
+            )
+
+    def finish(self, tables):
+        pass
+
+
+class CopyWriter:
+    """Writes rows with PostgreSQL COPY ... FROM STDIN."""
+
+    def __init__(self, connection: Connection):
+        self.connection = connection
+
+    def write(self, table, columns: List[str], rows: List[tuple]):
+        if not rows:
+            return
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        cursor = self.connection.connection.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+                buffer,
+            )
+        finally:
+            cursor.close()
+
+    def finish(self, tables):
+        # Explicit ids were copied in; move the serial sequences past them.
+        for table in tables:
+            self.connection.exec_driver_sql(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"(SELECT COALESCE(MAX(id), 1) FROM {table.name}))"
+            )
+
+
+def next_id(connection: Connection, model) -> int:
+    return (connection.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def generate_receipts(
+    rng: random.Random,
+    options: SeedOptions,
+    first_receipt_id: int,
+    user_ids: List[int],
+    product_ids: List[int],
+    prices: dict,
+) -> Iterator[tuple]:
+    """
+    Yield `(receipt row, line item rows)` in id order.
+
+    Products are drawn by Zipfian popularity, users by a flatter Zipf so some
+    customers shop far more often than others. Receipts are spread evenly over
+    `days` days ending at `end`, with hours following HOUR_WEIGHTS.
+    """
+    product_weights = zipf_cum_weights(len(product_ids), options.zipf_exponent)
+    user_weights = zipf_cum_weights(len(user_ids), 0.5)
+    hour_weights = list(itertools.accumulate(HOUR_WEIGHTS))
+    start = options.end - timedelta(days=options.days)
+    extra_items = max(options.basket_mean - 1, 0.01)
+
+    for offset in range(options.receipts):
+        receipt_id = first_receipt_id + offset
+        basket_size = min(options.basket_max, 1 + int(rng.expovariate(1 / extra_items)))
+        basket = {}
+        for product_id in rng.choices(
+            product_ids, cum_weights=product_weights, k=basket_size
+        ):
+            quantity = 1 + int(rng.expovariate(2.0))
+            basket[product_id] = basket.get(product_id, 0) + quantity
+
+        total = round(sum(prices[p] * q for p, q in basket.items()), 2)
+        if rng.random() < options.cash_share:
+            payment_type = "cash"
+            payment_amount = float(math.ceil(total / 10) * 10)
+        else:
+            payment_type = "cashless"
+            payment_amount = total
+
+        day = start + timedelta(days=offset * options.days // options.receipts)
+        created_at = day + timedelta(
+            hours=rng.choices(range(24), cum_weights=hour_weights)[0],
+            seconds=rng.randrange(3600),
+        )
+        user_id = rng.choices(user_ids, cum_weights=user_weights)[0]
+
+        yield (
+            (receipt_id, total, created_at, payment_type, payment_amount, user_id),
+            [(receipt_id, p, q) for p, q in basket.items()],
+        )
+
+
+def seed_database(
+    engine: Engine,
+    options: SeedOptions,
+    progress=None,
+    router: ShardRouter = shard_router,
+) -> dict:
+    """
+    Generate users, products, receipts and line items and bulk load them.
+
+    The same options and seed always produce the same rows. New rows get ids
+    after the ones already in the database, so seeding can be repeated. Users
+    are placed on shards by `router` like registered ones: `engine` is shard 0
+    and gets every user, and each shard gets the products, copies of its users
+    and their receipts, with ids following the shard's own.
+    """
+    rng = random.Random(options.seed)
+    if options.end is None:
+        options.end = datetime.combine(utcnow().date(), datetime.min.time())
+    started = time.perf_counter()
+    written = {"users": 0, "products": 0, "receipts": 0, "receipt_product": 0}
+
+    with ExitStack() as stack:
+        engines = [engine] + [create_engine(url) for url in router.urls]
+        for shard_engine in engines[1:]:
+            stack.callback(shard_engine.dispose)
+        connections = [stack.enter_context(e.begin()) for e in engines]
+        writers = [
+            (
+                CopyWriter(connection)
+                if connection.dialect.name == "postgresql"
+                else ExecuteManyWriter(connection)
+            )
+            for connection in connections
+        ]
+        connection, writer = connections[0], writers[0]
+
+        first_user_id = next_id(connection, User)
+        password_hash = seed_password_hash(rng)
+        user_ids = list(range(first_user_id, first_user_id + options.users))
+        user_shards = {user_id: router.shard_for(user_id) for user_id in user_ids}
+        for start in range(0, options.users, options.batch_size):
+            rows = [
+                (
+                    user_id,
+                    f"seed{options.seed}_user{user_id}",
+                    password_hash,
+                    rng.choice(FIRST_NAMES),
+                    rng.choice(SURNAMES),
+                    0,
+                    user_shards[user_id],
+                )
+                for user_id in user_ids[start : start + options.batch_size]
+            ]
+            writer.write(User.__table__, USER_COLUMNS, rows)
+            for shard in range(1, len(writers)):
+                # The copies the shard's receipts refer to.
+                writers[shard].write(
+                    User.__table__,
+                    USER_COLUMNS,
+                    [row for row in rows if row[-1] == shard],
+                )
+            written["users"] += len(rows)
+
+        first_product_id = max(next_id(c, Product) for c in connections)
+        product_ids = list(range(first_product_id, first_product_id + options.products))
+        prices = {}
+        for start in range(0, options.products, options.batch_size):
+            rows = []
+            for product_id in product_ids[start : start + options.batch_size]:
+                name = f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {product_id}"
+                price = round(rng.lognormvariate(1.5, 0.8), 2) or 0.01
+                prices[product_id] = price
+                rows.append((product_id, name, price))
+            for shard_writer in writers:
+                shard_writer.write(Product.__table__, PRODUCT_COLUMNS, rows)
+            written["products"] += len(rows)
+        # Popularity rank is independent of id order.
+        rng.shuffle(product_ids)
+
+        # Receipts are numbered in order here and given ids on their shard below.
+        receipts = generate_receipts(rng, options, 0, user_ids, product_ids, prices)
+        next_receipt_ids = [next_id(c, Receipt) for c in connections]
+        while True:
+            chunk = list(itertools.islice(receipts, options.batch_size))
+            if not chunk:
+                break
+            receipt_rows = [[] for _ in writers]
+            item_rows = [[] for _ in writers]
+            for receipt, items in chunk:
+                shard = user_shards[receipt[-1]]
+                receipt_id = next_receipt_ids[shard]
+                next_receipt_ids[shard] += 1
+                receipt_rows[shard].append((receipt_id,) + receipt[1:])
+                item_rows[shard].extend((receipt_id,) + item[1:] for item in items)
+            for shard, shard_writer in enumerate(writers):
+                shard_writer.write(
+                    Receipt.__table__, RECEIPT_COLUMNS, receipt_rows[shard]
+                )
+                shard_writer.write(receipt_product, LINE_ITEM_COLUMNS, item_rows[shard])
+            written["receipts"] += len(chunk)
+            written["receipt_product"] += sum(len(items) for _, items in chunk)
+            if progress:
+                progress(written, time.perf_counter() - started)
+
+        for shard_connection, shard_writer in zip(connections, writers):
+            shard_connection.execute(
+                text(
+                    """
+                    UPDATE users SET receipt_count = (
+                        SELECT COUNT(*) FROM receipts WHERE receipts.user_id = users.id
+                    )
+                    WHERE id >= :first_user_id
+                    """
+                ),
+                {"first_user_id": first_user_id},
+            )
+            shard_writer.finish([User.__table__, Product.__table__, Receipt.__table__])
+
+    written["seconds"] = round(time.perf_counter() - started, 2)
+    return written
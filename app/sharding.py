@@ -0,0 +1,557 @@
+import bisect
+import hashlib
+import threading
+import time
+from collections import deque
+from typing import List, Optional
+from fastapi import Depends
+from sqlalchemy import bindparam, create_engine, delete, insert, select, update
+from sqlalchemy.orm import Session, sessionmaker
+from app.auth import get_current_user
+from app.config import settings
+from app.database import SessionLocal, get_db
+from app.invalidation import bus
+from app.models import (
+    ImportJob,
+    ImportJobError,
+    ImportJobForward,
+    Product,
+    Receipt,
+    ReceiptForward,
+    User,
+    receipt_product,
+)
+
+# Public receipt and import job ids are `shard << SHARD_ID_BITS | id on the
+# shard`, so ids on shard 0 (the primary database) are unchanged.
+SHARD_ID_BITS = 40
+LOCAL_ID_MASK = (1 << SHARD_ID_BITS) - 1
+VIRTUAL_NODES = 128
+MOVE_BATCH_SIZE = 500
+
+
+def global_receipt_id(shard: int, local_id: int) -> int:
+    return (shard << SHARD_ID_BITS) | local_id
+
+
+def split_receipt_id(receipt_id: int) -> tuple:
+    """Return `(shard, id on the shard)` for a public receipt id."""
+    return receipt_id >> SHARD_ID_BITS, receipt_id & LOCAL_ID_MASK
+
+
+def ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring with virtual nodes. Adding a shard only moves keys
+    from the existing shards to the new one, about 1/N of them.
+    """
+
+    def __init__(self, shards: int, virtual_nodes: int = VIRTUAL_NODES):
+        points = sorted(
+            (ring_hash(f"shard-{shard}-{node}"), shard)
+            for shard in range(shards)
+            for node in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, key) -> int:
+        index = bisect.bisect(self._hashes, ring_hash(str(key)))
+        return self._shards[index % len(self._hashes)]
+
+
+class ShardRouter:
+    """
+    Database sessions per shard. Shard 0 is the primary database, which also
+    holds the users, refresh token revocations and receipt forwarding table;
+    `urls` are the databases of shards 1..N-1.
+
+    New users are placed by the hash ring; after that `users.shard` is the
+    source of truth, so changing the shard list only takes effect for existing
+    users once `rebalance` has moved them.
+    """
+
+    def __init__(self, urls: List[str], primary: sessionmaker = SessionLocal):
+        self.primary = primary
+        self._factories = {}
+        self._copied_users = set()
+        self._lock = threading.Lock()
+        self.configure(urls)
+
+    def configure(self, urls: List[str], primary: sessionmaker = None):
+        self.dispose()
+        if primary is not None:
+            self.primary = primary
+        self.urls = list(urls)
+        self.ring = HashRing(self.count)
+
+    @property
+    def count(self) -> int:
+        return len(self.urls) + 1
+
+    def shard_for(self, user_id: int) -> int:
+        return self.ring.shard_for(user_id)
+
+    def session(self, shard: int) -> Session:
+        if shard == 0:
+            return self.primary()
+        if not 0 < shard < self.count:
+            raise ValueError(f"Shard {shard} is not configured")
+        factory = self._factories.get(shard)
+        if factory is None:
+            with self._lock:
+                factory = self._factories.get(shard)
+                if factory is None:
+                    factory = sessionmaker(
+                        autocommit=False,
+                        autoflush=False,
+                        bind=create_engine(self.urls[shard - 1]),
+                    )
+                    self._factories[shard] = factory
+        return factory()
+
+    def copy_user(self, db: Session, shard: int, user: User):
+        """Make sure the shard has a copy of the user row its receipts refer to."""
+        if (shard, user.id) in self._copied_users:
+            return
+        if db.get(User, user.id) is None:
+            db.add(
+                User(
+                    id=user.id,
+                    username=user.username,
+                    hashed_password=user.hashed_password,
+                    name=user.name,
+                    surname=user.surname,
+                    shard=shard,
+                )
+            )
+            db.commit()
+        self._copied_users.add((shard, user.id))
+
+    def dispose(self):
+        with self._lock:
+            for factory in self._factories.values():
+                factory.kw["bind"].dispose()
+            self._factories = {}
+            self._copied_users = set()
+
+
+def parse_urls(value: str) -> List[str]:
+    return [url.strip() for url in value.split(",") if url.strip()]
+
+
+shard_router = ShardRouter(parse_urls(settings.SHARD_DATABASE_URLS))
+
+
+def shard_session(db: Session, shard: int, user: User):
+    """Yield `db` for shard 0, else a session on `shard` with a copy of `user`."""
+    if not shard:
+        yield db
+        return
+    shard_db = shard_router.session(shard)
+    try:
+        shard_router.copy_user(shard_db, shard, user)
+        yield shard_db
+    finally:
+        shard_db.close()
+
+
+def get_shard_db(
+    current_user: User = Depends(get_current_user), db: Session = Depends(get_db)
+):
+    """Session on the shard holding the current user's receipts."""
+    yield from shard_session(db, current_user.shard, current_user)
+
+
+def copy_receipts(
+    source: Session,
+    target: Session,
+    user_id: int,
+    after_id: int,
+    products: dict,
+    batch_size: int,
+    ids: Optional[List[int]] = None,
+) -> List[tuple]:
+    """
+    Copy the next batch of the user's receipts with ids above `after_id`, or
+    the ones in `ids`, and return `(old id, new id)` pairs. `products` maps
+    `(name, price)` to product ids on the target and is filled as products are
+    looked up or created.
+    """
+    query = select(
+        Receipt.id,
+        Receipt.total,
+        Receipt.created_at,
+        Receipt.payment_type,
+        Receipt.payment_amount,
+    ).where(Receipt.user_id == user_id, Receipt.id > after_id)
+    if ids is not None:
+        query = query.where(Receipt.id.in_(ids))
+    receipts = source.execute(query.order_by(Receipt.id).limit(batch_size)).all()
+    if not receipts:
+        return []
+
+    old_ids = [receipt.id for receipt in receipts]
+    items = source.execute(
+        select(
+            receipt_product.c.receipt_id,
+            receipt_product.c.quantity,
+            Product.name,
+            Product.price,
+        )
+        .join(Product, Product.id == receipt_product.c.product_id)
+        .where(receipt_product.c.receipt_id.in_(old_ids))
+    ).all()
+
+    for key in {(item.name, item.price) for item in items} - products.keys():
+        product_id = target.execute(
+            select(Product.id)
+            .where(Product.name == key[0], Product.price == key[1])
+            .limit(1)
+        ).scalar()
+        if product_id is None:
+            product_id = target.execute(
+                insert(Product).values(name=key[0], price=key[1]).returning(Product.id)
+            ).scalar()
+        products[key] = product_id
+
+    new_ids = target.execute(
+        insert(Receipt).returning(Receipt.id, sort_by_parameter_order=True),
+        [
+            {
+                "total": receipt.total,
+                "created_at": receipt.created_at,
+                "payment_type": receipt.payment_type,
+                "payment_amount": receipt.payment_amount,
+                "user_id": user_id,
+            }
+            for receipt in receipts
+        ],
+    ).scalars()
+    pairs = list(zip(old_ids, new_ids))
+    renumbered = dict(pairs)
+    if items:
+        target.execute(
+            receipt_product.insert(),
+            [
+                {
+                    "receipt_id": renumbered[item.receipt_id],
+                    "product_id": products[(item.name, item.price)],
+                    "quantity": item.quantity,
+                }
+                for item in items
+            ],
+        )
+    return pairs
+
+
+def delete_user_receipts(db: Session, user_id: int, only: Optional[List[int]] = None):
+    ids = select(Receipt.id).where(Receipt.user_id == user_id)
+    if only is not None:
+        ids = ids.where(Receipt.id.in_(only))
+    db.execute(delete(receipt_product).where(receipt_product.c.receipt_id.in_(ids)))
+    db.execute(delete(Receipt).where(Receipt.id.in_(ids)))
+
+
+def copy_import_jobs(source: Session, target: Session, user_id: int) -> List[tuple]:
+    """
+    Copy the user's import jobs and their rejected lines and return
+    `(old id, new id)` pairs.
+    """
+    jobs = source.execute(
+        select(ImportJob.__table__).where(ImportJob.user_id == user_id)
+    ).all()
+    if not jobs:
+        return []
+
+    old_ids = [job.id for job in jobs]
+    new_ids = target.execute(
+        insert(ImportJob).returning(ImportJob.id, sort_by_parameter_order=True),
+        [
+            {key: value for key, value in job._mapping.items() if key != "id"}
+            for job in jobs
+        ],
+    ).scalars()
+    pairs = list(zip(old_ids, new_ids))
+    renumbered = dict(pairs)
+    errors = source.execute(
+        select(ImportJobError.__table__).where(ImportJobError.job_id.in_(old_ids))
+    ).all()
+    if errors:
+        target.execute(
+            insert(ImportJobError),
+            [
+                {
+                    "job_id": renumbered[error.job_id],
+                    "line": error.line,
+                    "detail": error.detail,
+                }
+                for error in errors
+            ],
+        )
+    return pairs
+
+
+def delete_user_import_jobs(db: Session, user_id: int):
+    ids = select(ImportJob.id).where(ImportJob.user_id == user_id)
+    db.execute(delete(ImportJobError).where(ImportJobError.job_id.in_(ids)))
+    db.execute(delete(ImportJob).where(ImportJob.user_id == user_id))
+
+
+def forward_ids(primary: Session, model, source: int, target: int, pairs: List[tuple]):
+    """
+    Record in `model`'s table where moved receipts or import jobs went.
+    Forwards that pointed at the moved ids are redirected too, so every lookup
+    takes at most one hop.
+    """
+    forwards = [
+        {
+            "b_old": global_receipt_id(source, old_id),
+            "b_new": global_receipt_id(target, new_id),
+        }
+        for old_id, new_id in pairs
+    ]
+    table = model.__table__
+    primary.execute(
+        table.delete().where(table.c.old_id.in_([f["b_old"] for f in forwards]))
+    )
+    primary.execute(
+        table.update()
+        .where(table.c.new_id == bindparam("b_old"))
+        .values(new_id=bindparam("b_new")),
+        forwards,
+    )
+    primary.execute(
+        table.insert().values(old_id=bindparam("b_old"), new_id=bindparam("b_new")),
+        forwards,
+    )
+
+
+class UserMove:
+    """
+    Moves a user's receipts and import jobs to another shard in two steps.
+
+    `switch` copies the receipts in batches, each committed on the target
+    before its forwards are committed on the primary, and once the copy has
+    caught up points the user at the new shard. Workers that have not seen the
+    switch yet keep writing to the old shard until their cached user expires,
+    so `finish` waits `settle_seconds` (USER_CACHE_TTL by default) after the
+    switch before copying every receipt still on the old shard and deleting
+    them there. The import jobs move last, and until then their old ids are
+    still found on the old shard. A move interrupted before the switch is
+    simply started over.
+    """
+
+    def __init__(
+        self,
+        router: ShardRouter,
+        user_id: int,
+        target: int,
+        batch_size: int = None,
+        settle_seconds: float = None,
+    ):
+        self.router = router
+        self.user_id = user_id
+        self.target = target
+        self.batch_size = batch_size or MOVE_BATCH_SIZE
+        self.settle_seconds = (
+            settings.USER_CACHE_TTL if settle_seconds is None else settle_seconds
+        )
+        self.source = None
+        self.moved = 0
+        self.switched_at = None
+        self._copied = set()
+        self._products = {}
+
+    def _copy(self, primary: Session, source_db: Session, target_db: Session, **kw):
+        pairs = copy_receipts(
+            source_db, target_db, self.user_id, products=self._products, **kw
+        )
+        if pairs:
+            target_db.commit()
+            forward_ids(primary, ReceiptForward, self.source, self.target, pairs)
+            primary.commit()
+            self._copied.update(old_id for old_id, _ in pairs)
+            self.moved += len(pairs)
+        return pairs
+
+    def switch(self) -> bool:
+        """Copy the receipts and switch the user; False if already on the target."""
+        primary = self.router.session(0)
+        source_db = target_db = None
+        try:
+            user = primary.get(User, self.user_id)
+            self.source = user.shard
+            if self.source == self.target:
+                return False
+            source_db = self.router.session(self.source)
+            target_db = self.router.session(self.target)
+
+            # Leftovers of an interrupted move.
+            delete_user_receipts(target_db, self.user_id)
+            delete_user_import_jobs(target_db, self.user_id)
+            if target_db.get(User, self.user_id) is None:
+                self.router.copy_user(target_db, self.target, user)
+            target_db.execute(
+                update(User).where(User.id == self.user_id).values(receipt_count=0)
+            )
+            target_db.commit()
+
+            watermark = 0
+            while pairs := self._copy(
+                primary,
+                source_db,
+                target_db,
+                after_id=watermark,
+                batch_size=self.batch_size,
+            ):
+                watermark = pairs[-1][0]
+
+            primary.execute(
+                update(User).where(User.id == self.user_id).values(shard=self.target)
+            )
+            primary.commit()
+            self.switched_at = time.monotonic()
+            bus.publish("users", user.username)
+            bus.publish("receipt_counts", self.user_id)
+            bus.publish("insights", self.user_id)
+            return True
+        finally:
+            for db in (primary, source_db, target_db):
+                if db is not None:
+                    db.close()
+
+    def finish(self) -> int:
+        """
+        Wait for writers to the old shard, move what is left there and return
+        how many receipts were moved in total.
+        """
+        time.sleep(max(0.0, self.switched_at + self.settle_seconds - time.monotonic()))
+        primary = self.router.session(0)
+        source_db = self.router.session(self.source)
+        target_db = self.router.session(self.target)
+        try:
+            while True:
+                # Receipts committed late can have lower ids than copied ones.
+                ids = (
+                    source_db.execute(
+                        select(Receipt.id).where(Receipt.user_id == self.user_id)
+                    )
+                    .scalars()
+                    .all()
+                )
+                if not ids:
+                    break
+                missing = [i for i in ids if i not in self._copied]
+                for start in range(0, len(missing), self.batch_size):
+                    self._copy(
+                        primary,
+                        source_db,
+                        target_db,
+                        after_id=0,
+                        batch_size=self.batch_size,
+                        ids=missing[start : start + self.batch_size],
+                    )
+                for start in range(0, len(ids), self.batch_size):
+                    delete_user_receipts(
+                        source_db,
+                        self.user_id,
+                        only=ids[start : start + self.batch_size],
+                    )
+                source_db.commit()
+
+            # The counter also counts archived receipts and the receipts written
+            # to the old shard after the switch, so carry it over.
+            count = source_db.execute(
+                select(User.receipt_count).where(User.id == self.user_id)
+            ).scalar()
+            source_db.execute(
+                update(User)
+                .where(User.id == self.user_id)
+                .values(receipt_count=User.receipt_count - (count or 0))
+            )
+            source_db.commit()
+            target_db.execute(
+                update(User)
+                .where(User.id == self.user_id)
+                .values(receipt_count=User.receipt_count + (count or 0))
+            )
+            target_db.commit()
+
+            pairs = copy_import_jobs(source_db, target_db, self.user_id)
+            if pairs:
+                target_db.commit()
+                forward_ids(primary, ImportJobForward, self.source, self.target, pairs)
+                primary.commit()
+                delete_user_import_jobs(source_db, self.user_id)
+                source_db.commit()
+            bus.publish("receipt_counts", self.user_id)
+            return self.moved
+        finally:
+            for db in (primary, source_db, target_db):
+                db.close()
+
+
+def move_user(
+    router: ShardRouter,
+    user_id: int,
+    target: int,
+    batch_size: int = None,
+    settle_seconds: float = None,
+) -> int:
+    """Move a user's receipts to `target` and return how many were moved."""
+    move = UserMove(router, user_id, target, batch_size, settle_seconds)
+    if not move.switch():
+        return 0
+    return move.finish()
+
+
+def rebalance(
+    router: ShardRouter,
+    dry_run: bool = False,
+    batch_size: int = None,
+    progress=None,
+    settle_seconds: float = None,
+) -> dict:
+    """
+    Move every user whose shard differs from the hash ring's placement. Users
+    are switched one after another and each move is finished once its settle
+    time has passed, so the waits overlap.
+    """
+    primary = router.session(0)
+    try:
+        misplaced = [
+            (user_id, shard, router.shard_for(user_id))
+            for user_id, shard in primary.execute(
+                select(User.id, User.shard).order_by(User.id)
+            )
+            if router.shard_for(user_id) != shard
+        ]
+    finally:
+        primary.close()
+
+    result = {"users": len(misplaced), "receipts": 0}
+    if dry_run:
+        return result
+
+    def finish(move: UserMove):
+        moved = move.finish()
+        result["receipts"] += moved
+        if progress:
+            progress(move.user_id, move.source, move.target, moved)
+
+    switched = deque()
+    for user_id, _, target in misplaced:
+        move = UserMove(router, user_id, target, batch_size, settle_seconds)
+        if move.switch():
+            switched.append(move)
+        while switched and (
+            switched[0].switched_at + switched[0].settle_seconds <= time.monotonic()
+        ):
+            finish(switched.popleft())
+    while switched:
+        finish(switched.popleft())
+    return result
@@ -0,0 +1,283 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from typing import Callable, List, Tuple
+from starlette.concurrency import run_in_threadpool
+from app.config import settings
+from app.invalidation import bus
+from app.schemas import ReceiptOut
+
+RETRY_MILLISECONDS = 3000
+# Ids of sent events remembered per stream to drop duplicates.
+MAX_SENT_IDS = 1024
+
+
+class Subscription:
+    """
+    Receipts waiting to be sent on one stream. Events may be pushed from any
+    thread and are handed to the stream's event loop. At most `max_events` are
+    buffered; a consumer that falls further behind is marked `overflowed` and
+    disconnected, and resumes from the database with `Last-Event-ID`.
+    """
+
+    def __init__(self, user_id: int, loop: asyncio.AbstractEventLoop, max_events: int):
+        self.user_id = user_id
+        self.loop = loop
+        self.max_events = max_events
+        self.events = deque()
+        self.catch_up = False
+        self.overflowed = False
+        self._wake = asyncio.Event()
+
+    def push(self, event: Tuple[int, str]):
+        self._call(self._push, event)
+
+    def nudge(self):
+        """Ask the stream to look for new receipts in the database."""
+        self._call(self._nudge)
+
+    def _call(self, callback, *args):
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            pass  # The loop has been closed.
+
+    def _push(self, event):
+        if self.overflowed:
+            return
+        if len(self.events) >= self.max_events:
+            self.overflowed = True
+            self.events.clear()
+        else:
+            self.events.append(event)
+        self._wake.set()
+
+    def _nudge(self):
+        self.catch_up = True
+        self._wake.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """Wait for events or a nudge; return False after `timeout` seconds."""
+        if not (self.events or self.catch_up or self.overflowed):
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        self._wake.clear()
+        return True
+
+
+class StreamWatchers:
+    """
+    Users with open streams in any worker, learnt from the "stream_subscribers"
+    topic of the invalidation bus. Streams announce their user when they start
+    and then every STREAM_HEARTBEAT_SECONDS, so entries expire after a few
+    missed announcements. After missed messages (a cleared topic) every user
+    counts as watched for as long.
+    """
+
+    def __init__(self):
+        self._expiry = OrderedDict()
+        self._all_until = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def ttl() -> float:
+        return 3 * settings.STREAM_HEARTBEAT_SECONDS
+
+    def __contains__(self, user_id) -> bool:
+        now = time.monotonic()
+        if now < self._all_until:
+            return True
+        with self._lock:
+            expiry = self._expiry.get(user_id)
+        return expiry is not None and expiry > now
+
+    def evict(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            self._expiry[user_id] = now + self.ttl()
+            self._expiry.move_to_end(user_id)
+            while self._expiry and next(iter(self._expiry.values())) <= now:
+                self._expiry.popitem(last=False)
+
+    def clear(self):
+        self._all_until = time.monotonic() + self.ttl()
+
+    def cap_ttl(self, seconds):
+        pass
+
+
+class ReceiptBroker:
+    """
+    In-process fan-out of new receipts to their user's open streams.
+
+    Receipts created in this worker are pushed with their content. Receipts
+    created by other workers only arrive as a user id on the "receipt_streams"
+    topic of the invalidation bus, which makes the user's streams catch up from
+    the database; a cleared topic makes every stream catch up. User ids are
+    only published there while some worker has a stream open for the user.
+    """
+
+    def __init__(self, max_events: int):
+        self.max_events = max_events
+        self.watchers = StreamWatchers()
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+        self._announcing = threading.local()
+
+    def subscribe(self, user_id: int) -> Subscription:
+        """Register a stream; call from the event loop that serves it."""
+        subscription = Subscription(
+            user_id, asyncio.get_running_loop(), self.max_events
+        )
+        with self._lock:
+            self._subscriptions[user_id].add(subscription)
+        self.watch(user_id)
+        return subscription
+
+    def watch(self, user_id: int):
+        """Tell every worker that the user has an open stream."""
+        bus.publish("stream_subscribers", user_id)
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def subscriptions(self, user_id: int) -> List[Subscription]:
+        with self._lock:
+            return list(self._subscriptions.get(user_id, ()))
+
+    def all_subscriptions(self) -> List[Subscription]:
+        with self._lock:
+            return [s for group in self._subscriptions.values() for s in group]
+
+    def publish(self, user_id: int, receipt: dict):
+        """Send a committed receipt, as returned by `create_receipt`."""
+        subscriptions = self.subscriptions(user_id)
+        if subscriptions:
+            event = (
+                receipt["id"],
+                ReceiptOut.model_validate(receipt).model_dump_json(),
+            )
+            for subscription in subscriptions:
+                subscription.push(event)
+        self._announce(user_id)
+
+    def notify(self, user_id: int):
+        """Receipts were committed for the user without their content at hand."""
+        for subscription in self.subscriptions(user_id):
+            subscription.nudge()
+        self._announce(user_id)
+
+    def _announce(self, user_id: int):
+        if user_id not in self.watchers:
+            return
+        # The bus also delivers to this process; `evict` ignores that copy.
+        self._announcing.active = True
+        try:
+            bus.publish("receipt_streams", user_id)
+        finally:
+            self._announcing.active = False
+
+    def evict(self, user_id):
+        if not getattr(self._announcing, "active", False):
+            for subscription in self.subscriptions(user_id):
+                subscription.nudge()
+
+    def clear(self):
+        for subscription in self.all_subscriptions():
+            subscription.nudge()
+
+    def cap_ttl(self, seconds):
+        pass
+
+
+receipt_broker = ReceiptBroker(max_events=settings.STREAM_QUEUE_SIZE)
+# A clear of these topics would nudge, or publish for, every stream at once.
+bus.subscribe("receipt_streams", receipt_broker, never_clear=True)
+bus.subscribe("stream_subscribers", receipt_broker.watchers, never_clear=True)
+
+
+def server_sent_event(event_id: int, data: str) -> str:
+    return f"id: {event_id}\nevent: receipt\ndata: {data}\n\n"
+
+
+async def receipt_events(
+    user_id: int,
+    start: Callable[[], Tuple[int, bool]],
+    fetch: Callable[[int], List[Tuple[int, str]]],
+):
+    """
+    Server-sent events with the user's new receipts.
+
+    `start()` returns the receipt id to continue after and whether receipts
+    after it should be replayed. `fetch(after_id)` returns up to
+    STREAM_REPLAY_BATCH `(receipt id, JSON)` pairs of the user's receipts after
+    `after_id` from the database. Both run in a worker thread, only when the
+    stream starts or is nudged, so an idle stream holds no database connection.
+    The stream ends after STREAM_MAX_SECONDS, and clients reconnect with
+    `Last-Event-ID`.
+
+    Other workers only announce the user's receipts while the bus tells them
+    about the stream, so it is announced every STREAM_HEARTBEAT_SECONDS, and
+    the first time it also catches up with what they committed before.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.STREAM_MAX_SECONDS
+    watch_at = loop.time() + settings.STREAM_HEARTBEAT_SECONDS
+    rechecked = False
+    sent = OrderedDict()
+
+    def fresh(event_id: int) -> bool:
+        if event_id in sent:
+            return False
+        sent[event_id] = None
+        if len(sent) > MAX_SENT_IDS:
+            sent.popitem(last=False)
+        return True
+
+    # Subscribe before reading the start so no receipt falls in between.
+    subscription = receipt_broker.subscribe(user_id)
+    try:
+        watermark, replay = await run_in_threadpool(start)
+        yield f"retry: {RETRY_MILLISECONDS}\n\n"
+        while True:
+            if loop.time() >= watch_at:
+                watch_at = loop.time() + settings.STREAM_HEARTBEAT_SECONDS
+                receipt_broker.watch(user_id)
+                if not rechecked:
+                    rechecked = subscription.catch_up = True
+            if replay or subscription.catch_up:
+                replay = subscription.catch_up = False
+                while True:
+                    events = await run_in_threadpool(fetch, watermark)
+                    for event_id, data in events:
+                        watermark = max(watermark, event_id)
+                        if fresh(event_id):
+                            yield server_sent_event(event_id, data)
+                    if len(events) < settings.STREAM_REPLAY_BATCH:
+                        break
+
+            while subscription.events:
+                event_id, data = subscription.events.popleft()
+                watermark = max(watermark, event_id)
+                if fresh(event_id):
+                    yield server_sent_event(event_id, data)
+
+            if subscription.overflowed:
+                return
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            if not await subscription.wait(
+                min(settings.STREAM_HEARTBEAT_SECONDS, remaining)
+            ):
+                yield ": heartbeat\n\n"
+    finally:
+        receipt_broker.unsubscribe(subscription)
@@ -0,0 +1,301 @@
+import bisect
+import logging
+import threading
+import time
+from typing import Iterable, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+from app.cache import TTLCache
+from app.config import settings
+from app.database import SessionLocal
+from app.leaderboard import ALL_TIME
+from app.models import Product, ProductSales
+from app.sharding import shard_router
+
+logger = logging.getLogger(__name__)
+
+# Largest `k` served.
+SUGGEST_LIMIT = 50
+# Prefixes up to this long match a large share of all products; their results
+# are cached for SUGGEST_CACHE_TTL seconds.
+SHORT_PREFIX = 2
+LOAD_CHUNK_SIZE = 10000
+
+
+def fold(name: str) -> str:
+    return name.casefold()
+
+
+class SortedProducts:
+    """
+    Products sorted by case-folded name, then price, in flat arrays: the names
+    as one UTF-8 blob with an offset array, and numpy arrays of prices and
+    units sold. One product takes about 24 bytes plus its name, instead of the
+    ~150 bytes of a tuple of Python objects. The products whose names start
+    with a prefix are a contiguous range, found by binary search.
+    """
+
+    def __init__(self, rows: Iterable[Tuple[str, float, int]]):
+        rows = sorted(rows, key=lambda row: (fold(row[0]), row[1]))
+        encoded = [name.encode() for name, _, _ in rows]
+        self.names = b"".join(encoded)
+        self.offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded], out=self.offsets[1:])
+        self.prices = np.array([price for _, price, _ in rows], dtype=np.float64)
+        self.usage = np.array([usage for _, _, usage in rows], dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.prices)
+
+    def name(self, i: int) -> str:
+        return self.names[self.offsets[i] : self.offsets[i + 1]].decode()
+
+    def _bisect(self, prefix: str, past_prefix: bool) -> int:
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key = fold(self.name(mid))
+            if key < prefix or (past_prefix and key.startswith(prefix)):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def prefix_range(self, prefix: str) -> Tuple[int, int]:
+        """The `[start, stop)` positions of names starting with folded `prefix`."""
+        return self._bisect(prefix, False), self._bisect(prefix, True)
+
+    def find(self, name: str, price: float) -> Optional[int]:
+        folded = fold(name)
+        i = self._bisect(folded, False)
+        while i < len(self) and fold(self.name(i)) == folded:
+            if self.prices[i] == price and self.name(i) == name:
+                return i
+            i += 1
+        return None
+
+    def top(self, start: int, stop: int, k: int) -> List[Tuple[str, float, int]]:
+        """The `k` most used products in `[start, stop)`; ties in name order."""
+        usage = self.usage[start:stop]
+        if len(usage) > k:
+            threshold = np.partition(usage, len(usage) - k)[len(usage) - k]
+            above = np.flatnonzero(usage > threshold)
+            tied = np.flatnonzero(usage == threshold)[: k - len(above)]
+            positions = np.sort(np.concatenate([above, tied]))
+        else:
+            positions = np.arange(len(usage))
+        return [
+            (self.name(start + i), float(self.prices[start + i]), int(usage[i]))
+            for i in positions
+        ]
+
+
+class ProductIndex:
+    """
+    Type-ahead over the `(name, price)` products of every shard, ranked by
+    units sold.
+
+    The bulk of the products is a `SortedProducts` built by `rebuild`, from the
+    products table of each shard and the all-time counts of `product_sales`.
+    Products this worker creates, and the ones `refresh` finds other workers
+    have created since, are kept in a small sorted list until the next rebuild.
+    Sales are added to the counts as they are recorded. A background thread
+    refreshes every `refresh_interval` seconds and rebuilds every
+    `rebuild_interval` seconds, which also drops deleted products and brings
+    in other workers' sales.
+    """
+
+    def __init__(
+        self,
+        refresh_interval: float,
+        rebuild_interval: float,
+        cache_ttl: float,
+        session_factory: sessionmaker = SessionLocal,
+    ):
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.session_factory = session_factory
+        self._base = SortedProducts([])
+        # Sorted (folded name, price, name) entries not in the base yet.
+        self._pending = []
+        # (name, price) -> units sold, for the pending entries
+        self._pending_usage = {}
+        # shard -> largest product id seen
+        self._max_ids = {}
+        self._cache = TTLCache(ttl=cache_ttl, maxsize=4096)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self) -> int:
+        return len(self._base) + len(self._pending)
+
+    def record(self, items: List[tuple]):
+        """Count the `(name, price, quantity)` items of a saved receipt."""
+        with self._lock:
+            # Inside the lock, so a sale is not counted in a base `load` replaces.
+            base = self._base
+            for name, price, quantity in items:
+                i = base.find(name, price)
+                if i is not None:
+                    base.usage[i] += quantity
+                else:
+                    self._add_pending(name, price, quantity)
+
+    def _add_pending(self, name: str, price: float, quantity: int):
+        key = (name, price)
+        if key not in self._pending_usage:
+            bisect.insort(self._pending, (fold(name), price, name))
+            self._pending_usage[key] = 0
+        self._pending_usage[key] += quantity
+
+    def suggest(self, prefix: str, k: int) -> List[dict]:
+        """Up to `k` products whose names start with `prefix`, most sold first."""
+        folded = fold(prefix)
+        short = len(folded) <= SHORT_PREFIX
+        if short:
+            cached = self._cache.get((folded, k))
+            if cached is not None:
+                return cached
+
+        base = self._base
+        start, stop = base.prefix_range(folded)
+        candidates = base.top(start, stop, k)
+        with self._lock:
+            i = bisect.bisect_left(self._pending, (folded,))
+            while i < len(self._pending) and self._pending[i][0].startswith(folded):
+                _, price, name = self._pending[i]
+                candidates.append((name, price, self._pending_usage[(name, price)]))
+                i += 1
+        candidates.sort(key=lambda c: (-c[2], fold(c[0]), c[1]))
+        result = [
+            {"name": name, "price": price, "quantity": quantity}
+            for name, price, quantity in candidates[:k]
+        ]
+        if short:
+            self._cache.set((folded, k), result)
+        return result
+
+    def _sessions(self):
+        for shard in range(shard_router.count):
+            if shard == 0:
+                yield shard, self.session_factory()
+            else:
+                yield shard, shard_router.session(shard)
+
+    def rebuild(self):
+        """Reload every product and its all-time units sold."""
+        products = {}
+        max_ids = {}
+        usage = {}
+        for shard, db in self._sessions():
+            try:
+                if shard == 0:
+                    sales = db.execute(
+                        select(
+                            ProductSales.name, ProductSales.price, ProductSales.quantity
+                        ).where(
+                            ProductSales.period == "all",
+                            ProductSales.started_at == ALL_TIME,
+                        )
+                    )
+                    usage = {(name, price): quantity for name, price, quantity in sales}
+                max_ids[shard] = db.execute(select(func.max(Product.id))).scalar() or 0
+                rows = db.execute(
+                    select(Product.name, Product.price)
+                    .where(Product.id <= max_ids[shard])
+                    .distinct()
+                    .execution_options(yield_per=LOAD_CHUNK_SIZE)
+                )
+                for name, price in rows:
+                    products[(name, price)] = usage.get((name, price), 0)
+            finally:
+                db.close()
+
+        self.load(products, max_ids)
+
+    def load(self, products: dict, max_ids: Optional[dict] = None):
+        """Replace the base with `(name, price) -> units sold`."""
+        base = SortedProducts(
+            (name, price, quantity) for (name, price), quantity in products.items()
+        )
+        with self._lock:
+            # Keep the products created while the base was loaded.
+            pending = [
+                (key, quantity)
+                for key, quantity in self._pending_usage.items()
+                if key not in products
+            ]
+            self._pending, self._pending_usage = [], {}
+            for (name, price), quantity in pending:
+                self._add_pending(name, price, quantity)
+            self._base = base
+            for shard, max_id in (max_ids or {}).items():
+                self._max_ids[shard] = max(self._max_ids.get(shard, 0), max_id)
+        self._cache.clear()
+
+    def refresh(self):
+        """Add the products created on any shard since the last look."""
+        for shard, db in self._sessions():
+            try:
+                after = self._max_ids.get(shard, 0)
+                rows = db.execute(
+                    select(Product.id, Product.name, Product.price)
+                    .where(Product.id > after)
+                    .order_by(Product.id)
+                ).all()
+            finally:
+                db.close()
+            if not rows:
+                continue
+            with self._lock:
+                base = self._base
+                for _, name, price in rows:
+                    if (name, price) not in self._pending_usage and (
+                        base.find(name, price) is None
+                    ):
+                        self._add_pending(name, price, 0)
+                self._max_ids[shard] = max(after, rows[-1][0])
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="product-index", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        rebuilt_at = None
+        while not self._stopped.is_set():
+            try:
+                now = time.monotonic()
+                if rebuilt_at is None or now - rebuilt_at >= self.rebuild_interval:
+                    self.rebuild()
+                    rebuilt_at = now
+                else:
+                    self.refresh()
+            except Exception:
+                logger.warning("Product index update failed", exc_info=True)
+            self._stopped.wait(self.refresh_interval)
+
+    def clear(self):
+        with self._lock:
+            self._base = SortedProducts([])
+            self._pending, self._pending_usage = [], {}
+            self._max_ids.clear()
+        self._cache.clear()
+
+
+product_index = ProductIndex(
+    refresh_interval=settings.SUGGEST_REFRESH_SECONDS,
+    rebuild_interval=settings.SUGGEST_REBUILD_SECONDS,
+    cache_ttl=settings.SUGGEST_CACHE_TTL,
+)
@@ -0,0 +1,112 @@
+"""
+Receipt change log benchmark.
+
+Appends synthetic receipts to the change log of a scratch SQLite database in
+transactions of one change each, as `create_receipt` does, and in import-sized
+batches. Then times a consumer catching up with the whole log in batches of
+several sizes, as GET /changes serves them, and compacting it.
+
+    python -m benchmarks.bench_changes --changes 200000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/..")
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app.changes import (
+    append_changes,
+    compact_changes,
+    created_change,
+    read_changes,
+    render_batch,
+)
+from app.database import Base
+
+
+def synthetic_receipt(rng: random.Random, receipt_id: int) -> dict:
+    products = [
+        {"name": f"product {rng.randint(1, 10000)}", "price": 1.5, "total": 1.5 * q}
+        for q in (rng.randint(1, 5) for _ in range(rng.randint(1, 8)))
+    ]
+    total = sum(product["total"] for product in products)
+    return {
+        "id": receipt_id,
+        "products": products,
+        "total": total,
+        "rest": 0.0,
+        "created_at": datetime(2026, 1, 1),
+        "payment": {"type": "cashless", "amount": total},
+    }
+
+
+def timed(label: str, fn, rows: int):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed * 1000:>10.1f} ms {rows / elapsed:>12,.0f} rows/s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--changes", type=int, default=200000)
+    parser.add_argument("--single", type=int, default=200)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench_changes.db")
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    rng = random.Random(1)
+    db = Session()
+
+    def append_one_by_one():
+        for i in range(args.single):
+            append_changes(db, [created_change(synthetic_receipt(rng, i), 1)])
+            db.commit()
+
+    def append_batches():
+        for start in range(args.single, args.changes, 1000):
+            stop = min(start + 1000, args.changes)
+            append_changes(
+                db,
+                [
+                    created_change(synthetic_receipt(rng, i), 1)
+                    for i in range(start, stop)
+                ],
+            )
+            db.commit()
+
+    timed("append, one per transaction", append_one_by_one, args.single)
+    timed("append, 1000 per transaction", append_batches, args.changes - args.single)
+
+    for limit in (100, 1000, 10000):
+
+        def catch_up():
+            after = 0
+            while True:
+                rows = read_changes(db, after, limit)
+                render_batch(0, after, rows, limit)
+                if len(rows) <= limit:
+                    return
+                after = rows[limit - 1].offset
+
+        timed(f"catch up, batches of {limit}", catch_up, args.changes)
+
+    timed(
+        "compact everything",
+        lambda: compact_changes(db, datetime(2100, 1, 1), consumers=[]),
+        args.changes,
+    )
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
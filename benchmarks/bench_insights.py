@@ -0,0 +1,115 @@
+"""
+Spending insights benchmark for one user with 1M line items.
+
+Times building the column arrays from query rows, computing all statistics,
+and appending single receipts as `create_receipt` does. With `--with-db` the
+rows are first seeded into a scratch SQLite database and loaded with the real
+query.
+
+    python -m benchmarks.bench_insights --items 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/..")
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app.database import Base
+from app.insights import SpendingColumns, load_rows
+from app.seeding import SeedOptions, seed_database
+
+
+def synthetic_rows(items: int, products: int, seed: int) -> list:
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 1)
+    rows = []
+    receipt_id = 0
+    while len(rows) < items:
+        receipt_id += 1
+        created_at = start + timedelta(seconds=receipt_id * 97)
+        basket = rng.sample(range(products), rng.randint(1, 7))
+        total = 0.0
+        lines = []
+        for product_id in basket:
+            price = 1 + product_id % 50
+            quantity = rng.randint(1, 3)
+            total += price * quantity
+            lines.append((product_id, quantity, float(price), f"product {product_id}"))
+        for product_id, quantity, price, name in lines:
+            rows.append(
+                (receipt_id, total, created_at, product_id, quantity, price, name)
+            )
+    return rows[:items]
+
+
+def timed(label: str, fn):
+    start = time.perf_counter()
+    result = fn()
+    print(f"{label:<36} {(time.perf_counter() - start) * 1000:>10.1f} ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--items", type=int, default=1000000)
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--appends", type=int, default=10000)
+    parser.add_argument("--with-db", action="store_true")
+    args = parser.parse_args()
+
+    if args.with_db:
+        path = os.path.join(tempfile.mkdtemp(), "bench_insights.db")
+        engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(bind=engine)
+        seed_database(
+            engine,
+            SeedOptions(
+                users=1,
+                products=args.products,
+                receipts=args.items // 4,
+                basket_mean=4.4,
+                end=datetime(2026, 1, 1),
+            ),
+        )
+        db = sessionmaker(bind=engine)()
+        rows = timed("load rows (one query)", lambda: load_rows(db, 1, 0))
+        db.close()
+    else:
+        rows = timed(
+            "generate rows",
+            lambda: synthetic_rows(args.items, args.products, seed=1),
+        )
+    print(f"line items: {len(rows):,}")
+
+    columns = SpendingColumns()
+    timed("build column arrays", lambda: columns.catch_up(rows))
+    print(f"receipts: {len(columns.receipt_ids):,}")
+    timed("compute statistics", lambda: columns.summary(10))
+
+    next_id = int(columns.receipt_ids.values.max()) + 1
+    created_at = datetime(2026, 1, 2)
+
+    def appends():
+        for receipt_id in range(next_id, next_id + args.appends):
+            columns.append_rows(
+                [
+                    (receipt_id, 12.0, created_at, 1, 2, 3.0, "product 1"),
+                    (receipt_id, 12.0, created_at, 2, 2, 3.0, "product 2"),
+                ]
+            )
+
+    elapsed = time.perf_counter()
+    appends()
+    elapsed = time.perf_counter() - elapsed
+    print(f"{'append one receipt':<36} {elapsed / args.appends * 1e6:>10.1f} us")
+    timed("compute statistics after appends", lambda: columns.summary(10))
+
+
+if __name__ == "__main__":
+    main()
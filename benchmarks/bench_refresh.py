@@ -0,0 +1,115 @@
+"""
+Refresh-token throughput benchmark.
+
+Compares the pre-rotation refresh path (decode + user lookup + new tokens)
+with the current one (the same plus the Bloom filter check and the revocation
+insert), both with the cached user lookup, and times the revocation check
+alone with a large revocation list. Runs against a scratch SQLite file in WAL
+mode unless `--database-url` points at an empty database.
+
+    python -m benchmarks.bench_refresh --iterations 2000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/..")
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from jose import jwt
+from app.auth import (
+    ALGORITHM,
+    SECRET_KEY,
+    create_access_token,
+    create_refresh_token,
+    get_password_hash,
+    find_user,
+    verify_refresh_token,
+)
+from app.database import Base
+from app.models import User
+from app.revocation import revocation_list
+
+
+def timed(label: str, iterations: int, fn):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - start
+    print(
+        f"{label:<40} {iterations / elapsed:>12,.0f} ops/s"
+        f" {elapsed / iterations * 1e6:>10.1f} us/op"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--revoked", type=int, default=100000)
+    parser.add_argument("--database-url", default=None)
+    args = parser.parse_args()
+
+    if args.database_url:
+        engine = create_engine(args.database_url)
+    else:
+        path = os.path.join(tempfile.mkdtemp(), "bench_refresh.db")
+        engine = create_engine(f"sqlite:///{path}")
+
+        @event.listens_for(engine, "connect")
+        def set_wal(dbapi_connection, connection_record):
+            dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add(
+        User(
+            username="bench",
+            hashed_password=get_password_hash("bench"),
+            name="Bench",
+            surname="User",
+        )
+    )
+    db.commit()
+
+    revocation_list.sync(db)
+    for _ in range(args.revoked):
+        revocation_list.add(uuid.uuid4().hex)
+    print(f"revocation list size: {len(revocation_list):,}")
+
+    token = create_refresh_token(data={"sub": "bench"})
+    timed(
+        "jwt.decode only",
+        args.iterations,
+        lambda: jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]),
+    )
+    timed(
+        "verify_refresh_token (filter check)",
+        args.iterations,
+        lambda: verify_refresh_token(token, db),
+    )
+
+    def legacy_refresh():
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        user = find_user(db, payload["sub"])
+        create_access_token(data={"sub": user.username})
+        create_refresh_token(data={"sub": user.username})
+
+    from app.routers.users import refresh_access_token
+
+    state = {"token": create_refresh_token(data={"sub": "bench"})}
+
+    def rotating_refresh():
+        state["token"] = refresh_access_token(state["token"], db)["refresh_token"]
+
+    timed("legacy refresh (no rotation)", args.iterations, legacy_refresh)
+    timed("refresh with rotation", args.iterations, rotating_refresh)
+
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Product suggestion benchmark with 1M products.
+
+Times building the sorted index, suggestions for prefixes of every length
+(uncached) and recording sold items as `create_receipt` does, and reports the
+memory the index takes. With `--with-db` the products are also written to a
+scratch SQLite database and the same prefixes are looked up with `LIKE`.
+
+    python -m benchmarks.bench_suggestions --products 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/..")
+from sqlalchemy import create_engine, insert, select
+from app.database import Base
+from app.models import Product
+from app.suggestions import ProductIndex, SortedProducts
+
+WORDS = (
+    "apple banana bread butter cheese chicken coffee cola cream egg flour honey "
+    "juice lemon milk oat olive orange pasta pepper rice salt soap sugar tea "
+    "tomato tuna water wine yogurt"
+).split()
+BRANDS = "acme bio daily fresh gold happy home nord prime royal select sun".split()
+
+
+def synthetic_products(count: int, seed: int) -> dict:
+    """`(name, price) -> units sold`, with Zipf-like popularity."""
+    rng = random.Random(seed)
+    products = {}
+    while len(products) < count:
+        name = (
+            f"{rng.choice(BRANDS).title()} {rng.choice(WORDS)} "
+            f"{rng.choice(WORDS)} {rng.randint(1, 999)}g"
+        )
+        price = round(rng.uniform(0.5, 50), 2)
+        products[(name, price)] = int(1000 / (len(products) + 1) ** 0.8)
+    return products
+
+
+def timed(label: str, fn):
+    start = time.perf_counter()
+    result = fn()
+    print(f"{label:<40} {(time.perf_counter() - start) * 1000:>10.1f} ms")
+    return result
+
+
+def per_call(label: str, fn, args: list):
+    start = time.perf_counter()
+    for arg in args:
+        fn(arg)
+    elapsed = (time.perf_counter() - start) / len(args)
+    print(f"{label:<40} {elapsed * 1e6:>10.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--with-db", action="store_true")
+    args = parser.parse_args()
+
+    products = timed(
+        "generate products", lambda: synthetic_products(args.products, seed=1)
+    )
+    print(f"products: {len(products):,}")
+
+    tracemalloc.start()
+    base = timed(
+        "build sorted index",
+        lambda: SortedProducts((n, p, u) for (n, p), u in products.items()),
+    )
+    size = base.names.__sizeof__() + sum(
+        array.nbytes for array in (base.offsets, base.prices, base.usage)
+    )
+    print(f"{'index size':<40} {size / 2**20:>10.1f} MiB")
+    print(
+        f"{'peak allocated while building':<40} "
+        f"{tracemalloc.get_traced_memory()[1] / 2**20:>10.1f} MiB"
+    )
+    tracemalloc.stop()
+
+    index = ProductIndex(refresh_interval=30, rebuild_interval=3600, cache_ttl=0)
+    index.load(products)
+    rng = random.Random(2)
+    names = [name for name, _ in rng.sample(list(products), args.lookups)]
+    for length in (1, 2, 3, 5, 8):
+        prefixes = [name[:length] for name in names]
+        start, stop = base.prefix_range(prefixes[0].casefold())
+        per_call(
+            f"suggest, {length}-char prefix ({stop - start:,} hits)",
+            lambda prefix: index.suggest(prefix, 10),
+            prefixes,
+        )
+
+    sold = rng.sample(list(products), args.lookups)
+    per_call(
+        "record a sold product",
+        lambda key: index.record([(key[0], key[1], 1)]),
+        sold,
+    )
+    new = [(f"New product {i}", 1.0) for i in range(args.lookups)]
+    per_call(
+        "record a new product",
+        lambda key: index.record([(key[0], key[1], 1)]),
+        new,
+    )
+    per_call(
+        "suggest with new products pending",
+        lambda prefix: index.suggest(prefix, 10),
+        ["new product 1"] * args.lookups,
+    )
+
+    if args.with_db:
+        path = os.path.join(tempfile.mkdtemp(), "bench_suggestions.db")
+        engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(bind=engine)
+        with engine.begin() as connection:
+            connection.execute(
+                insert(Product),
+                [{"name": name, "price": price} for name, price in products],
+            )
+        with engine.connect() as connection:
+            for length in (3, 8):
+                prefixes = [name[:length] for name in names[:50]]
+                per_call(
+                    f"SQL LIKE, {length}-char prefix, unranked",
+                    lambda prefix: connection.execute(
+                        select(Product.name, Product.price)
+                        .where(Product.name.like(prefix + "%"))
+                        .limit(10)
+                    ).all(),
+                    prefixes,
+                )
+
+
+if __name__ == "__main__":
+    main()
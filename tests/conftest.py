@@ -7,12 +7,16 @@ import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/..")
 from app.main import app
 from app.database import Base, get_db
+from app.leaderboard import leaderboard
+from app.suggestions import product_index
 from app.config import settings
 from fastapi.testclient import TestClient
 
 SQLALCHEMY_DATABASE_URL = settings.DATABASE_URL_TEST
 engine = create_engine(SQLALCHEMY_DATABASE_URL)
 TestingSessionLocal = sessionmaker(bind=engine)
+leaderboard.session_factory = TestingSessionLocal
+product_index.session_factory = TestingSessionLocal
 
 Base.metadata.create_all(bind=engine)
 
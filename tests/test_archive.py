@@ -0,0 +1,94 @@
+from datetime import datetime
+from sqlalchemy import text
+from app.archive import Segment, archive, archive_receipts
+from app.config import settings
+from app.routers.receipts import receipt_text_cache
+from conftest import TestingSessionLocal
+
+
+def test_archived_receipts_stay_reachable(client, tmp_path, monkeypatch):
+    user = {
+        "username": "archiveuser",
+        "password": "pass",
+        "name": "Old",
+        "surname": "Buyer",
+    }
+    assert client.post("/users/register", json=user).status_code == 200
+    token = client.post(
+        "/users/login", data={"username": "archiveuser", "password": "pass"}
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    receipt_ids = []
+    for amount in (10, 20):
+        response = client.post(
+            "/receipts/",
+            headers=headers,
+            json={
+                "products": [{"name": "archived soap", "price": 2.5, "quantity": 2}],
+                "payment": {"type": "cash", "amount": amount},
+            },
+        )
+        receipt_ids.append(response.json()["id"])
+
+    # Archived later, into a second segment.
+    third = client.post(
+        "/receipts/",
+        headers=headers,
+        json={
+            "products": [{"name": "archived soap", "price": 2.5, "quantity": 2}],
+            "payment": {"type": "cash", "amount": 30},
+        },
+    ).json()["id"]
+
+    db = TestingSessionLocal()
+    archive.reopen(str(tmp_path))
+    try:
+        db.execute(
+            text("UPDATE receipts SET created_at = :old WHERE id IN (:a, :b)"),
+            {"old": datetime(2000, 1, 1), "a": receipt_ids[0], "b": receipt_ids[1]},
+        )
+        db.commit()
+        receipt_text_cache.clear()
+        before = {
+            receipt_id: client.get(
+                f"/receipts/{receipt_id}", params={"line_width": 33}
+            ).text
+            for receipt_id in receipt_ids
+        }
+
+        assert archive_receipts(db, archive, datetime(2001, 1, 1)) == 2
+        receipt_text_cache.clear()
+
+        for receipt_id in receipt_ids:
+            response = client.get(f"/receipts/{receipt_id}", params={"line_width": 33})
+            assert response.status_code == 200
+            assert response.text == before[receipt_id]
+
+        response = client.get("/receipts/", headers=headers, params={"count": "exact"})
+        assert [r["id"] for r in response.json()] == [third] + receipt_ids
+        assert response.json()[1]["products"][0]["total"] == 5
+        assert response.headers["X-Total-Count"] == "3"
+
+        # Later pages and counts reuse the user's index entries.
+        scans = []
+        monkeypatch.setattr(Segment, "user_entries", lambda *args: scans.append(args))
+        response = client.get(
+            "/receipts/", headers=headers, params={"min_total": 5, "skip": 1}
+        )
+        assert [r["id"] for r in response.json()] == receipt_ids
+        assert not scans
+        monkeypatch.undo()
+
+        # A new segment is picked up.
+        db.execute(
+            text("UPDATE receipts SET created_at = :old WHERE id = :c"),
+            {"old": datetime(2000, 1, 1), "c": third},
+        )
+        db.commit()
+        assert archive_receipts(db, archive, datetime(2001, 1, 1)) == 1
+        response = client.get("/receipts/", headers=headers, params={"count": "exact"})
+        assert [r["id"] for r in response.json()] == receipt_ids + [third]
+    finally:
+        archive.reopen(settings.ARCHIVE_DIR)
+        db.close()
@@ -0,0 +1,137 @@
+import json
+from datetime import datetime, timedelta
+from app.auth import create_access_token
+from app.changes import compact_changes, compacted_offset, last_offset
+from app.config import settings
+from app.revocation import utcnow
+from conftest import TestingSessionLocal
+
+
+def test_changes_are_consumed_in_batches_and_compacted(client, monkeypatch):
+    monkeypatch.setattr(settings, "CHANGES_API_KEYS", "mirror:m-key, audit:a-key")
+    mirror = {"X-API-Key": "m-key"}
+    audit = {"X-API-Key": "a-key"}
+    assert client.get("/changes/").status_code == 401
+    assert client.get("/changes/", headers={"X-API-Key": "nope"}).status_code == 403
+
+    user = {"username": "changer", "password": "pass", "name": "Ch", "surname": "A"}
+    assert client.post("/users/register", json=user).status_code == 200
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': 'changer'})}"}
+    db = TestingSessionLocal()
+    try:
+        start = last_offset(db)
+    finally:
+        db.close()
+
+    created = []
+    for quantity in (1, 2, 3):
+        response = client.post(
+            "/receipts/",
+            headers=headers,
+            json={
+                "products": [
+                    {"name": "change milk", "price": 1.5, "quantity": quantity},
+                    {"name": "change bread", "price": 2.0, "quantity": 1},
+                ],
+                "payment": {"type": "cash", "amount": 20},
+            },
+        )
+        assert response.status_code == 200
+        created.append(response.json())
+
+    response = client.get(f"/changes/?after={start}&limit=2", headers=mirror)
+    assert response.status_code == 200
+    batch = response.json()
+    assert batch["after"] == start and batch["has_more"]
+    assert [change["offset"] for change in batch["changes"]] == [start + 1, start + 2]
+    assert batch["next_after"] == start + 2
+    first = batch["changes"][0]
+    assert first["kind"] == "created" and first["receipt_id"] == created[0]["id"]
+    assert first["receipt"] == created[0]
+
+    batch = client.get(f"/changes/?after={batch['next_after']}", headers=mirror).json()
+    assert [change["receipt"] for change in batch["changes"]] == created[2:]
+    assert not batch["has_more"] and batch["next_after"] == start + 3
+
+    # Without `after` the consumer continues from its checkpoint.
+    response = client.put(
+        "/changes/checkpoint", json={"offset": start + 3}, headers=mirror
+    )
+    assert response.json() == {
+        "shard": 0,
+        "consumer": "mirror",
+        "offset": start + 3,
+        "compacted_offset": 0,
+    }
+    batch = client.get("/changes/", headers=mirror).json()
+    assert batch["after"] == start + 3 and batch["changes"] == []
+    bad = client.put("/changes/checkpoint", json={"offset": start + 4}, headers=mirror)
+    assert bad.status_code == 400
+    assert client.get("/changes/?shard=9", headers=mirror).status_code == 404
+
+    # Compaction waits for every consumer.
+    db = TestingSessionLocal()
+    try:
+        old = datetime(2000, 1, 1)
+        assert compact_changes(db, old)["changes"] == 0
+        client.put("/changes/checkpoint", json={"offset": start + 1}, headers=audit)
+        result = compact_changes(db, old, batch_size=2)
+        assert result["compacted_offset"] == start + 1
+        assert result["changes"] == start + 1
+    finally:
+        db.close()
+    assert client.get(f"/changes/?after={start}", headers=audit).status_code == 410
+    batch = client.get("/changes/", headers=audit).json()
+    assert [change["offset"] for change in batch["changes"]] == [start + 2, start + 3]
+
+    # Changes past their retention are compacted even when unconsumed.
+    db = TestingSessionLocal()
+    try:
+        result = compact_changes(db, utcnow() + timedelta(days=1))
+        assert result["compacted_offset"] == start + 3
+    finally:
+        db.close()
+    checkpoint = client.get("/changes/checkpoint", headers=audit).json()
+    assert checkpoint["offset"] == start + 1
+    assert checkpoint["compacted_offset"] == start + 3
+    assert client.get("/changes/", headers=audit).status_code == 410
+
+    # With every change compacted, the consumer can still move past them.
+    batch = client.get(f"/changes/?after={start + 3}", headers=audit).json()
+    assert batch["changes"] == [] and batch["next_after"] == start + 3
+    response = client.put(
+        "/changes/checkpoint", json={"offset": batch["next_after"]}, headers=audit
+    )
+    assert response.status_code == 200
+    assert client.get("/changes/", headers=audit).json()["after"] == start + 3
+    bad = client.put("/changes/checkpoint", json={"offset": start + 4}, headers=audit)
+    assert bad.status_code == 400
+
+
+def test_imported_change_matches_the_listed_receipt(client, monkeypatch):
+    monkeypatch.setattr(settings, "CHANGES_API_KEYS", "mirror:m-key")
+    user = {"username": "cashless", "password": "pass", "name": "Ca", "surname": "Rd"}
+    assert client.post("/users/register", json=user).status_code == 200
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': 'cashless'})}"}
+    db = TestingSessionLocal()
+    try:
+        start = max(last_offset(db), compacted_offset(db))
+    finally:
+        db.close()
+
+    job_id = client.post("/receipts/imports/", headers=headers).json()["id"]
+    line = {
+        "products": [{"name": "card tea", "price": 2.0, "quantity": 1}],
+        "payment": {"type": "cashless", "amount": 10},
+    }
+    response = client.post(
+        f"/receipts/imports/{job_id}/lines",
+        headers=headers,
+        content=json.dumps(line).encode() + b"\n",
+    )
+    assert response.json()["receipts_imported"] == 1
+
+    listed = client.get("/receipts/", headers=headers).json()
+    assert listed[0]["rest"] == 0.0
+    changes = client.get(f"/changes/?after={start}", headers={"X-API-Key": "m-key"})
+    assert [change["receipt"] for change in changes.json()["changes"]] == listed
@@ -0,0 +1,95 @@
+import gzip
+import json
+from datetime import datetime, timedelta, timezone
+from app.config import settings
+from app.importing import LineSplitter, normalize_created_at
+
+
+def receipt_line(amount, created_at=None):
+    line = {
+        "products": [
+            {"name": "imported bread", "price": 2.0, "quantity": 1},
+            {"name": "imported milk", "price": 1.5, "quantity": 2},
+        ],
+        "payment": {"type": "cash", "amount": amount},
+    }
+    if created_at:
+        line["created_at"] = created_at
+    return json.dumps(line)
+
+
+def test_line_splitter_bounds_lines_and_reads_gzip_members():
+    data = gzip.compress(b'{"a": 1}\n' + b"x" * 100) + gzip.compress(b"\n\nlast")
+    splitter = LineSplitter(compressed=True, max_line_bytes=50)
+    lines = []
+    for start in range(0, len(data), 7):
+        lines.extend(splitter.feed(data[start : start + 7]))
+    lines.extend(splitter.finish())
+    assert lines == [(1, b'{"a": 1}'), (2, None), (3, b""), (4, b"last")]
+
+
+def test_created_at_is_stored_as_naive_utc():
+    assert normalize_created_at(None).tzinfo is None
+    kyiv = timezone(timedelta(hours=2))
+    assert normalize_created_at(datetime(2019, 3, 1, 12, tzinfo=kyiv)) == datetime(
+        2019, 3, 1, 10
+    )
+
+
+def test_import_receipts_resumes_after_broken_upload(client, monkeypatch):
+    monkeypatch.setattr(settings, "IMPORT_BATCH_RECEIPTS", 2)
+    user = {"username": "importer", "password": "pass", "name": "Leg", "surname": "Acy"}
+    assert client.post("/users/register", json=user).status_code == 200
+    token = client.post(
+        "/users/login", data={"username": "importer", "password": "pass"}
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    lines = [
+        receipt_line(10, "2019-03-01T10:00:00"),
+        "{not json",
+        receipt_line(10),
+        "",
+        receipt_line(1),
+        receipt_line(20, "2019-03-02T12:30:00+02:00"),
+        receipt_line(30),
+    ]
+    body = gzip.compress("\n".join(lines).encode() + b"\n")
+
+    response = client.post("/receipts/imports/", headers=headers)
+    assert response.status_code == 201
+    job_id = response.json()["id"]
+    upload = f"/receipts/imports/{job_id}/lines"
+
+    # A cut-off upload keeps the batches read so far.
+    response = client.post(
+        upload,
+        headers={**headers, "Content-Encoding": "gzip"},
+        content=body[: len(body) - 12],
+    )
+    assert response.status_code == 400
+    job = client.get(f"/receipts/imports/{job_id}", headers=headers).json()
+    assert job["status"] == "failed"
+    assert 0 < job["lines_committed"] < len(lines)
+
+    # Uploading the whole file again only processes the remaining lines.
+    response = client.post(
+        upload, headers={**headers, "Content-Encoding": "gzip"}, content=body
+    )
+    assert response.status_code == 200
+    job = response.json()
+    assert job["status"] == "completed"
+    assert job["lines_committed"] == len(lines)
+    assert job["receipts_imported"] == 4
+    assert job["error_count"] == 2
+    assert [error["line"] for error in job["errors"]] == [2, 5]
+    assert job["errors"][1]["detail"] == "Insufficient payment"
+
+    response = client.get("/receipts/?count=exact&limit=10", headers=headers)
+    assert response.headers["X-Total-Count"] == "4"
+    receipts = sorted(response.json(), key=lambda receipt: receipt["created_at"])
+    assert receipts[0]["created_at"].startswith("2019-03-01T10:00:00")
+    assert receipts[1]["created_at"].startswith("2019-03-02T10:30:00")
+    assert all(receipt["total"] == 5.0 for receipt in receipts)
+
+    assert client.post(upload, headers=headers, content=b"").status_code == 409
@@ -0,0 +1,194 @@
+import logging
+import os
+import select
+import time
+import pytest
+from app import invalidation
+from app.cache import TTLCache
+from app.invalidation import (
+    POSTGRES_MAX_PAYLOAD,
+    BackendInvalidationBus,
+    FileInvalidationBus,
+    InvalidationBus,
+    PostgresInvalidationBus,
+)
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_file_bus_evicts_in_other_workers(tmp_path):
+    path = str(tmp_path / "invalidation.log")
+    buses = [FileInvalidationBus(path, batch_interval=0.01) for _ in range(2)]
+    caches = [TTLCache(ttl=60) for _ in range(2)]
+    for bus, cache in zip(buses, caches):
+        bus.subscribe("products", cache)
+        bus.start()
+    try:
+        assert wait_for(lambda: not any(bus.degraded for bus in buses))
+        for cache in caches:
+            cache.set(("soap", 1.5), 1)
+            cache.set(("apples", 3.0), 2)
+
+        buses[0].publish("products", ("soap", 1.5))
+        assert caches[0].get(("soap", 1.5)) is None
+        assert wait_for(lambda: caches[1].get(("soap", 1.5)) is None)
+        assert caches[1].get(("apples", 3.0)) == 2
+    finally:
+        for bus in buses:
+            bus.stop()
+
+
+def test_degraded_bus_caps_ttl(tmp_path):
+    bus = FileInvalidationBus(
+        str(tmp_path / "missing" / "invalidation.log"), fallback_ttl=0
+    )
+    cache = TTLCache(ttl=60)
+    bus.subscribe("receipts", cache)
+    bus.start()
+    try:
+        assert bus.degraded
+        cache.set(1, "receipt")
+        assert cache.get(1) is None
+    finally:
+        bus.stop()
+
+
+class FakeNotify:
+    def __init__(self, payload):
+        self.payload = payload
+
+
+class FakeConnection:
+    """Stands in for a psycopg2 connection: notifications sent are received."""
+
+    closed = False
+
+    def __init__(self):
+        self.notifies = []
+        self.sent = []
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, statement, parameters):
+        channel, payload = parameters
+        self.sent.append(payload)
+        self.notifies.append(FakeNotify(payload))
+
+    def poll(self):
+        pass
+
+
+def test_backend_bus_requires_the_transport_methods():
+    with pytest.raises(TypeError):
+        BackendInvalidationBus()
+
+
+def test_postgres_bus_splits_payloads_and_applies_notifications(monkeypatch):
+    monkeypatch.setattr(select, "select", lambda r, w, x, timeout: (r, w, x))
+    sender = PostgresInvalidationBus("postgresql+psycopg2://u:p@db/app")
+    receiver = PostgresInvalidationBus("postgresql://u:p@db/app")
+    assert sender.dsn == "postgresql://u:p@db/app"
+    products, cache = TTLCache(ttl=60), TTLCache(ttl=60)
+    receiver.subscribe("products", products)
+    receiver.subscribe("users", cache)
+    products.set(("soap", 1.5), 1)
+    cache.set("alice", 2)
+    cache.set("bob", 3)
+
+    sender._conn = connection = FakeConnection()
+    many = [f"user-{i:05d}" for i in range(1000)]
+    sender._queue("products", [("soap", 1.5)])
+    sender._queue("users", ["alice"])
+    sender._flush()
+    sender._queue("users", many[:200])
+    sender._queue("products", [("x" * 50, i) for i in range(200)])
+    sender._flush()
+    assert all(len(payload) <= POSTGRES_MAX_PAYLOAD for payload in connection.sent)
+    assert len(connection.sent) == 3
+
+    receiver._conn = connection
+    for message in receiver._receive(0.01):
+        receiver._receive_message(message)
+    assert products.get(("soap", 1.5)) is None
+    assert cache.get("alice") is None and cache.get("bob") == 3
+    # The oversized topic arrives as "clear the topic".
+    products.set(("bread", 1.0), 2)
+    sender._queue("products", [("x" * 50, i) for i in range(200)])
+    sender._flush()
+    for message in receiver._receive(0.01):
+        receiver._receive_message(message)
+    assert products.get(("bread", 1.0)) is None
+
+    # Topics subscribed with never_clear are split instead.
+    streams = TTLCache(ttl=60)
+    sender.subscribe("receipt_streams", TTLCache(ttl=60), never_clear=True)
+    receiver.subscribe("receipt_streams", streams, never_clear=True)
+    user_ids = list(range(10**9, 10**9 + 1000))
+    for user_id in user_ids:
+        streams.set(user_id, 1)
+    streams.set(1, 1)
+    sender._queue("receipt_streams", user_ids)
+    sender._flush()
+    for message in receiver._receive(0.01):
+        receiver._receive_message(message)
+    assert all(streams.get(user_id) is None for user_id in user_ids)
+    assert streams.get(1) == 1
+
+    # A worker ignores its own messages.
+    cache.set("carol", 4)
+    sender._queue("users", ["carol"])
+    sender._flush()
+    receiver.origin = sender.origin
+    for message in receiver._receive(0.01):
+        receiver._receive_message(message)
+    assert cache.get("carol") == 4
+
+
+@pytest.mark.skipif(
+    not os.environ.get("INVALIDATION_POSTGRES_URL"),
+    reason="INVALIDATION_POSTGRES_URL is not set",
+)
+def test_postgres_bus_evicts_in_other_workers():
+    url = os.environ["INVALIDATION_POSTGRES_URL"]
+    buses = [PostgresInvalidationBus(url, batch_interval=0.01) for _ in range(2)]
+    caches = [TTLCache(ttl=60) for _ in range(2)]
+    for bus, cache in zip(buses, caches):
+        bus.subscribe("products", cache)
+        bus.start()
+    try:
+        assert wait_for(lambda: not any(bus.degraded for bus in buses), timeout=5)
+        for cache in caches:
+            cache.set(("soap", 1.5), 1)
+        buses[0].publish("products", ("soap", 1.5))
+        assert wait_for(lambda: caches[1].get(("soap", 1.5)) is None, timeout=5)
+    finally:
+        for bus in buses:
+            bus.stop()
+
+
+def test_memory_bus_warns_about_other_workers(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(invalidation, "worker_directory", lambda: str(tmp_path))
+    # The parent process stands in for another worker.
+    open(tmp_path / str(os.getppid()), "w").close()
+    open(tmp_path / "999999999", "w").close()
+    bus = InvalidationBus()
+    with caplog.at_level(logging.WARNING, logger="app.invalidation"):
+        bus.start()
+    assert "2 workers share the database" in caplog.text
+    assert not (tmp_path / "999999999").exists()
+    bus.stop()
+    assert not (tmp_path / str(os.getpid())).exists()
@@ -0,0 +1,89 @@
+import random
+from sqlalchemy import select
+from app.auth import create_access_token
+from app.leaderboard import (
+    ALL_TIME,
+    Leaderboard,
+    SpaceSaving,
+    leaderboard,
+    rebuild_sales,
+)
+from app.models import ProductSales
+from conftest import TestingSessionLocal
+
+
+def test_space_saving_keeps_heavy_hitters():
+    rng = random.Random(36)
+    stream = ["hot"] * 300 + ["warm"] * 150 + [f"cold{i}" for i in range(400)]
+    rng.shuffle(stream)
+    sketch = SpaceSaving(ALL_TIME, capacity=20)
+    for key in stream:
+        sketch.add((key, 1.0), 1, 1.0)
+
+    ranking = sketch.top(2)
+    assert [row[0] for row in ranking] == ["hot", "warm"]
+    # Counts are never too low and too high by at most total / capacity.
+    assert 300 <= ranking[0][2] <= 300 + len(stream) // 20
+    assert 150 <= ranking[1][2] <= 150 + len(stream) // 20
+    assert len(sketch.counters) == 20
+
+
+def sales(db, name):
+    return db.execute(
+        select(ProductSales.period, ProductSales.quantity, ProductSales.revenue)
+        .where(ProductSales.name == name)
+        .order_by(ProductSales.period)
+    ).all()
+
+
+def test_top_products_are_counted_persisted_and_rebuilt(client):
+    user = {"username": "manager", "password": "pass", "name": "Sto", "surname": "Re"}
+    assert client.post("/users/register", json=user).status_code == 200
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': 'manager'})}"}
+    for quantity in (1000, 500):
+        response = client.post(
+            "/receipts/",
+            headers=headers,
+            json={
+                "products": [
+                    {"name": "leader coffee", "price": 3.0, "quantity": quantity},
+                    {"name": "leader cake", "price": 5.0, "quantity": 900},
+                ],
+                "payment": {"type": "cashless", "amount": 100000},
+            },
+        )
+        assert response.status_code == 200
+
+    response = client.get("/products/top?window=all&k=2", headers=headers)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["window"] == "all" and body["since"] is None
+    assert body["products"] == [
+        {"name": "leader cake", "price": 5.0, "quantity": 1800, "revenue": 9000.0},
+        {"name": "leader coffee", "price": 3.0, "quantity": 1500, "revenue": 4500.0},
+    ]
+    assert client.get("/products/top?window=week", headers=headers).status_code == 422
+    assert client.get("/products/top").status_code == 401
+
+    # Another worker (or a restart) sees the flushed counts.
+    leaderboard.flush()
+    db = TestingSessionLocal()
+    assert sales(db, "leader coffee") == [
+        ("all", 1500, 4500.0),
+        ("day", 1500, 4500.0),
+        ("hour", 1500, 4500.0),
+    ]
+    other = Leaderboard(10, 60.0, 1, session_factory=TestingSessionLocal)
+    other.flush()
+    assert other.top("all", 2)["products"] == body["products"]
+
+    # Recounting from the receipts gives the same numbers.
+    rebuild_sales([db])
+    db.close()
+    db = TestingSessionLocal()
+    assert sales(db, "leader coffee") == [
+        ("all", 1500, 4500.0),
+        ("day", 1500, 4500.0),
+        ("hour", 1500, 4500.0),
+    ]
+    db.close()
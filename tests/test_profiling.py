@@ -0,0 +1,70 @@
+import pstats
+from app.auth import create_access_token
+from app.config import settings
+from app.profiling import (
+    PROFILE_HEADER,
+    create_profile_token,
+    profile_store,
+    verify_profile_token,
+)
+
+
+def test_profile_tokens_are_signed_and_expire():
+    token = create_profile_token(60)
+    assert verify_profile_token(token)
+    expires, _, digest = token.partition(".")
+    assert not verify_profile_token(f"{int(expires) + 1}.{digest}")
+    assert not verify_profile_token(create_profile_token(-1))
+    assert not verify_profile_token("garbage")
+    assert not verify_profile_token(None)
+
+
+def test_profiled_requests_are_stored_in_a_ring(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(profile_store, "directory", str(tmp_path))
+    monkeypatch.setattr(profile_store, "max_profiles", 2)
+    user = {"username": "profiled", "password": "pass", "name": "Pro", "surname": "F"}
+    assert client.post("/users/register", json=user).status_code == 200
+    auth = {"Authorization": f"Bearer {create_access_token({'sub': 'profiled'})}"}
+    profile = {PROFILE_HEADER: create_profile_token(60)}
+
+    response = client.get("/products/top", headers=auth)
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+    assert client.get("/profiles/").status_code == 403
+    assert client.get("/profiles/", headers=auth).status_code == 403
+
+    response = client.get("/products/top", headers={**auth, **profile})
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+
+    listed = client.get("/profiles/", headers=profile).json()
+    assert [summary["id"] for summary in listed] == [profile_id]
+    assert listed[0]["route"] == "/products/top"
+    assert listed[0]["trigger"] == "token"
+    assert listed[0]["status_code"] == 200
+
+    # The dependency and the endpoint ran in worker threads.
+    response = client.get(f"/profiles/{profile_id}?format=collapsed", headers=profile)
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert any("get_current_user" in line for line in lines)
+    assert any("top_products" in line for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+    response = client.get(f"/profiles/{profile_id}?format=pstats", headers=profile)
+    path = tmp_path / "download.pstats"
+    path.write_bytes(response.content)
+    functions = {name for _, _, name in pstats.Stats(str(path)).stats}
+    assert "get_current_user" in functions and "top_products" in functions
+
+    # Sampled requests are profiled without the header; only two are kept.
+    monkeypatch.setattr(settings, "PROFILE_SAMPLE_RATE", 1.0)
+    response = client.get("/products/top?window=all", headers=auth)
+    assert "X-Profile-Id" in response.headers
+    assert client.get("/products/top?k=0", headers=auth).status_code == 422
+    listed = client.get("/profiles/", headers=profile).json()
+    assert [summary["status_code"] for summary in listed] == [422, 200]
+    assert listed[1]["trigger"] == "sample"
+    assert profile_id not in {summary["id"] for summary in listed}
+    assert client.get(f"/profiles/{profile_id}", headers=profile).status_code == 404
+    assert client.get("/profiles/..%2Fx", headers=profile).status_code == 404
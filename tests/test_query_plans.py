@@ -0,0 +1,289 @@
+"""
+Query plan regression tests.
+
+Every SQL statement an endpoint sends is captured and explained against a
+seeded database. The plans must not fully scan the large tables, and on
+PostgreSQL the estimated row counts must stay bounded. The plans are also
+compared with the snapshots in tests/query_plans/<dialect>.json, so a change
+in how a query is executed shows up in review. After an intended change, run
+
+    UPDATE_PLAN_SNAPSHOTS=1 pytest tests/test_query_plans.py
+
+and commit the updated snapshot; the same creates the snapshot for a new
+dialect. PLAN_DATABASE_URL selects an empty database to seed; by default a
+temporary SQLite file is used.
+"""
+
+import json
+import os
+import re
+from datetime import datetime
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+from app.auth import create_access_token, create_refresh_token, user_cache
+from app.config import settings
+from app.database import Base, get_db
+from app.insights import spending_cache
+from app.main import app
+from app.pagination import receipt_count_cache
+from app.routers.receipts import product_cache, receipt_text_cache
+from app.seeding import SeedOptions, seed_database
+
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_plans")
+LARGE_TABLES = {"users", "products", "receipts", "receipt_product"}
+# Upper bound for the planner's row estimate of any single plan node. Insights
+# read the user's whole history by design.
+MAX_ESTIMATED_ROWS = 5000
+ESTIMATED_ROWS_LIMITS = {"spending_insights": 50000}
+CHANGES_API_KEY = "plan-key"
+SEED = SeedOptions(
+    users=50, products=2000, receipts=20000, end=datetime(2026, 1, 1), seed=33
+)
+
+
+class StatementRecorder:
+    def __init__(self, engine):
+        self.statements = []
+        self.recording = False
+        event.listen(engine, "before_cursor_execute", self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        if self.recording and not executemany:
+            self.statements.append((statement, parameters))
+
+
+@pytest.fixture(scope="module")
+def seeded(tmp_path_factory):
+    url = os.environ.get("PLAN_DATABASE_URL") or "sqlite:///{}".format(
+        tmp_path_factory.mktemp("plans") / "plans.db"
+    )
+    engine = create_engine(url)
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    seed_database(engine, SEED)
+    with engine.begin() as connection:
+        connection.exec_driver_sql("ANALYZE")
+
+    SessionLocal = sessionmaker(bind=engine)
+
+    def override_get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    recorder = StatementRecorder(engine)
+    app.dependency_overrides[get_db] = override_get_db
+    api_keys = settings.CHANGES_API_KEYS
+    settings.CHANGES_API_KEYS = f"plans:{CHANGES_API_KEY}"
+    with TestClient(app) as client:
+        yield client, engine, recorder
+    settings.CHANGES_API_KEYS = api_keys
+    app.dependency_overrides.pop(get_db, None)
+    Base.metadata.drop_all(bind=engine)
+    engine.dispose()
+
+
+def busiest_user(engine):
+    with engine.connect() as connection:
+        return connection.execute(
+            text("SELECT id, username FROM users ORDER BY receipt_count DESC LIMIT 1")
+        ).one()
+
+
+def scenarios(engine):
+    """(name, method, path, keyword arguments) for each endpoint call."""
+    user_id, username = busiest_user(engine)
+    with engine.connect() as connection:
+        receipt_id = connection.execute(
+            text("SELECT MAX(id) FROM receipts WHERE user_id = :u"), {"u": user_id}
+        ).scalar()
+        product = connection.execute(
+            text("SELECT name, price FROM products ORDER BY id LIMIT 1")
+        ).one()
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': username})}"}
+    receipt = {
+        "products": [
+            {"name": product.name, "price": product.price, "quantity": 1},
+            {"name": "plan test product", "price": 1.25, "quantity": 2},
+        ],
+        "payment": {"type": "cashless", "amount": 1000},
+    }
+    return [
+        ("list_receipts", "get", "/receipts/", {"headers": headers}),
+        (
+            "list_receipts_date_range",
+            "get",
+            "/receipts/?start_date=2025-06-01T00:00:00&end_date=2025-07-01T00:00:00",
+            {"headers": headers},
+        ),
+        (
+            "list_receipts_min_total_payment_type",
+            "get",
+            "/receipts/?min_total=50&payment_type=cash",
+            {"headers": headers},
+        ),
+        (
+            "list_receipts_deep_page",
+            "get",
+            "/receipts/?skip=100000&min_total=50",
+            {"headers": headers},
+        ),
+        (
+            "count_receipts_filtered",
+            "get",
+            "/receipts/?payment_type=cashless&count=exact",
+            {"headers": headers},
+        ),
+        ("count_receipts", "get", "/receipts/?count=exact", {"headers": headers}),
+        ("create_receipt", "post", "/receipts/", {"headers": headers, "json": receipt}),
+        (
+            "read_changes",
+            "get",
+            "/changes/?after=0&limit=100",
+            {"headers": {"X-API-Key": CHANGES_API_KEY}},
+        ),
+        ("spending_insights", "get", "/receipts/insights", {"headers": headers}),
+        ("top_products", "get", "/products/top?window=day", {"headers": headers}),
+        ("get_public_receipt", "get", f"/receipts/{receipt_id}", {}),
+        (
+            "refresh_token",
+            "post",
+            "/users/refresh",
+            {"params": {"refresh_token": create_refresh_token({"sub": username})}},
+        ),
+    ]
+
+
+def normalize_sql(statement: str) -> str:
+    return " ".join(statement.split())
+
+
+def table_aliases(statement: str) -> dict:
+    aliases = {}
+    for table, alias in re.findall(
+        r"\b(?:FROM|JOIN|UPDATE)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", statement, re.I
+    ):
+        aliases[table] = table
+        if alias and alias.upper() not in {"WHERE", "ON", "SET", "JOIN", "ORDER"}:
+            aliases[alias] = table
+    return aliases
+
+
+def explain_sqlite(connection, statement, parameters, max_rows):
+    rows = connection.exec_driver_sql(
+        "EXPLAIN QUERY PLAN " + statement, parameters
+    ).all()
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node_id] + detail)
+
+    aliases = table_aliases(statement)
+    problems = []
+    for line in lines:
+        # An open-ended rowid range reads the rest of the table just like a scan.
+        match = re.match(
+            r"\s*(?:SCAN (\w+)"
+            r"|SEARCH (\w+) USING INTEGER PRIMARY KEY \(rowid[<>]=?\?\))",
+            line,
+        )
+        name = match and (match.group(1) or match.group(2))
+        if name and aliases.get(name, name) in LARGE_TABLES:
+            problems.append(f"full scan: {line.strip()}")
+    return lines, problems
+
+
+def explain_postgresql(connection, statement, parameters, max_rows):
+    plan = connection.exec_driver_sql(
+        "EXPLAIN (FORMAT JSON) " + statement, parameters
+    ).scalar()
+    lines = []
+    problems = []
+
+    def walk(node, depth):
+        line = node["Node Type"]
+        if "Relation Name" in node:
+            line += f" on {node['Relation Name']}"
+        if "Index Name" in node:
+            line += f" using {node['Index Name']}"
+        lines.append("  " * depth + line)
+        if (
+            node["Node Type"] == "Seq Scan"
+            and node.get("Relation Name") in LARGE_TABLES
+        ):
+            problems.append(f"sequential scan on {node['Relation Name']}")
+        if node["Plan Rows"] > max_rows:
+            problems.append(f"{line} estimates {node['Plan Rows']} rows")
+        for child in node.get("Plans", []):
+            walk(child, depth + 1)
+
+    walk(plan[0]["Plan"], 0)
+    return lines, problems
+
+
+EXPLAINERS = {"sqlite": explain_sqlite, "postgresql": explain_postgresql}
+
+
+def capture_plans(client, engine, recorder):
+    explain = EXPLAINERS[engine.dialect.name]
+    plans = {}
+    problems = []
+    for name, method, path, kwargs in scenarios(engine):
+        # Start cold so the statements behind every cache are captured.
+        for cache in (
+            user_cache,
+            product_cache,
+            receipt_text_cache,
+            receipt_count_cache,
+            spending_cache,
+        ):
+            cache.clear()
+        recorder.statements = []
+        recorder.recording = True
+        try:
+            response = getattr(client, method)(path, **kwargs)
+        finally:
+            recorder.recording = False
+        assert response.status_code == 200, (name, response.text)
+
+        plans[name] = []
+        seen = set()
+        max_rows = ESTIMATED_ROWS_LIMITS.get(name, MAX_ESTIMATED_ROWS)
+        with engine.connect() as connection:
+            for statement, parameters in recorder.statements:
+                sql = normalize_sql(statement)
+                if sql in seen or not re.match(r"(SELECT|UPDATE|DELETE)\b", sql, re.I):
+                    continue
+                seen.add(sql)
+                lines, found = explain(connection, statement, parameters, max_rows)
+                plans[name].append({"sql": sql, "plan": lines})
+                problems.extend(f"{name}: {problem}\n  {sql}" for problem in found)
+    return plans, problems
+
+
+def test_query_plans(seeded):
+    client, engine, recorder = seeded
+    plans, problems = capture_plans(client, engine, recorder)
+    assert not problems, "\n".join(problems)
+
+    path = os.path.join(SNAPSHOT_DIR, f"{engine.dialect.name}.json")
+    if os.environ.get("UPDATE_PLAN_SNAPSHOTS") == "1":
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(plans, file, indent=2, ensure_ascii=False)
+            file.write("\n")
+        return
+
+    if not os.path.exists(path):
+        pytest.fail(f"No plan snapshot at {path}; run with UPDATE_PLAN_SNAPSHOTS=1")
+    with open(path, encoding="utf-8") as file:
+        expected = json.load(file)
+    assert plans == expected, (
+        "Query plans changed; review the difference and rerun with "
+        "UPDATE_PLAN_SNAPSHOTS=1 to accept it"
+    )
@@ -1,3 +1,12 @@
+import json
+from datetime import datetime
+from app import pagination
+from app.auth import create_access_token
+from app.config import settings
+from app.insights import SpendingColumns
+from app.revocation import utcnow
+
+
 def test_create_receipt(client, access_token):
     headers = {"Authorization": f"Bearer {access_token}"}
     receipt_data = {
@@ -29,4 +38,103 @@ def test_public_receipt_view(client):
 def test_invalid_receipt_access(client):
     response = client.get("/receipts/999")
     assert response.status_code == 404
-    assert response.json()["detail"] == "Receipt not found"
\ No newline at end of file
+    assert response.json()["detail"] == "Receipt not found"
+
+
+def test_list_receipts_total_count(client, access_token):
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = client.get("/receipts/", headers=headers, params={"count": "exact"})
+    assert response.status_code == 200
+    assert response.headers["X-Total-Count"] == str(len(response.json()))
+    assert response.headers["X-Total-Count-Mode"] == "exact"
+
+    response = client.get(
+        "/receipts/",
+        headers=headers,
+        params={"count": "estimate", "payment_type": "cashless"},
+    )
+    assert response.status_code == 200
+    assert response.headers["X-Total-Count"] == "0"
+
+
+def test_spending_insights(client, access_token):
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = client.get("/receipts/insights", headers=headers)
+    assert response.status_code == 200
+    count = response.json()["receipt_count"]
+
+    receipt_data = {
+        "products": [{"name": "coffee", "price": 4, "quantity": 5}],
+        "payment": {"type": "cashless", "amount": 20},
+    }
+    assert (
+        client.post("/receipts/", headers=headers, json=receipt_data).status_code == 200
+    )
+
+    response = client.get("/receipts/insights", headers=headers, params={"top": 1})
+    insights = response.json()
+    assert insights["receipt_count"] == count + 1
+    assert insights["top_products"] == [
+        {"name": "coffee", "price": 4.0, "quantity": 5, "spent": 20.0}
+    ]
+    assert sum(map(sum, insights["heatmap"])) == count + 1
+
+
+def test_insights_pick_up_receipts_committed_late(monkeypatch):
+    def row(receipt_id, created_at=None):
+        created_at = created_at or utcnow()
+        return (receipt_id, 2.0, created_at, 1, 1, 2.0, "late tea")
+
+    columns = SpendingColumns()
+    columns.catch_up([row(1, datetime(2026, 1, 1)), row(5)])
+    # Receipts created before the overlap window are settled by the first load.
+    assert columns.settled_until == 1 and columns.recent_ids == {5}
+    # Receipt 3 commits after 5 was read: the next catch-up reads both.
+    columns.catch_up([row(3), row(5)])
+    assert columns.summary(1)["receipt_count"] == 3
+    assert columns.recent_ids == {3, 5}
+
+    monkeypatch.setattr(settings, "INSIGHTS_OVERLAP_SECONDS", 0)
+    columns.catch_up([row(3), row(5), row(6)])
+    assert columns.settled_until == 6 and not columns.recent_ids
+    assert columns.summary(1)["receipt_count"] == 4
+
+
+def test_filtered_counts_follow_new_and_imported_receipts(client, monkeypatch):
+    user = {"username": "counted", "password": "pass", "name": "Co", "surname": "Unt"}
+    assert client.post("/users/register", json=user).status_code == 200
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': 'counted'})}"}
+    receipt = {
+        "products": [{"name": "counted tea", "price": 2.0, "quantity": 1}],
+        "payment": {"type": "cash", "amount": 5},
+    }
+
+    def cash_count(mode="exact"):
+        response = client.get(
+            "/receipts/",
+            headers=headers,
+            params={"count": mode, "payment_type": "cash"},
+        )
+        assert response.status_code == 200
+        return (
+            int(response.headers["X-Total-Count"]),
+            response.headers["X-Total-Count-Mode"],
+        )
+
+    assert cash_count() == (0, "exact")
+    assert client.post("/receipts/", headers=headers, json=receipt).status_code == 200
+    assert cash_count() == (1, "exact")
+
+    job_id = client.post("/receipts/imports/", headers=headers).json()["id"]
+    response = client.post(
+        f"/receipts/imports/{job_id}/lines",
+        headers=headers,
+        content=json.dumps(receipt).encode() + b"\n",
+    )
+    assert response.json()["receipts_imported"] == 1
+    assert cash_count() == (2, "exact")
+
+    # SQLite has no planner estimates, so the count stays exact.
+    assert cash_count("estimate") == (2, "exact")
+    monkeypatch.setattr(pagination, "estimate_rows", lambda db, query: 250000)
+    assert cash_count("estimate") == (250000, "estimate")
@@ -0,0 +1,92 @@
+import asyncio
+import gzip
+import httpx
+from fastapi.testclient import TestClient
+from app.capture import CaptureLog, TrafficCapture, pseudonym
+from app.main import app
+from app.replay import compare, read_capture, replay
+
+
+def test_captured_traffic_is_sanitized_and_replayed(client, tmp_path):
+    path = str(tmp_path / "capture-{pid}.ndjson.gz")
+    log = CaptureLog(path, max_records=100, max_body_bytes=65536)
+    log.start()
+    captured = TestClient(TrafficCapture(app, log))
+
+    user = {"username": "capturer", "password": "s3cret", "name": "Ca", "surname": "P"}
+    assert captured.post("/users/register", json=user).status_code == 200
+    tokens = captured.post(
+        "/users/login", data={"username": "capturer", "password": "s3cret"}
+    ).json()
+    headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+    receipt = captured.post(
+        "/receipts/",
+        headers=headers,
+        json={
+            "products": [{"name": "replay bread", "price": 3.0, "quantity": 2}],
+            "payment": {"type": "cash", "amount": 10},
+        },
+    ).json()
+    assert captured.get(f"/receipts/{receipt['id']}").status_code == 200
+    assert captured.get("/receipts/?limit=5", headers=headers).status_code == 200
+    refreshed = captured.post(
+        "/users/refresh", params={"refresh_token": tokens["refresh_token"]}
+    )
+    assert refreshed.status_code == 200
+    log.stop()
+
+    with gzip.open(log.path, "rt") as f:
+        raw = f.read()
+    for secret in (
+        "s3cret",
+        "capturer",
+        tokens["access_token"],
+        tokens["refresh_token"],
+    ):
+        assert secret not in raw
+
+    records = read_capture([log.path])
+    alias = pseudonym("capturer")
+    assert [(record["method"], record["route"]) for record in records] == [
+        ("POST", "/users/register"),
+        ("POST", "/users/login"),
+        ("POST", "/receipts/"),
+        ("GET", "/receipts/{receipt_id}"),
+        ("GET", "/receipts/"),
+        ("POST", "/users/refresh"),
+    ]
+    register, login, create, public, listing, refresh = records
+    assert (
+        register["json"]["username"] == alias and register["json"]["password"] is None
+    )
+    assert login["form"] == {"username": alias, "password": None}
+    assert create["user"] == alias and create["created_id"] == receipt["id"]
+    assert public["path_params"] == {"receipt_id": str(receipt["id"])}
+    assert listing["query"] == "limit=5"
+    assert refresh["user"] == alias and refresh["query"] == "refresh_token="
+
+    report = asyncio.run(
+        replay(
+            records,
+            "http://replay",
+            speed=0,
+            concurrency=1,
+            transport=httpx.ASGITransport(app=app),
+        )
+    )
+    routes = report["routes"]
+    assert report["requests"] == 6 and report["skipped"] == 0
+    # The replay registers the captured user before the clock starts.
+    assert routes["POST /users/register"]["statuses"] == {"400": 1}
+    for key in (
+        "POST /users/login",
+        "POST /receipts/",
+        "GET /receipts/{receipt_id}",
+        "GET /receipts/",
+        "POST /users/refresh",
+    ):
+        assert routes[key]["statuses"] == {"200": 1}, key
+        assert routes[key]["p99_ms"] >= routes[key]["p50_ms"] > 0
+
+    compared = compare(report, {"routes": {"GET /receipts/": {"p50_ms": 1.0}}})
+    assert "p50_ratio" in compared["routes"]["GET /receipts/"]
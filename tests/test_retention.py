@@ -0,0 +1,202 @@
+import json
+import os
+from datetime import datetime
+from app.archive import archive, archive_receipts
+from app.auth import create_access_token
+from app.changes import last_offset, read_changes
+from app.config import settings
+from app.models import Product, PurgeCheckpoint, Receipt, receipt_product
+from app.retention import Pacer, purge_archived_receipts, purge_receipts
+from app.routers.receipts import receipt_text_cache
+from app.sharding import ShardRouter
+from conftest import TestingSessionLocal
+
+
+def test_pacer_backs_off_on_slow_batches():
+    pacer = Pacer(max_batch=100, min_batch=10, target_seconds=0.1, duty_cycle=0.25)
+    assert pacer.batch == 10
+    for _ in range(20):
+        pacer.done(0.01)
+    assert pacer.batch == 100
+    assert pacer.done(0.4) == 0.4 * 3
+    assert pacer.batch == 50
+    for _ in range(5):
+        pacer.done(1.0)
+    assert pacer.batch == 10
+
+
+def test_purge_deletes_expired_receipts_in_resumable_batches(client):
+    user = {"username": "purged", "password": "pass", "name": "Ex", "surname": "Pired"}
+    assert client.post("/users/register", json=user).status_code == 200
+    token = client.post(
+        "/users/login", data={"username": "purged", "password": "pass"}
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    def create(name):
+        response = client.post(
+            "/receipts/",
+            headers=headers,
+            json={
+                "products": [
+                    {"name": name, "price": 1.0, "quantity": 1},
+                    {"name": "purge staple", "price": 2.0, "quantity": 1},
+                ],
+                "payment": {"type": "cash", "amount": 10},
+            },
+        )
+        assert response.status_code == 200
+        return response.json()["id"]
+
+    expired = [create(f"purge only {n}") for n in range(5)]
+    kept = create("purge kept")
+
+    db = TestingSessionLocal()
+    db.query(Receipt).filter(Receipt.id.in_(expired)).update(
+        {Receipt.created_at: datetime(1999, 1, 1)}, synchronize_session=False
+    )
+    db.commit()
+    cutoff = datetime(2000, 1, 1)
+    pauses = []
+
+    def pacer():
+        return Pacer(max_batch=2, min_batch=2, target_seconds=10.0, duty_cycle=0.5)
+
+    # The budget stops the first run early; the second one resumes.
+    result = purge_receipts(
+        db, 0, cutoff, max_receipts=3, pacer=pacer(), sleep=pauses.append
+    )
+    assert result["receipts"] == 3 and not result["finished"]
+    assert result["batches"] == 2 and len(pauses) == 2
+    assert result["lag_seconds"] > 0
+    checkpoint = db.get(PurgeCheckpoint, "receipts")
+    assert checkpoint.after_id == expired[2]
+
+    progress = []
+    result = purge_receipts(
+        db, 0, cutoff, pacer=pacer(), progress=progress.append, sleep=pauses.append
+    )
+    assert result["receipts"] == 2 and result["finished"]
+    assert result["line_items"] == 4 and result["products"] == 2
+    assert result["lag_seconds"] == 0.0
+    assert progress[-1]["receipts"] == 2 and progress[-1]["rows_per_second"] > 0
+    db.refresh(checkpoint)
+    assert checkpoint.after_id is None and checkpoint.receipts_deleted == 5
+    assert checkpoint.products_deleted == 5
+
+    assert db.query(Receipt).filter(Receipt.id.in_(expired)).count() == 0
+    names = {name for (name,) in db.query(Product.name)}
+    assert "purge kept" in names and "purge staple" in names
+    assert not any(name.startswith("purge only") for name in names)
+    db.close()
+
+    response = client.get("/receipts/?count=exact", headers=headers)
+    assert response.headers["X-Total-Count"] == "1"
+    assert [receipt["id"] for receipt in response.json()] == [kept]
+    assert client.get(f"/receipts/{expired[0]}").status_code == 404
+
+
+def test_purge_deletes_archived_receipts(client, tmp_path):
+    user = {"username": "archpurge", "password": "pass", "name": "Ar", "surname": "Ch"}
+    assert client.post("/users/register", json=user).status_code == 200
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': 'archpurge'})}"}
+
+    def create():
+        response = client.post(
+            "/receipts/",
+            headers=headers,
+            json={
+                "products": [{"name": "archived purge", "price": 1.0, "quantity": 1}],
+                "payment": {"type": "cash", "amount": 10},
+            },
+        )
+        assert response.status_code == 200
+        return response.json()["id"]
+
+    expired, old, live = [create(), create()], create(), create()
+    db = TestingSessionLocal()
+    archive.reopen(str(tmp_path))
+    try:
+        db.query(Receipt).filter(Receipt.id.in_(expired)).update(
+            {Receipt.created_at: datetime(1999, 1, 1)}, synchronize_session=False
+        )
+        db.query(Receipt).filter(Receipt.id == old).update(
+            {Receipt.created_at: datetime(2003, 1, 1)}, synchronize_session=False
+        )
+        db.commit()
+        assert archive_receipts(db, archive, datetime(2005, 1, 1)) == 3
+        start = last_offset(db)
+
+        router = ShardRouter([], primary=TestingSessionLocal)
+        result = purge_archived_receipts(router, archive, datetime(2000, 1, 1))
+        assert result == {"receipts": 2, "segments": 1}
+        assert archive.get(expired[0]) is None and archive.get(old) is not None
+        assert [change.receipt_id for change in read_changes(db, start, 10)] == expired
+        response = client.get("/receipts/?count=exact", headers=headers)
+        assert [receipt["id"] for receipt in response.json()] == [live, old]
+        assert response.headers["X-Total-Count"] == "2"
+        receipt_text_cache.clear()
+        assert client.get(f"/receipts/{expired[0]}").status_code == 404
+
+        # A segment left with only expired receipts is removed.
+        result = purge_archived_receipts(router, archive, datetime(2004, 1, 1))
+        assert result == {"receipts": 1, "segments": 1}
+        assert not [name for name in os.listdir(tmp_path) if "segment" in name]
+        response = client.get("/receipts/?count=exact", headers=headers)
+        assert [receipt["id"] for receipt in response.json()] == [live]
+        assert response.headers["X-Total-Count"] == "1"
+    finally:
+        archive.reopen(settings.ARCHIVE_DIR)
+        db.close()
+
+
+def test_cached_ids_of_purged_products_are_looked_up_again(client):
+    user = {"username": "staleprod", "password": "pass", "name": "St", "surname": "Ale"}
+    user_id = client.post("/users/register", json=user).json()["id"]
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': 'staleprod'})}"}
+    receipt = {
+        "products": [{"name": "stale soap", "price": 1.0, "quantity": 1}],
+        "payment": {"type": "cash", "amount": 10},
+    }
+
+    def purge_everything():
+        # As a purge in another worker would, without reaching this one's cache.
+        db = TestingSessionLocal()
+        stale = db.query(Product).filter(Product.name == "stale soap").one()
+        db.execute(
+            receipt_product.delete().where(receipt_product.c.product_id == stale.id)
+        )
+        db.delete(stale)
+        db.commit()
+        db.close()
+
+    assert client.post("/receipts/", headers=headers, json=receipt).status_code == 200
+    purge_everything()
+    response = client.post("/receipts/", headers=headers, json=receipt)
+    assert response.status_code == 200
+    assert "stale soap" in client.get(f"/receipts/{response.json()['id']}").text
+
+    purge_everything()
+    job_id = client.post("/receipts/imports/", headers=headers).json()["id"]
+    response = client.post(
+        f"/receipts/imports/{job_id}/lines",
+        headers=headers,
+        content=json.dumps(receipt).encode() + b"\n",
+    )
+    assert response.json()["receipts_imported"] == 1
+
+    db = TestingSessionLocal()
+    try:
+        product_ids = {
+            product_id
+            for (product_id,) in db.query(receipt_product.c.product_id).filter(
+                receipt_product.c.receipt_id.in_(
+                    db.query(Receipt.id).filter(Receipt.user_id == user_id)
+                )
+            )
+        }
+        assert product_ids == {
+            db.query(Product.id).filter(Product.name == "stale soap").scalar()
+        }
+    finally:
+        db.close()
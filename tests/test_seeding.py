@@ -0,0 +1,69 @@
+from datetime import datetime
+from sqlalchemy import create_engine, text
+from app.database import Base
+from app.seeding import SeedOptions, seed_database
+from app.sharding import ShardRouter
+
+
+def seeded_rows(path):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    options = SeedOptions(
+        users=20, products=50, receipts=300, end=datetime(2026, 1, 1), seed=7
+    )
+    written = seed_database(engine, options)
+    with engine.connect() as connection:
+        receipts = connection.execute(text("SELECT * FROM receipts ORDER BY id")).all()
+        items = connection.execute(
+            text("SELECT * FROM receipt_product ORDER BY receipt_id, product_id")
+        ).all()
+        counts_match = connection.execute(
+            text(
+                """
+                SELECT COUNT(*) FROM users WHERE receipt_count != (
+                    SELECT COUNT(*) FROM receipts WHERE receipts.user_id = users.id
+                )
+                """
+            )
+        ).scalar()
+    engine.dispose()
+    return written, receipts, items, counts_match
+
+
+def test_seed_is_deterministic(tmp_path):
+    written, receipts, items, mismatched = seeded_rows(tmp_path / "a.db")
+    assert written["receipts"] == len(receipts) == 300
+    assert written["receipt_product"] == len(items)
+    assert mismatched == 0
+
+    assert seeded_rows(tmp_path / "b.db")[1:3] == (receipts, items)
+
+
+def test_seeded_users_are_placed_on_their_shards(tmp_path):
+    engines = [create_engine(f"sqlite:///{tmp_path / name}") for name in "ab"]
+    for engine in engines:
+        Base.metadata.create_all(bind=engine)
+    router = ShardRouter([f"sqlite:///{tmp_path / 'b'}"])
+    options = SeedOptions(
+        users=20, products=50, receipts=300, end=datetime(2026, 1, 1), seed=7
+    )
+    seed_database(engines[0], options, router=router)
+
+    with engines[0].connect() as connection:
+        shards = dict(connection.execute(text("SELECT id, shard FROM users")).all())
+    assert shards == {user_id: router.shard_for(user_id) for user_id in shards}
+    assert set(shards.values()) == {0, 1}
+
+    receipts = 0
+    for shard, engine in enumerate(engines):
+        with engine.connect() as connection:
+            owners = connection.execute(
+                text("SELECT DISTINCT user_id FROM receipts")
+            ).scalars()
+            assert {shards[user_id] for user_id in owners} == {shard}
+            receipts += connection.execute(
+                text("SELECT SUM(receipt_count) FROM users")
+            ).scalar()
+        engine.dispose()
+    router.dispose()
+    assert receipts == 300
@@ -0,0 +1,296 @@
+import json
+from datetime import datetime
+import pytest
+from sqlalchemy import create_engine, delete, func, select, update
+from app.archive import archive, archive_receipts
+from app.auth import create_access_token
+from app.config import settings
+from app.database import Base, SessionLocal
+from app.models import ImportJob, ImportJobForward, Receipt, ReceiptForward, User
+from app.routers.receipts import receipt_text_cache
+from app.sharding import (
+    HashRing,
+    UserMove,
+    rebalance,
+    shard_router,
+    split_receipt_id,
+)
+from conftest import TestingSessionLocal
+
+
+def test_hash_ring_only_moves_keys_to_the_new_shard():
+    before, after = HashRing(3), HashRing(4)
+    moved = [
+        key for key in range(10000) if before.shard_for(key) != after.shard_for(key)
+    ]
+    assert all(after.shard_for(key) == 3 for key in moved)
+    assert 1500 < len(moved) < 3500
+
+
+@pytest.fixture
+def shard_urls(tmp_path):
+    urls = []
+    for number in (1, 2):
+        url = f"sqlite:///{tmp_path / f'shard{number}.db'}"
+        engine = create_engine(url)
+        Base.metadata.create_all(bind=engine)
+        engine.dispose()
+        urls.append(url)
+    shard_router.configure(urls[:1], primary=TestingSessionLocal)
+    yield urls
+    shard_router.configure([], primary=SessionLocal)
+    # Rebalancing may have moved users of other test modules to these shards.
+    # The shards are recreated for every test, so their forwards are stale.
+    db = TestingSessionLocal()
+    db.execute(update(User).values(shard=0))
+    db.execute(delete(ReceiptForward))
+    db.execute(delete(ImportJobForward))
+    db.commit()
+    db.close()
+
+
+def register_until(client, wanted: set) -> dict:
+    """
+    Register users until there is one for each wanted placement, given as
+    (shard with two shards, shard with three shards).
+    """
+    rings = {count: HashRing(count) for count in (2, 3)}
+    found = {}
+    for number in range(60):
+        username = f"sharded{number}"
+        response = client.post(
+            "/users/register",
+            json={
+                "username": username,
+                "password": "pass",
+                "name": "S",
+                "surname": "U",
+            },
+        )
+        user_id = response.json()["id"]
+        placement = (rings[2].shard_for(user_id), rings[3].shard_for(user_id))
+        if placement in wanted and placement not in found:
+            found[placement] = (user_id, username)
+            if len(found) == len(wanted):
+                return found
+    pytest.fail(f"No users registered for placements {set(wanted) - set(found)}")
+
+
+def shard_receipt_count(url: str, user_id: int) -> int:
+    engine = create_engine(url)
+    with engine.connect() as connection:
+        count = connection.execute(
+            select(func.count()).where(Receipt.user_id == user_id)
+        ).scalar()
+    engine.dispose()
+    return count
+
+
+def test_receipts_follow_user_shard(client, shard_urls):
+    placements = register_until(client, {(1, 2), (0, 2), (1, 1)})
+    receipts = {}
+    for (before, _), (user_id, username) in placements.items():
+        headers = {"Authorization": f"Bearer {create_access_token({'sub': username})}"}
+        ids = []
+        for amount in (10, 20):
+            response = client.post(
+                "/receipts/",
+                headers=headers,
+                json={
+                    "products": [{"name": "sharded tea", "price": 4.0, "quantity": 2}],
+                    "payment": {"type": "cash", "amount": amount},
+                },
+            )
+            assert response.status_code == 200
+            ids.append(response.json()["id"])
+        assert [split_receipt_id(i)[0] for i in ids] == [before, before]
+        receipts[user_id] = (
+            headers,
+            ids,
+            [client.get(f"/receipts/{i}").text for i in ids],
+        )
+
+    user_on_shard_1 = placements[(1, 2)][0]
+    db = TestingSessionLocal()
+    assert db.get(User, user_on_shard_1).shard == 1
+    assert db.query(Receipt).filter(Receipt.user_id == user_on_shard_1).count() == 0
+    db.close()
+    assert shard_receipt_count(shard_urls[0], user_on_shard_1) == 2
+
+    # Add shard 2 and move the users the ring now places there.
+    shard_router.configure(shard_urls, primary=TestingSessionLocal)
+    result = rebalance(shard_router, settle_seconds=0)
+    assert result["receipts"] >= 4
+    assert rebalance(shard_router, dry_run=True)["users"] == 0
+
+    receipt_text_cache.clear()
+    for (before, after), (user_id, _) in placements.items():
+        headers, old_ids, texts = receipts[user_id]
+        # Old ids keep working through the forwarding table.
+        assert [client.get(f"/receipts/{i}").text for i in old_ids] == texts
+
+        response = client.get("/receipts/?count=exact", headers=headers)
+        assert response.headers["X-Total-Count"] == "2"
+        new_ids = [receipt["id"] for receipt in response.json()]
+        assert {split_receipt_id(i)[0] for i in new_ids} == {after}
+        if before == after:
+            assert new_ids == old_ids
+
+    assert shard_receipt_count(shard_urls[0], user_on_shard_1) == 0
+    assert shard_receipt_count(shard_urls[1], user_on_shard_1) == 2
+
+
+def test_receipts_written_to_the_old_shard_after_the_switch_are_moved(
+    client, shard_urls
+):
+    user = {"username": "late-mover", "password": "pass", "name": "L", "surname": "M"}
+    user_id = client.post("/users/register", json=user).json()["id"]
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': 'late-mover'})}"}
+    response = client.post(
+        "/receipts/",
+        headers=headers,
+        json={
+            "products": [{"name": "late tea", "price": 4.0, "quantity": 1}],
+            "payment": {"type": "cash", "amount": 10},
+        },
+    )
+    source = split_receipt_id(response.json()["id"])[0]
+    target = 1 - source
+
+    move = UserMove(shard_router, user_id, target, settle_seconds=0)
+    assert move.switch()
+    # A worker that has not seen the switch yet writes to the old shard.
+    db = shard_router.session(source)
+    try:
+        db.add(
+            Receipt(
+                user_id=user_id,
+                total=3.0,
+                created_at=datetime(2026, 1, 1),
+                payment_type="cash",
+                payment_amount=3.0,
+            )
+        )
+        db.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(receipt_count=User.receipt_count + 1)
+        )
+        db.commit()
+    finally:
+        db.close()
+    assert move.finish() == 2
+
+    urls = {shard: url for shard, url in enumerate(shard_urls[:1], start=1)}
+    for shard, expected in ((source, 0), (target, 2)):
+        if shard in urls:
+            assert shard_receipt_count(urls[shard], user_id) == expected
+        else:
+            db = TestingSessionLocal()
+            count = db.query(Receipt).filter(Receipt.user_id == user_id).count()
+            db.close()
+            assert count == expected
+    response = client.get("/receipts/", headers=headers, params={"count": "exact"})
+    assert response.headers["X-Total-Count"] == "2"
+    assert {split_receipt_id(r["id"])[0] for r in response.json()} == {target}
+
+
+def test_import_jobs_move_with_their_user(client, shard_urls):
+    user = {"username": "job-mover", "password": "pass", "name": "J", "surname": "M"}
+    user_id = client.post("/users/register", json=user).json()["id"]
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': 'job-mover'})}"}
+    job_id = client.post("/receipts/imports/", headers=headers).json()["id"]
+    lines = [
+        json.dumps(
+            {
+                "products": [{"name": "moved tea", "price": 4.0, "quantity": 1}],
+                "payment": {"type": "cash", "amount": 5},
+            }
+        ).encode(),
+        b"not json",
+    ]
+    response = client.post(
+        f"/receipts/imports/{job_id}/lines",
+        headers=headers,
+        content=lines[0] + b"\n" + lines[1] + b"\n",
+    )
+    assert response.json()["receipts_imported"] == 1
+    source, local_id = split_receipt_id(job_id)
+    target = 1 - source
+    # The connection dropped after these lines.
+    db = shard_router.session(source)
+    db.execute(
+        update(ImportJob).where(ImportJob.id == local_id).values(status="interrupted")
+    )
+    db.commit()
+    db.close()
+
+    move = UserMove(shard_router, user_id, target, settle_seconds=0)
+    assert move.switch()
+    # Until the move finishes, the job is read from the old shard.
+    response = client.get(f"/receipts/imports/{job_id}", headers=headers)
+    assert response.status_code == 200 and response.json()["id"] == job_id
+    move.finish()
+
+    response = client.get(f"/receipts/imports/{job_id}", headers=headers)
+    assert response.status_code == 200
+    job = response.json()
+    assert split_receipt_id(job["id"])[0] == target
+    assert (job["lines_committed"], job["receipts_imported"]) == (2, 1)
+    assert [error["line"] for error in job["errors"]] == [2]
+
+    # An upload resumed through the old id skips the lines already imported.
+    response = client.post(
+        f"/receipts/imports/{job_id}/lines",
+        headers=headers,
+        content=b"\n".join(lines + [lines[0]]) + b"\n",
+    )
+    assert response.status_code == 200
+    assert response.json()["receipts_imported"] == 2
+    response = client.get("/receipts/", headers=headers, params={"count": "exact"})
+    assert response.headers["X-Total-Count"] == "2"
+    assert {split_receipt_id(r["id"])[0] for r in response.json()} == {target}
+
+
+def test_archive_keeps_public_ids_of_sharded_receipts(client, shard_urls, tmp_path):
+    ring = HashRing(2)
+    for number in range(60):
+        username = f"archived-sharded{number}"
+        response = client.post(
+            "/users/register",
+            json={
+                "username": username,
+                "password": "pass",
+                "name": "A",
+                "surname": "S",
+            },
+        )
+        if ring.shard_for(response.json()["id"]) == 1:
+            break
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': username})}"}
+    response = client.post(
+        "/receipts/",
+        headers=headers,
+        json={
+            "products": [{"name": "archived tea", "price": 4.0, "quantity": 1}],
+            "payment": {"type": "cash", "amount": 10},
+        },
+    )
+    receipt_id = response.json()["id"]
+    assert split_receipt_id(receipt_id)[0] == 1
+
+    archive.reopen(str(tmp_path / "archive"))
+    db = shard_router.session(1)
+    try:
+        db.execute(update(Receipt).values(created_at=datetime(2000, 1, 1)))
+        db.commit()
+        receipt_text_cache.clear()
+        text = client.get(f"/receipts/{receipt_id}").text
+        assert archive_receipts(db, archive, datetime(2001, 1, 1), shard=1) == 1
+        receipt_text_cache.clear()
+        assert client.get(f"/receipts/{receipt_id}").text == text
+        response = client.get("/receipts/", headers=headers, params={"limit": 5})
+        assert [receipt["id"] for receipt in response.json()] == [receipt_id]
+    finally:
+        archive.reopen(settings.ARCHIVE_DIR)
+        db.close()
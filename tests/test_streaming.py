@@ -0,0 +1,138 @@
+import asyncio
+import json
+import threading
+from app.auth import create_access_token
+from app.config import settings
+from app import streaming
+from app.streaming import ReceiptBroker, receipt_broker
+
+
+def test_broker_drops_slow_consumers_and_relays_other_workers():
+    async def scenario():
+        broker = ReceiptBroker(max_events=2)
+        slow = broker.subscribe(1)
+        other = broker.subscribe(2)
+        receipt = {
+            "id": 7,
+            "products": [],
+            "total": 1.0,
+            "rest": 0.0,
+            "created_at": "2026-01-01T00:00:00",
+            "payment": {"type": "cash", "amount": 1.0},
+        }
+        for _ in range(3):
+            await asyncio.to_thread(broker.publish, 1, receipt)
+        assert await slow.wait(1.0)
+        assert slow.overflowed and not slow.events
+
+        # Another worker's receipt arrives as a user id through the bus.
+        broker.evict(2)
+        assert await other.wait(1.0)
+        assert other.catch_up and not other.events
+        # The copy of this worker's own announcement is ignored.
+        other.catch_up = False
+        await asyncio.to_thread(broker.publish, 2, receipt)
+        assert await other.wait(1.0)
+        assert not other.catch_up and len(other.events) == 1
+
+        # After missed messages every stream catches up.
+        other.events.clear()
+        broker.clear()
+        assert await other.wait(1.0)
+        assert other.catch_up
+
+        broker.unsubscribe(slow)
+        broker.unsubscribe(other)
+        assert broker.all_subscriptions() == []
+
+    asyncio.run(scenario())
+
+
+def test_broker_only_announces_watched_users(monkeypatch):
+    published = []
+
+    class RecordingBus:
+        def publish(self, topic, *keys):
+            published.append((topic, keys))
+
+    monkeypatch.setattr(streaming, "bus", RecordingBus())
+    broker = ReceiptBroker(max_events=2)
+    broker.notify(1)
+    assert published == []
+
+    # A stream for user 1 opened in another worker.
+    broker.watchers.evict(1)
+    broker.notify(1)
+    broker.notify(2)
+    assert published == [("receipt_streams", (1,))]
+
+    monkeypatch.setattr(settings, "STREAM_HEARTBEAT_SECONDS", 0)
+    broker.watchers.evict(3)
+    broker.notify(3)
+    assert len(published) == 1
+    # After missed messages every user counts as watched.
+    monkeypatch.setattr(settings, "STREAM_HEARTBEAT_SECONDS", 15)
+    broker.watchers.clear()
+    broker.notify(2)
+    assert published[-1] == ("receipt_streams", (2,))
+
+
+def read_events(text):
+    events = []
+    for block in text.split("\n\n"):
+        fields = dict(
+            line.split(": ", 1) for line in block.splitlines() if ": " in line
+        )
+        if fields.get("event") == "receipt":
+            events.append((int(fields["id"]), json.loads(fields["data"])))
+    return events
+
+
+def test_stream_replays_and_pushes_new_receipts(client, monkeypatch):
+    monkeypatch.setattr(settings, "STREAM_MAX_SECONDS", 1.0)
+    monkeypatch.setattr(settings, "STREAM_HEARTBEAT_SECONDS", 0.2)
+    monkeypatch.setattr(settings, "STREAM_REPLAY_BATCH", 2)
+    user = {"username": "watcher", "password": "pass", "name": "Li", "surname": "Ve"}
+    assert client.post("/users/register", json=user).status_code == 200
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': 'watcher'})}"}
+
+    def create(amount):
+        response = client.post(
+            "/receipts/",
+            headers=headers,
+            json={
+                "products": [{"name": "stream tea", "price": 2.0, "quantity": 1}],
+                "payment": {"type": "cash", "amount": amount},
+            },
+        )
+        assert response.status_code == 200
+        return response.json()
+
+    created = [create(amount) for amount in (10, 20, 30, 40)]
+
+    # Created while the stream below is open.
+    pushed = []
+    timer = threading.Timer(0.3, lambda: pushed.append(create(50)))
+    timer.start()
+    response = client.get(
+        "/receipts/stream",
+        headers={**headers, "Last-Event-ID": str(created[0]["id"])},
+    )
+    timer.join()
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert ": heartbeat" in response.text
+
+    events = read_events(response.text)
+    assert [event_id for event_id, _ in events] == [
+        receipt["id"] for receipt in created[1:] + pushed
+    ]
+    assert events[0][1] == created[1]
+    assert events[-1][1] == pushed[0]
+    assert receipt_broker.all_subscriptions() == []
+
+    # Without Last-Event-ID only new receipts are sent.
+    response = client.get("/receipts/stream", headers=headers)
+    assert read_events(response.text) == []
+
+    assert client.get("/receipts/stream").status_code == 401
@@ -0,0 +1,91 @@
+from app.auth import create_access_token
+from app.leaderboard import leaderboard
+from app.suggestions import SortedProducts, product_index
+
+
+def test_sorted_products_find_prefix_ranges():
+    products = SortedProducts(
+        [
+            ("Milk", 1.5, 10),
+            ("milk", 1.0, 3),
+            ("Mint tea", 2.0, 7),
+            ("Ägg", 3.0, 1),
+            ("Mango", 0.5, 0),
+            ("Bread", 1.0, 20),
+        ]
+    )
+    start, stop = products.prefix_range("mi")
+    assert [products.name(i) for i in range(start, stop)] == [
+        "milk",
+        "Milk",
+        "Mint tea",
+    ]
+    start_x, stop_x = products.prefix_range("x")
+    assert start_x == stop_x
+    assert products.find("Milk", 1.5) == start + 1
+    assert products.prefix_range("äg") == (len(products) - 1, len(products))
+    assert products.find("Milk", 1.0) is None
+    assert products.find("Ägg", 3.0) is not None
+
+    start, stop = products.prefix_range("m")
+    assert [row[0] for row in products.top(start, stop, 2)] == ["Milk", "Mint tea"]
+    # Equal counts are kept in name order.
+    assert products.top(start, stop, 10)[0] == ("Mango", 0.5, 0)
+
+
+def test_suggest_ranks_by_units_sold(client):
+    user = {"username": "cashier", "password": "pass", "name": "Ca", "surname": "Sh"}
+    assert client.post("/users/register", json=user).status_code == 200
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': 'cashier'})}"}
+
+    def sell(*products):
+        response = client.post(
+            "/receipts/",
+            headers=headers,
+            json={
+                "products": [
+                    {"name": name, "price": price, "quantity": quantity}
+                    for name, price, quantity in products
+                ],
+                "payment": {"type": "cash", "amount": 1000},
+            },
+        )
+        assert response.status_code == 200
+
+    def suggest(prefix, k=10):
+        response = client.get(
+            "/products/suggest", params={"prefix": prefix, "k": k}, headers=headers
+        )
+        assert response.status_code == 200
+        return [
+            (product["name"], product["price"], product["quantity"])
+            for product in response.json()["products"]
+        ]
+
+    sell(("Suggest Apple", 1.0, 1), ("suggest apricot", 2.0, 5))
+    # Loaded from the products table and the all-time sales.
+    leaderboard.flush()
+    product_index.rebuild()
+    assert suggest("SUGGEST AP") == [
+        ("suggest apricot", 2.0, 5),
+        ("Suggest Apple", 1.0, 1),
+    ]
+
+    # New products and sales are served before the next rebuild.
+    sell(("Suggest Apple", 1.0, 9), ("Suggest Avocado", 3.0, 2))
+    assert suggest("suggest a", k=2) == [
+        ("Suggest Apple", 1.0, 10),
+        ("suggest apricot", 2.0, 5),
+    ]
+    assert suggest("suggest av") == [("Suggest Avocado", 3.0, 2)]
+
+    leaderboard.flush()
+    product_index.rebuild()
+    assert suggest("suggest a") == [
+        ("Suggest Apple", 1.0, 10),
+        ("suggest apricot", 2.0, 5),
+        ("Suggest Avocado", 3.0, 2),
+    ]
+    assert suggest("suggest b") == []
+    assert client.get("/products/suggest?prefix=", headers=headers).status_code == 422
+    assert client.get("/products/suggest?prefix=a").status_code == 401
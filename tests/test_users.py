@@ -1,3 +1,11 @@
+from datetime import datetime
+from jose import jwt
+from app.config import settings
+from app.models import RevokedToken
+from app.revocation import BloomFilter, delete_expired, revocation_list
+from conftest import TestingSessionLocal
+
+
 def test_register_user(client):
     response = client.post(
         "/users/register",
@@ -40,4 +48,106 @@ def test_invalid_login(client):
         "/users/login", data={"username": "wronguser", "password": "wrongpass"}
     )
     assert response.status_code == 400
-    assert response.json()["detail"] == "Incorrect username or password"
\ No newline at end of file
+    assert response.json()["detail"] == "Incorrect username or password"
+
+def test_refresh_token_rotation(client):
+    response = client.post(
+        "/users/login", data={"username": "testuser", "password": "testpass"}
+    )
+    refresh_token = response.json()["refresh_token"]
+
+    response = client.post("/users/refresh", params={"refresh_token": refresh_token})
+    assert response.status_code == 200
+    rotated_token = response.json()["refresh_token"]
+    assert rotated_token != refresh_token
+
+    response = client.post("/users/refresh", params={"refresh_token": refresh_token})
+    assert response.status_code == 401
+
+    response = client.post("/users/logout", params={"refresh_token": rotated_token})
+    assert response.status_code == 204
+
+    response = client.post("/users/refresh", params={"refresh_token": rotated_token})
+    assert response.status_code == 401
+
+
+def test_register_users_bulk(client, monkeypatch):
+    monkeypatch.setattr(settings, "PROVISIONING_API_KEY", "p-key")
+    response = client.post(
+        "/users/login", data={"username": "testuser", "password": "testpass"}
+    )
+    user_headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    assert client.post("/users/register/bulk", headers=user_headers, json=[]).status_code == 401
+    assert client.post("/users/register/bulk", headers={"X-API-Key": "nope"}, json=[]).status_code == 403
+    headers = {"X-API-Key": "p-key"}
+    users = [
+        {"username": "cashier1", "password": "pass1", "name": "Ann", "surname": "Lee"},
+        {"username": "testuser", "password": "pass", "name": "Dup", "surname": "User"},
+        {"username": "cashier2", "password": "pass2", "name": "Bob", "surname": "Ray"},
+        {"username": "cashier1", "password": "pass3", "name": "Ann", "surname": "Kay"},
+    ]
+    response = client.post("/users/register/bulk", headers=headers, json=users)
+    assert response.status_code == 200
+    results = response.json()
+    assert [r["status"] for r in results] == [
+        "created",
+        "conflict",
+        "created",
+        "duplicate",
+    ]
+    assert results[0]["id"] is not None
+
+    response = client.post(
+        "/users/login", data={"username": "cashier2", "password": "pass2"}
+    )
+    assert response.status_code == 200
+
+
+def test_revocations_are_written_through(client):
+    response = client.post(
+        "/users/login", data={"username": "testuser", "password": "testpass"}
+    )
+    refresh_token = response.json()["refresh_token"]
+    jti = jwt.get_unverified_claims(refresh_token)["jti"]
+    assert client.post("/users/refresh", params={"refresh_token": refresh_token}).status_code == 200
+
+    db = TestingSessionLocal()
+    try:
+        assert db.get(RevokedToken, jti) is not None
+        # A worker that has not seen the rotation picks it up on its next sync.
+        revocation_list.clear()
+        assert revocation_list.is_revoked(db, jti)
+        assert not revocation_list.is_revoked(db, "never-issued")
+
+        db.add(RevokedToken(jti="expired", expires_at=datetime(2000, 1, 1), revoked_at=datetime(2000, 1, 1)))
+        db.commit()
+        assert delete_expired(db) == 1
+        assert db.get(RevokedToken, jti) is not None
+    finally:
+        db.close()
+    response = client.post("/users/refresh", params={"refresh_token": refresh_token})
+    assert response.status_code == 401
+
+
+def test_unsynced_revocations_are_caught_by_the_primary_key(client, monkeypatch):
+    response = client.post(
+        "/users/login", data={"username": "testuser", "password": "testpass"}
+    )
+    refresh_token = response.json()["refresh_token"]
+    assert client.post("/users/logout", params={"refresh_token": refresh_token}).status_code == 204
+
+    # As on another worker that has not synced since the logout.
+    revocation_list.clear()
+    monkeypatch.setattr(revocation_list, "sync", lambda db: None)
+    response = client.post("/users/refresh", params={"refresh_token": refresh_token})
+    assert response.status_code == 401
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    keys = [f"jti-{i}" for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+    assert false_positives < 300